@@ -23,7 +23,8 @@ Boston, MA 02111-1307, USA.
 """
 
 from optparse import OptionParser
-import math, sys, utilities, time
+import os, sys, time
+import binning
 
 ttotstart = time.time()
 
@@ -44,6 +45,19 @@ clopts.add_option('-d', '--delimiter', dest="delimiter", default=None,
                help="The column delimiter (defaults to any kind of whitespace)")
 clopts.add_option('-c', '--column', dest='column', default=1, type="int",
                   help="Which column to pull the data from")
+clopts.add_option('-w', '--weights', dest='weights', default=None, type="int",
+                  help="Column with a weight for each point (defaults to " +
+                  "equal weights)")
+clopts.add_option('-p', '--periodic', dest='periodic', action="store_true",
+                  default=False, help="Wrap values into the bin range " +
+                  "(e.g., for angles) rather than discarding those outside")
+clopts.add_option('-s', '--stream', dest='stream', action="store_true",
+                  default=False, help="Read the data in blocks without " +
+                  "holding it in memory (any extra arguments are more data " +
+                  "files). Without -r and -b, the data is read twice")
+clopts.add_option('-j', '--nproc', dest='nproc', default=1, type="int",
+                  help="Number of processes to histogram with in --stream " +
+                  "mode (default %default)")
 (opts, args) = clopts.parse_args()
 
 if not opts.output_file:
@@ -59,81 +73,69 @@ else:
    binrange = [0,0]
 data_file = opts.data_file
 output_file = opts.output_file
-normalize = opts.normalize
 script_name = opts.script_name
-delimiter = opts.delimiter
-column = opts.column
-phipsibins = []   # the list of all bins in both directions (dimension bins)
-data = []         # array of 2-element arrays that contains every pair of points
-discarded = 0     # count number of points that have been discarded
-pointweight = 1.0 # how much a single point is worth. 1 if not normalized.
-
-# read in data, check for existing file
-if data_file == 'none':
-   input_data = sys.stdin
-else:
-   try:
-      input_data = open(data_file,'r')
-   except IOError:
-      print 'Error: data file ' + data_file + ' not found!'
-      sys.exit(1)
-
-# load data into file
-for line in input_data:
-   if delimiter: words = line.split(delimiter)
-   else: words = line.split()
-   if len(words) < column: # skip any lines that don't have enough values
-      continue
-   try: # skip any lines where value is not a float
-      data.append(float(words[column-1]))
-   except ValueError:
-      continue
-
-input_data.close()
-
-# Set up default ranges
-if (binrange[0] == 0 and binrange[1] == 0):
-   xmaxminholder = utilities.minmax(data)
-   binrange[0] = math.floor(xmaxminholder[0])
-   binrange[1] = math.ceil(xmaxminholder[1])
-
-# Set up default number of bins according to "Scott's Choice"
-if bins == 0:
-   inttmp = 3.5 * utilities.stdev(data,'no') / float(len(data)) ** (1/3.0)
-   bins = int(math.ceil((binrange[1] - binrange[0])/inttmp))
-
-if normalize: 
-   pointweight /= float(len(data)) * (binrange[1] - binrange[0])/bins
-
-interval = (binrange[1] - binrange[0])/bins
 
-# create a large 1-D array with every bin (x1y1 x1y2 ... x1yN x2y1 x2y2 ... ... xNyN)
-for x in range(bins):
-   phipsibins.append(0)
-
-for x in range(len(data)):
-
-   xval = data[x]
-
-   if xval > binrange[1] or xval < binrange[0]:
-      discarded += 1
-      continue
-
-   xval -= binrange[0]
-
-   binnum = int(math.floor(xval/interval))
-
-   try:
-      phipsibins[binnum] += pointweight
-   except:
-      phipsibins[binnum-1] += pointweight
+columns = [opts.column]
+weights = None
+
+if opts.stream:
+   # Stream the data files (or stdin) through the histogram
+   data_files = args
+   if data_file != 'none': data_files = [data_file] + data_files
+   if not data_files: data_files = ['-']
+   for fname in data_files:
+      if fname != '-' and not os.path.exists(fname):
+         print 'Error: data file ' + fname + ' not found!'
+         sys.exit(1)
+   if (binrange[0] == 0 and binrange[1] == 0) or bins == 0:
+      if '-' in data_files:
+         print 'Error: -r and -b are required to stream from stdin'
+         sys.exit(1)
+      stats = binning.scan_files(data_files, columns, opts.delimiter,
+                                 opts.nproc)
+      if stats.n == 0:
+         print 'Error: no data found!'
+         sys.exit(1)
+      if (binrange[0] == 0 and binrange[1] == 0):
+         binrange = stats.default_range(0)
+      if bins == 0:
+         bins = stats.scott_bins(0, binrange[0], binrange[1])
+   hist = binning.histogram_files(data_files, columns, [binrange], [bins],
+                                  [opts.periodic], opts.weights,
+                                  opts.delimiter, opts.nproc)
+   data_file = ', '.join(data_files)
+else:
+   # read in data, check for existing file
+   if data_file == 'none':
+      input_data = sys.stdin
+   else:
+      try:
+         input_data = open(data_file,'r')
+      except IOError:
+         print 'Error: data file ' + data_file + ' not found!'
+         sys.exit(1)
+
+   # load data into file, skipping lines without (enough) numbers
+   if opts.weights: columns.append(opts.weights)
+   data = binning.load_columns(input_data, columns, opts.delimiter)
+   if opts.weights: weights = data[:,1]
+   data = data[:,0]
+
+   input_data.close()
+
+   # Set up default ranges
+   if (binrange[0] == 0 and binrange[1] == 0):
+      binrange = binning.default_range(data)
+
+   # Set up default number of bins according to "Scott's Choice"
+   if bins == 0:
+      bins = binning.scott_bins(data, binrange[0], binrange[1])
+
+   hist = binning.Histogram([binrange], [bins], [opts.periodic])
+   hist.add(data, weights)
 
-xprintval = binrange[0]
 outputfile = open(output_file,'w')
-for x in range(len(phipsibins)):
-   outputfile.write(str(xprintval) + ' ' + str(phipsibins[x]) + '\n')
-   xprintval += interval
-   
+hist.write(outputfile, opts.normalize)
 outputfile.close()
 
 if script_name != '':
@@ -152,5 +154,5 @@ if script_name != '':
    print 'GNUPLOT script:  ' + script_name
 print 'Numbers of Bins: ' + str(bins)
 print 'Bin X-Range:     ' + str(binrange[0]) + ' - ' + str(binrange[1])
-print 'Points Omitted:  ' + str(discarded)
+print 'Points Omitted:  ' + str(hist.discarded)
 print 'Done!'
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from __future__ import division
-import math, sys, utilities, time, re
+import sys, time, re, binning
 from optparse import OptionParser
 from os import path
 
@@ -26,6 +26,20 @@ parser.add_option('-c', '--columns', dest='columns', default=None,
 parser.add_option('-d', '--delimiter', dest='delimiter', default=None,
                   help='The string/character that delimits fields in the ' +
                   'input data file')
+parser.add_option('-w', '--weights', dest='weights', default=None, type='int',
+                  help='Column with a weight for each point (defaults to ' +
+                  'equal weights)')
+parser.add_option('-p', '--periodic', dest='periodic', default=False,
+                  action='store_true', help='Wrap values into the bin ' +
+                  'ranges (e.g., for dihedrals) rather than discarding those ' +
+                  'outside')
+parser.add_option('-s', '--stream', dest='stream', default=False,
+                  action='store_true', help='Read the data in blocks ' +
+                  'without holding it in memory (any extra arguments are more ' +
+                  'data files). Without -x, -y and -b, the data is read twice')
+parser.add_option('-j', '--nproc', dest='nproc', default=1, type='int',
+                  help='Number of processes to histogram with in --stream ' +
+                  'mode (default %default)')
 opt, args = parser.parse_args()
 
 # Set up regular expressions to parse the input commands.
@@ -77,104 +91,76 @@ else:
    col1 = 0
    col2 = 1
 
-maxcol = max(col1, col2) + 1
-
-if not opt.data_file:
-   input_data = sys.stdin
+script_name = opt.gnuplot
+columns = [col1 + 1, col2 + 1]
+weights = None
+
+if opt.stream:
+   # Stream the data files (or stdin) through the histogram
+   data_files = args
+   if opt.data_file: data_files = [opt.data_file] + data_files
+   if not data_files: data_files = ['-']
+   for fname in data_files:
+      if fname != '-' and not path.exists(fname):
+         print 'Error: Could not find %s!' % fname
+         sys.exit(1)
+   if (binrange[0] == 0 and binrange[1] == 0) or \
+      (binrange[2] == 0 and binrange[3] == 0) or bins[0] == 0 or bins[1] == 0:
+      if '-' in data_files:
+         print 'Error: -x, -y and -b are required to stream from stdin'
+         sys.exit(1)
+      stats = binning.scan_files(data_files, columns, opt.delimiter, opt.nproc)
+      if stats.n == 0:
+         print 'Error: no data found!'
+         sys.exit(1)
+      if binrange[0] == 0 and binrange[1] == 0:
+         binrange[0:2] = stats.default_range(0)
+      if binrange[2] == 0 and binrange[3] == 0:
+         binrange[2:4] = stats.default_range(1)
+      if bins[0] == 0 or bins[1] == 0:
+         bins[0] = stats.scott_bins(0, binrange[0], binrange[1])
+         bins[1] = stats.scott_bins(1, binrange[2], binrange[3])
+   hist = binning.histogram_files(data_files, columns,
+                                  [binrange[0:2], binrange[2:4]], bins,
+                                  [opt.periodic, opt.periodic], opt.weights,
+                                  opt.delimiter, opt.nproc)
+   opt.data_file = ', '.join(data_files)
 else:
-   if not path.exists(opt.data_file):
-      print 'Error: Could not find %s!' % opt.data_file
-      sys.exit(1)
-   input_data = open(opt.data_file)
+   if not opt.data_file:
+      input_data = sys.stdin
+   else:
+      if not path.exists(opt.data_file):
+         print 'Error: Could not find %s!' % opt.data_file
+         sys.exit(1)
+      input_data = open(opt.data_file)
 
-phipsibins = []   # the list of all bins in both directions
-data1 = []        # array of 2-element arrays that contains every pair of points
-data2 = []        # array of 2-element arrays that contains every pair of points
-discarded = 0     # count number of points that have been discarded
-pointweight = 1.0 # how much a single point is worth. 1 if not normalized.
-script_name = opt.gnuplot
+   # load data into file, skipping lines where either column is not a float
+   if opt.weights: columns.append(opt.weights)
+   data = binning.load_columns(input_data, columns, opt.delimiter)
+   if opt.weights: weights = data[:,2]
+   data = data[:,:2]
+
+   input_data.close()
+
+   # Set up default ranges
+   if binrange[0] == 0 and binrange[1] == 0:
+      binrange[0:2] = binning.default_range(data[:,0])
+   if binrange[2] == 0 and binrange[3] == 0:
+      binrange[2:4] = binning.default_range(data[:,1])
+
+   # Set up default number of bins according to "Scott's Choice"
+   if bins[0] == 0 or bins[1] == 0:
+      bins[0] = binning.scott_bins(data[:,0], binrange[0], binrange[1])
+      bins[1] = binning.scott_bins(data[:,1], binrange[2], binrange[3])
+
+   hist = binning.Histogram([binrange[0:2], binrange[2:4]], bins,
+                            [opt.periodic, opt.periodic])
+   hist.add(data, weights)
+
+discarded = hist.discarded
 
-# load data into file
-for line in input_data:
-   if opt.delimiter is None:
-      words = line.split()
-   else:
-      words = line.split(opt.delimiter)
-   if len(words) < maxcol: # skip any lines that don't have enough values
-      continue
-   try: # skip any lines where at least 1 of first 2 columns are not floats
-      data1.append(float(words[col1].strip()))
-      data2.append(float(words[col2].strip()))
-   except ValueError:
-      print words
-      continue
-
-input_data.close()
-
-# Set up default ranges
-if (binrange[0] == 0 and binrange[1] == 0) or \
-            (binrange[2] == 0 and binrange[3] == 0):
-   xmaxminholder = utilities.minmax(data1)
-   ymaxminholder = utilities.minmax(data2)
-   binrange[0] = math.floor(xmaxminholder[0])
-   binrange[1] = math.ceil(xmaxminholder[1])
-   binrange[2] = math.floor(ymaxminholder[0])
-   binrange[3] = math.ceil(ymaxminholder[1])
-
-# Set up default number of bins according to "Scott's Choice"
-if bins[0] == 0 or bins[1] == 0:
-   xinttmp = 3.5 * utilities.stdev(data1,'no') / float(len(data1)) ** (1/3)
-   yinttmp = 3.5 * utilities.stdev(data2,'no') / float(len(data2)) ** (1/3)
-   bins[0] = int(math.ceil((binrange[1] - binrange[0])/xinttmp))
-   bins[1] = int(math.ceil((binrange[3] - binrange[2])/yinttmp))
-if opt.normalize: 
-   pointweight /= float(len(data1)) * (
-            binrange[1]-binrange[0])*(binrange[3]-binrange[2])/(bins[0]*bins[1])
-
-xinterval = (binrange[1] - binrange[0])/bins[0]
-yinterval = (binrange[3] - binrange[2])/bins[1]
-
-# create a large 1-D array with every bin 
-# (x1y1 x1y2 ... x1yN x2y1 x2y2 ... ... xNyN)
-for x in range(bins[0]):
-   for y in range(bins[1]):
-      phipsibins.append(0)
-
-skipped = 0
-for x in range(len(data1)):
-
-   xval = data1[x]
-   yval = data2[x]
-
-   if xval > binrange[1] or xval < binrange[0] or yval > binrange[3] or \
-               yval < binrange[2]:
-      discarded += 1
-      continue
-
-   xval -= binrange[0]
-   yval -= binrange[2]
-
-   binnum = int(math.floor(xval/xinterval) * bins[1] + math.floor(yval/yinterval))
-
-   try:
-      phipsibins[binnum] += pointweight
-   except IndexError:
-      skipped += 1
-
-if skipped > 0:
-   print 'Warning: %d points did not fit into the range.' % skipped
-
-xprintval = binrange[0]
-yprintval = binrange[2]
 outputfile = open(opt.output_file,'w')
-for x in range(len(phipsibins)):
-   if x != 0 and x % bins[1] == 0:
-      xprintval += xinterval
-      yprintval = binrange[2]
-      outputfile.write('\n')
-   outputfile.write('%s %s %s\n' % (xprintval,yprintval,phipsibins[x]))
-   yprintval += yinterval
-   
+hist.write(outputfile, opt.normalize)
 outputfile.close()
 
 if script_name:
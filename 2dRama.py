@@ -9,14 +9,19 @@
 import numpy as np
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
+import binning
 
 kb = 1.9858775e-3 	# Boltzmann const
 T = 300.0		# Simulation Temperature
 
 name = 'dihedrals.300' # Input filename - output file name will be created based on input
-phipsi = np.loadtxt('%s.dat'%name)
+nproc = 1		# Number of processes to histogram the input file with
 
-H, xedges, yedges = np.histogram2d(phipsi[:,3], phipsi[:,2], bins=72, range = [[-180,180],[-180,180]])
+# Stream the phi/psi columns through the histogram so the data never has to fit
+# in memory
+hist = binning.histogram_files(['%s.dat'%name], [4, 3], [[-180,180],[-180,180]], [72, 72], nproc=nproc)
+H = hist.counts.reshape((72, 72))
+xedges = yedges = np.linspace(-180, 180, 73)
 extent = (xedges[0],xedges[-1],yedges[0],yedges[-1]) #get the xmin,xmax values for 
 H = -kb * T * np.log(H/H.max())    # Convert populations to free energy; highest populated bin at 0 kcal/mol
 
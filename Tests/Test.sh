@@ -82,6 +82,29 @@ diff -Nru rama_2dbinned.dat.check rama_2dbinned.dat > rama_2dbinned.dat.diff
 test_cleanup $? rama_2dbinned.dat.diff
 /bin/rm -f rama_2dbinned.dat
 
+../2Dbinning.py -f rama.2.dat.check -o rama_2dbinned.dat -s -j 2 \
+                -b 50x50 -n -c 1,2 -x "-176.0-180" > /dev/null
+
+printf "   Checking streamed 2D binning:    "
+diff -Nru rama_2dbinned.dat.check rama_2dbinned.dat > rama_2dbinned.dat.diff
+test_cleanup $? rama_2dbinned.dat.diff
+/bin/rm -f rama_2dbinned.dat
+
+# heatmap.py --stream must bin edge-aligned data the way numpy.histogram2d
+# does in its in-memory path
+printf "   Checking heatmap stream edges:   "
+python -c "import numpy
+d = numpy.loadtxt('heatmap_edges.dat')
+numpy.savetxt('tmp', numpy.histogram2d(d[:,1], d[:,0], bins=[250,250],
+              range=[[-10,15],[-10,15]])[0], '%d')"
+PYTHONPATH=..:$PYTHONPATH python -c "import numpy, binning
+h = binning.histogram_files(['heatmap_edges.dat'], [2, 1], [[-10,15],[-10,15]],
+                            [250, 250], max_fields=3, numpy_edges=True)
+numpy.savetxt('heatmap_edges.out', h.counts.reshape((250, 250)), '%d')"
+diff -Nru tmp heatmap_edges.out > heatmap_edges.diff
+test_cleanup $? heatmap_edges.diff
+/bin/rm -f heatmap_edges.out
+
 # mdcrd.py
 echo "============================================================"
 echo "Testing mdcrd.py"
@@ -99,6 +122,31 @@ printf "   Checking mdcrd.py log file:  "
 diff -Nru mdcrd_py.log.check mdcrd_py.log > mdcrd_py.log.diff
 test_cleanup $? mdcrd_py.log.diff
 /bin/rm -f AmberTraj_RMSD.dat mdcrd_py.log
+
+printf "   Checking one-shot frame counts: "
+PATH=`pwd`/cpptraj_stub:$PATH python ../mdcrd.py -p trpcage.nowat.parm7 -n \
+   trpcage.solv5.[1-2]_remd12.nc > tmp
+diff -Nru mdcrd_frames.out.check tmp > mdcrd_frames.out.diff
+test_cleanup $? mdcrd_frames.out.diff
+
+# Pooled sessions: frame counts, then two rmsd() calls with the same default
+# names (run in separate passes) the second of which hits a cpptraj error
+printf "   Checking pooled cpptraj runs:   "
+PATH=`pwd`/cpptraj_stub:$PATH PYTHONPATH=..:$PYTHONPATH python - > tmp << EOF
+import mdcrd
+pool = mdcrd.CpptrajPool()
+counts = pool.frame_counts('trpcage.nowat.parm7', ['trpcage.solv5.1_remd12.nc',
+                                                   'trpcage.solv5.2_remd12.nc'])
+print sorted(counts.items())
+trajs = [mdcrd.AmberTraj('trpcage.nowat.parm7', 'trpcage.solv5.1_remd12.nc',
+                         pool=pool) for i in range(2)]
+for traj in trajs: traj.rmsd()
+trajs[1]._cpptraj_commands += 'trajin missing.nc\\n'
+mdcrd.run_batch(trajs, pool)
+pool.close()
+EOF
+diff -Nru mdcrd_pool.out.check tmp > mdcrd_pool.out.diff
+test_cleanup $? mdcrd_pool.out.diff
 echo "============================================================"
 echo "Testing remd.py"
 python ../remd.py -l rem1.log -t TEMP -o tmp
@@ -111,6 +159,22 @@ python ../remd.py -l phrem.log -t pH -o tmp
 printf "   Checking pH-REM log analysis: "
 diff -Nru ph_remlog.stats.check tmp > ph_remlog.stats.diff
 test_cleanup $? ph_remlog.stats.diff
+
+python ../remd.py -l rem1.log -t TEMP -o tmp
+printf "   Checking cached T-REM log:    "
+diff -Nru temp_remlog.stats.check tmp > temp_remlog.stats.diff
+test_cleanup $? temp_remlog.stats.diff
+
+python ../remd.py -l phrem.log -t pH -o tmp
+printf "   Checking cached pH-REM log:   "
+diff -Nru ph_remlog.stats.check tmp > ph_remlog.stats.diff
+test_cleanup $? ph_remlog.stats.diff
+/bin/rm -f rem1.log.npz phrem.log.npz
+
+python ../remd_diagnostics.py -n -l rem1.log -t TEMP -o tmp
+printf "   Checking T-REM diagnostics:   "
+diff -Nru remd_diagnostics.check tmp > remd_diagnostics.diff
+test_cleanup $? remd_diagnostics.diff
 echo "============================================================"
 
 /bin/rm -f tmp
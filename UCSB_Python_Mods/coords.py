@@ -3,10 +3,11 @@
 #LAST MODIFIED: 10-29-08
 
 #DESCRIPTION: Provides reading and writing routines for popular
-#coordinate file formats.  Currently: pdb and amber trajectory.
+#coordinate file formats.  Currently: pdb, amber trajectory (ascii and
+#netcdf), and a binary frame cache (see SaveBinTrj).
 
 from numpy import *
-import copy, os, gzip, pdbtools
+import copy, os, gzip, struct, zlib, bisect, cPickle, hashlib, atexit, pdbtools
 
 #Masks for backbone atoms
 NoMask = []
@@ -16,6 +17,28 @@ BackboneMask = ["CA", "C", "N"]
 AlphaCarbonMask = ["CA"]
 Caps = ["NHE","NME","ACE"]
 
+#Binary frame cache format: a fixed-size header followed by
+#little-endian float32 coordinates in (nframes, natoms, 3) order
+BinTrjMagic = "CRDBIN01"
+BinTrjHeadFmt = "<8sii"
+BinTrjHeadLen = 32
+
+#Gzip seek index: uncompressed bytes between decompressor checkpoints,
+#compressed bytes fed per read, and the suffix of the sidecar index file
+GzipIndexSpan = 4 * 1024 * 1024
+GzipIndexChunk = 64 * 1024
+GzipIndexSuffix = ".gzidx"
+
+#Prmtop parse caches: number of topologies kept in memory, and the
+#directory of the on-disk cache (None, the default, disables it; set it
+#here or with the PRMTOP_CACHE_DIR environment variable)
+PrmtopCacheSize = 8
+PrmtopCacheDir = os.environ.get("PRMTOP_CACHE_DIR", None)
+
+#NetCDF (classic and 64-bit offset) header tags and external types
+NcDimension, NcVariable, NcAttribute = 10, 11, 12
+NcTypes = {1:">i1", 2:"S1", 3:">i2", 4:">i4", 5:">f4", 6:">f8"}
+
 
 def GetPdbSeq(PdbFile):
   "Gets the sequence from a PdbFile."
@@ -116,6 +139,52 @@ def ParseCrdString(s, AtomNames = [], Mask = NoMask):
     raise ValueError, "Improper number of coordinates found in Crd string."
 
 
+def ParseCrdBlock(s, NFrame, AtomNames = [], Mask = NoMask):
+  """Takes a text string of NFrame consecutive Crd coordinate sets, each
+with the same line layout, and parses them at once into an array of
+dimensions [NFrame,N,3]."""
+  if NFrame == 0:
+    return zeros((0, 0, 3), float)
+  Buf = frombuffer(s, dtype = uint8)
+  if not len(Buf) % NFrame == 0:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  Buf = Buf.reshape((NFrame, -1))
+  #drop the line ends, found from the layout of the first frame
+  Keep = flatnonzero(logical_and(Buf[0] != 10, Buf[0] != 13))
+  if not mod(len(Keep), 24) == 0:
+    raise ValueError, "Improper number of coordinates found in Crd string."
+  Fields = Buf.take(Keep, axis=1).reshape((-1, 8))
+  if all(Fields[:,4] == 46) and not any(_CrdBadChar.take(Fields)):
+    #standard %8.3f fields: convert the digits arithmetically
+    Pos = dot(_CrdDigit.take(Fields), _CrdPlace)
+    Pos[any(Fields == 45, axis=1)] *= -1.
+  else:
+    #anything else goes through the string conversion
+    try:
+      Pos = Fields.copy().view("S8").astype(float)
+    except ValueError:
+      raise ValueError, "Improper number of coordinates found in Crd string."
+  Pos = Pos.reshape((NFrame, -1, 3))
+  #if using mask remove the extraneous coordinates
+  if not Mask == NoMask:
+    if not len(AtomNames) == Pos.shape[1]:
+      raise ValueError, "Crd frames hold %d atoms but %d atom names " \
+                        "were given." % (Pos.shape[1], len(AtomNames))
+    Pos = Pos.take(GetMaskInd(AtomNames, Mask), axis=1)
+  return Pos
+
+#lookup tables for converting %8.3f crd fields in ParseCrdBlock
+_CrdDigit = zeros(256, float)
+_CrdDigit[48:58] = arange(10)
+_CrdBadChar = ones(256, bool)
+_CrdBadChar[[32, 43, 45, 46] + range(48, 58)] = False
+_CrdPlace = array([1000., 100., 10., 1., 0., 0.1, 0.01, 0.001])
+
+def GetMaskInd(AtomNames, Mask):
+  """Returns the indices of the atoms whose names pass Mask."""
+  return array([i for (i, a) in enumerate(AtomNames) if a.strip() in Mask], int)
+
+
 def ParseRstString(s, AtomNames = [], Mask = NoMask):
   """Takes a text string of Rst coordinates and parses into an array;
 Note that this will return velocities as well."""
@@ -136,24 +205,150 @@ Note that this will return velocities as well."""
     raise IOError, "Improper number of coordinates found in Rst file."
 
 
+class PrmtopClass:
+  """Provides lazy access to the %FLAG sections of a Prmtop file.
+The file is scanned once to record the byte range of each section, and a
+section is only parsed the first time it is requested.  If PrmtopCacheDir
+is set, parsed sections are also stored in an on-disk cache keyed by the
+path, size, and modification time of the Prmtop file.  Newly parsed
+sections are written by SaveCache(), once for however many were parsed;
+instances from GetPrmtop() are saved when they leave its cache and at
+exit.  Use GetPrmtop() to share instances within a process."""
+
+  def __init__(self, PrmtopFile, UseCacheFile = True):
+    """Scans the Prmtop file.
+* PrmtopFile: string name of prmtop file
+* UseCacheFile: True to read and write the on-disk cache, if
+  PrmtopCacheDir is set"""
+    if not os.path.isfile(PrmtopFile):
+      raise IOError, "Could not find Prmtop file."
+    self.PrmtopFile = PrmtopFile
+    st = os.stat(PrmtopFile)
+    self.Key = (os.path.abspath(PrmtopFile), st.st_size, int(st.st_mtime))
+    self.CacheFile = None
+    if UseCacheFile and not PrmtopCacheDir is None:
+      Name = hashlib.md5(self.Key[0]).hexdigest() + ".pkl"
+      self.CacheFile = os.path.join(PrmtopCacheDir, Name)
+    #section byte ranges, as (start of data, end of data)
+    self.Offsets = {}
+    #parsed sections, keyed by (flag name, block length)
+    self.Sections = {}
+    #whether sections were parsed since the cache was last written
+    self.Unsaved = False
+    if not self.__LoadCache():
+      self.__Scan()
+
+  def __Scan(self):
+    """Records the byte range of the data in each %FLAG section."""
+    f = open(self.PrmtopFile, "rb")
+    Pos = 0
+    Name, Skip = None, False
+    for line in f:
+      if Skip:
+        #skip the %FORMAT line
+        Skip = False
+        self.Offsets[Name] = [Pos + len(line), None]
+      elif line.startswith("%"):
+        if not Name is None and self.Offsets[Name][1] is None:
+          self.Offsets[Name][1] = Pos
+        if line.startswith("%FLAG"):
+          Name, Skip = line.split()[1], True
+          self.Offsets[Name] = [Pos + len(line), None]
+      Pos += len(line)
+    f.close()
+    if not Name is None and self.Offsets[Name][1] is None:
+      self.Offsets[Name][1] = Pos
+
+  def __LoadCache(self):
+    """Loads offsets and parsed sections from the on-disk cache."""
+    if self.CacheFile is None or not os.path.isfile(self.CacheFile):
+      return False
+    try:
+      Dat = cPickle.load(open(self.CacheFile, "rb"))
+    except Exception:
+      return False
+    if not type(Dat) is dict or not Dat.get("Key", None) == self.Key:
+      return False
+    self.Offsets, self.Sections = Dat["Offsets"], Dat["Sections"]
+    return True
+
+  def SaveCache(self):
+    """Writes offsets and parsed sections to the on-disk cache if any were
+parsed since it was last written, ignoring any failure to do so."""
+    if self.CacheFile is None or not self.Unsaved: return
+    self.Unsaved = False
+    try:
+      CacheDir = os.path.dirname(self.CacheFile)
+      if not os.path.isdir(CacheDir): os.makedirs(CacheDir)
+      Tmp = "%s.%d" % (self.CacheFile, os.getpid())
+      f = open(Tmp, "wb")
+      cPickle.dump({"Key":self.Key, "Offsets":self.Offsets,
+                    "Sections":self.Sections}, f, 2)
+      f.close()
+      os.rename(Tmp, self.CacheFile)
+    except (IOError, OSError):
+      pass
+
+  def Flags(self):
+    "Returns the names of the %FLAG sections."
+    return self.Offsets.keys()
+
+  def Get(self, Flag, BlockLen = None):
+    """Returns a list of the string fields for a %FLAG section, either split
+on whitespace or, if BlockLen is given, in fixed-width blocks.  Flag may be
+given as the name (e.g., ATOM_NAME) or as the full %FLAG ATOM_NAME line.
+Returns an empty list if there is no such section."""
+    if Flag.startswith("%FLAG"): Flag = Flag.split()[1]
+    k = (Flag, BlockLen)
+    if not k in self.Sections:
+      if not Flag in self.Offsets: return []
+      Start, End = self.Offsets[Flag]
+      f = open(self.PrmtopFile, "rb")
+      f.seek(Start)
+      s = f.read(End - Start)
+      f.close()
+      Dat = []
+      for line in s.splitlines():
+        if BlockLen is None:
+          Dat.extend(line.split())
+        else:
+          Dat.extend([line[i:i+BlockLen] for i in xrange(0,len(line),BlockLen)])
+      self.Sections[k] = Dat
+      self.Unsaved = True
+    return list(self.Sections[k])
+
+
+_PrmtopCache = []
+
+def GetPrmtop(PrmtopFile):
+  """Returns a PrmtopClass instance for a file, reusing a recently used one
+if the file has not changed."""
+  if not os.path.isfile(PrmtopFile):
+    raise IOError, "Could not find Prmtop file."
+  st = os.stat(PrmtopFile)
+  Key = (os.path.abspath(PrmtopFile), st.st_size, int(st.st_mtime))
+  for (i, p) in enumerate(_PrmtopCache):
+    if p.Key == Key:
+      #move to the front of the list
+      del _PrmtopCache[i]
+      _PrmtopCache.insert(0, p)
+      return p
+  p = PrmtopClass(PrmtopFile)
+  _PrmtopCache.insert(0, p)
+  for Old in _PrmtopCache[PrmtopCacheSize:]: Old.SaveCache()
+  del _PrmtopCache[PrmtopCacheSize:]
+  return p
+
+def _SavePrmtopCaches():
+  "Writes the on-disk caches of the instances kept by GetPrmtop."
+  for p in _PrmtopCache: p.SaveCache()
+
+atexit.register(_SavePrmtopCaches)
+
 def GetPrmtopBlock(PrmtopFile, Flag, BlockLen = None):
   "Gets Prmtop data for a specified Flag."
   if os.path.isfile(PrmtopFile):
-    f = open(PrmtopFile, "rU")
-    Dat = []
-    line = f.readline()
-    while len(line) > 0 and not line.startswith(Flag):
-      line = f.readline()
-    f.readline()
-    line = f.readline()
-    while len(line) > 0 and not line[0:1] == "%":
-      if BlockLen is None:
-        Dat.extend(line.split())
-      else:
-        Dat.extend([line[i:i+BlockLen] for i in xrange(0,len(line)-1,BlockLen)])
-      line = f.readline()
-    f.close()
-    return Dat
+    return GetPrmtop(PrmtopFile).Get(Flag, BlockLen)
   else:
     raise IOError, "Could not find Prmtop file."
     return None
@@ -329,6 +524,10 @@ def GetTrjLenOld(TrjFile, PrmtopFile):
 
 def GetTrjLen(TrjFile, PrmtopFile):
   "Gets the number of frames in a trajectory."
+  if IsBinTrj(TrjFile):
+    return GetBinTrjHead(TrjFile)[1]
+  if IsNetCDF(TrjFile):
+    return len(GetNetCDFTrj(TrjFile)[0])
   Names = GetPrmtopAtomNames(PrmtopFile)
   if Names is None: return 0
   NAtom = len(Names)
@@ -338,7 +537,7 @@ def GetTrjLen(TrjFile, PrmtopFile):
   if r > 0: NLine += 1
   #use gzip?
   if TrjFile.strip().lower().endswith("gz"):
-    FileMthd = gzip.GzipFile
+    FileMthd = GzipIndexFile
   else:
     FileMthd = file
   #open the trj file
@@ -353,26 +552,394 @@ def GetTrjLen(TrjFile, PrmtopFile):
   BytesCoords = 0
   for i in range(NLine):
     BytesCoords += len(Trj.readline())
-  #unfortunately for gzip files, we can't seek to end, so we need to
-  #do this bit to get the total size:
-  Trj.seek(0)
-  BytesTot = 0
-  #try to catch errors in the gzipped file; stride 1024 bytes
-  try:
-    while len(Trj.read(1024)) > 0: pass
-  except IOError:
-    #find the exact byte number
-    try:
-      while len(Trj.read(1)) > 0: pass
-    except IOError:
-      pass
-  BytesTot = max(Trj.tell(), 0)
+  if FileMthd is GzipIndexFile:
+    #the size comes from the sidecar index, or one pass that writes it
+    BytesTot = Trj.Size()
+  else:
+    BytesTot = os.path.getsize(TrjFile)
   #return the total number of configs
   Trj.close()
   del Trj
   return int((BytesTot - BytesHead) / BytesCoords)
 
 
+#======== BINARY FRAME CACHE ========
+
+def IsBinTrj(TrjFile):
+  "Returns True if TrjFile is a binary frame cache."
+  if not os.path.isfile(TrjFile): return False
+  f = open(TrjFile, "rb")
+  s = f.read(len(BinTrjMagic))
+  f.close()
+  return s == BinTrjMagic
+
+def GetBinTrjHead(BinFile):
+  "Returns (NAtom, NFrame) from the header of a binary frame cache."
+  f = open(BinFile, "rb")
+  s = f.read(BinTrjHeadLen)
+  f.close()
+  if len(s) < BinTrjHeadLen:
+    raise IOError, "Binary trajectory %s has a truncated header." % BinFile
+  Magic, NAtom, NFrame = struct.unpack(BinTrjHeadFmt, s[:struct.calcsize(BinTrjHeadFmt)])
+  if not Magic == BinTrjMagic:
+    raise IOError, "%s is not a binary trajectory file." % BinFile
+  #guard against a writer that did not finish
+  if NAtom > 0:
+    NFrameDisk = (os.path.getsize(BinFile) - BinTrjHeadLen) / (12 * NAtom)
+    NFrame = min(NFrame, NFrameDisk)
+  return NAtom, NFrame
+
+def GetBinTrj(BinFile, Mode = "r"):
+  """Returns a memory-mapped (NFrame, NAtom, 3) float32 array of the frames
+in a binary frame cache.  Use Mode = "r+" to modify the frames in place."""
+  NAtom, NFrame = GetBinTrjHead(BinFile)
+  if NFrame == 0:
+    return zeros((0, NAtom, 3), float32)
+  return memmap(BinFile, dtype = "<f4", mode = Mode, offset = BinTrjHeadLen,
+                shape = (NFrame, NAtom, 3))
+
+def SaveBinTrj(CoordsObj, BinFile):
+  """Saves all configurations of a coordinate object (TrjClass, PdbListClass,
+or MultiCoordClass) to a binary frame cache, honoring any skip/stride/read
+settings of the object but ignoring its mask.  Returns the number of frames."""
+  NAtom = len(CoordsObj.AtomNames)
+  f = open(BinFile, "wb")
+  #write a zero frame count first so that a partial file is never trusted
+  f.write(struct.pack(BinTrjHeadFmt, BinTrjMagic, NAtom, 0).ljust(BinTrjHeadLen, "\0"))
+  NFrame = 0
+  for i in xrange(len(CoordsObj)):
+    Pos = CoordsObj.Get(i, NoMask)
+    if not Pos.shape == (NAtom, 3):
+      f.close()
+      raise ValueError, "Configuration %d has the wrong number of atoms." % i
+    f.write(asarray(Pos, "<f4").tostring())
+    NFrame += 1
+  f.seek(0)
+  f.write(struct.pack(BinTrjHeadFmt, BinTrjMagic, NAtom, NFrame))
+  f.close()
+  if hasattr(CoordsObj, "Close"): CoordsObj.Close()
+  return NFrame
+
+def CrdToBin(TrjFile, PrmtopFile, BinFile, NSkip = 0, NRead = None, NStride = 1):
+  """Converts an (optionally gzipped) amber trajectory to a binary frame cache,
+which can then be opened with TrjClass in place of the original trajectory."""
+  Trj = TrjClass(TrjFile, PrmtopFile, NSkip = NSkip, NRead = NRead,
+                 NStride = NStride)
+  return SaveBinTrj(Trj, BinFile)
+
+
+#======== NETCDF TRAJECTORIES ========
+
+def IsNetCDF(TrjFile):
+  "Returns True if TrjFile is a NetCDF (version 3) file."
+  if not os.path.isfile(TrjFile): return False
+  f = open(TrjFile, "rb")
+  s = f.read(4)
+  f.close()
+  return s in ["CDF\x01", "CDF\x02"]
+
+def ReadNetCDFHeader(NcFile):
+  """Reads the header of a NetCDF classic or 64-bit offset file.
+Returns a dictionary with keys:
+* Dims: list of (name, length) with length None for the record dimension
+* NumRecs: number of records (None if streaming)
+* Attrs: dictionary of global attributes
+* Vars: dictionary of name to a dictionary with keys Dims (list of dimension
+  names), Attrs, Type (numpy dtype string), VSize, Begin, and IsRec
+* RecSize: number of bytes per record"""
+  f = open(NcFile, "rb")
+  s = f.read(4)
+  if not s in ["CDF\x01", "CDF\x02"]:
+    f.close()
+    raise IOError, "%s is not a NetCDF file." % NcFile
+  OffsetFmt = {"\x01":">i", "\x02":">q"}[s[3]]
+  #read the header in chunks as needed
+  Buf = [f.read(65536), 0]
+  def Get(n):
+    while len(Buf[0]) - Buf[1] < n:
+      More = f.read(65536)
+      if len(More) == 0:
+        raise IOError, "Truncated NetCDF header in %s." % NcFile
+      Buf[0] = Buf[0][Buf[1]:] + More
+      Buf[1] = 0
+    x = Buf[0][Buf[1]:Buf[1]+n]
+    Buf[1] += n
+    return x
+  def GetInt():
+    return struct.unpack(">i", Get(4))[0]
+  def GetName():
+    n = GetInt()
+    return Get(n + (-n % 4))[:n]
+  def GetValues():
+    t, n = GetInt(), GetInt()
+    nb = n * int(NcTypes[t][-1])
+    x = Get(nb + (-nb % 4))[:nb]
+    if t == 2: return x.rstrip("\0")
+    v = fromstring(x, NcTypes[t])
+    if len(v) == 1: return v[0]
+    return v
+  def GetList(Tag):
+    t, n = GetInt(), GetInt()
+    if t == 0 and n == 0: return 0
+    if not t == Tag:
+      raise IOError, "Malformed NetCDF header in %s." % NcFile
+    return n
+  def GetAttrs():
+    return dict([(GetName(), GetValues()) for i in range(GetList(NcAttribute))])
+  Head = {}
+  NumRecs = struct.unpack(">I", Get(4))[0]
+  if NumRecs == 0xFFFFFFFF: NumRecs = None
+  Head["NumRecs"] = NumRecs
+  Head["Dims"] = []
+  for i in range(GetList(NcDimension)):
+    Name, Len = GetName(), GetInt()
+    if Len == 0: Len = None
+    Head["Dims"].append((Name, Len))
+  Head["Attrs"] = GetAttrs()
+  Head["Vars"] = {}
+  RecVars = []
+  for i in range(GetList(NcVariable)):
+    Name = GetName()
+    DimIds = [GetInt() for j in range(GetInt())]
+    Var = {"Dims":[Head["Dims"][j][0] for j in DimIds]}
+    Var["Attrs"] = GetAttrs()
+    Var["Type"] = NcTypes[GetInt()]
+    Var["VSize"] = GetInt()
+    Var["Begin"] = struct.unpack(OffsetFmt, Get(struct.calcsize(OffsetFmt)))[0]
+    Var["Shape"] = [Head["Dims"][j][1] for j in DimIds]
+    Var["IsRec"] = len(DimIds) > 0 and Head["Dims"][DimIds[0]][1] is None
+    if Var["IsRec"]: RecVars.append(Var)
+    Head["Vars"][Name] = Var
+  f.close()
+  #a lone record variable is stored without padding
+  if len(RecVars) == 1:
+    v = RecVars[0]
+    Head["RecSize"] = int(product(v["Shape"][1:])) * int(v["Type"][-1])
+  else:
+    Head["RecSize"] = sum([v["VSize"] for v in RecVars])
+  return Head
+
+def GetNetCDFTrj(NcFile):
+  """Returns a memory-mapped (NFrame, NAtom, 3) array of the coordinates in
+an AMBER-convention NetCDF trajectory, along with the header dictionary from
+ReadNetCDFHeader.  The array is big-endian and read-only."""
+  Head = ReadNetCDFHeader(NcFile)
+  if not "coordinates" in Head["Vars"]:
+    raise IOError, "No coordinates found in NetCDF file %s." % NcFile
+  Var = Head["Vars"]["coordinates"]
+  if not Var["IsRec"] or not len(Var["Shape"]) == 3:
+    raise IOError, "Coordinates in %s are not (frame, atom, spatial)." % NcFile
+  NAtom, NDim = Var["Shape"][1:]
+  ItemSize = int(Var["Type"][-1])
+  FrameSize = NAtom * NDim * ItemSize
+  #count the complete frames actually on disk
+  Size = os.path.getsize(NcFile)
+  NFrame = 0
+  if Size >= Var["Begin"] + FrameSize:
+    NFrame = (Size - Var["Begin"] - FrameSize) / Head["RecSize"] + 1
+  if not Head["NumRecs"] is None:
+    NFrame = min(NFrame, Head["NumRecs"])
+  if NFrame == 0:
+    return zeros((0, NAtom, NDim), Var["Type"]), Head
+  Map = memmap(NcFile, dtype = uint8, mode = "r")
+  Frames = ndarray(shape = (NFrame, NAtom, NDim), dtype = Var["Type"],
+                   buffer = Map, offset = Var["Begin"],
+                   strides = (Head["RecSize"], NDim * ItemSize, ItemSize))
+  Scale = Var["Attrs"].get("scale_factor", None)
+  if not Scale is None and not Scale == 1.:
+    Frames = Frames * Scale
+  return Frames, Head
+
+
+#======== GZIP SEEK INDEX ========
+
+class GzipIndexFile:
+  """Provides a read-only, seekable file object for gzipped files.
+Decompressor checkpoints are taken every Span uncompressed bytes as the
+file is read, so a seek only decompresses from the nearest checkpoint at
+or before the target instead of from the start of the stream.  The
+uncompressed size is stored in a sidecar index file (FileName + .gzidx,
+keyed by the size and modification time of the gzipped file) so that it
+is only ever found by decompressing once."""
+
+  def __init__(self, FileName, Mode = "r", Span = GzipIndexSpan,
+               UseIndexFile = True):
+    """Opens the gzipped file for reading.
+* FileName: string name of gzipped file
+* Mode: must be a read mode
+* Span: uncompressed bytes between decompressor checkpoints
+* UseIndexFile: True to read and write the sidecar index file"""
+    if "w" in Mode or "a" in Mode or "+" in Mode:
+      raise IOError, "GzipIndexFile is read-only."
+    self.name = FileName
+    self.Span = max(int(Span), GzipIndexChunk)
+    self.UseIndexFile = UseIndexFile
+    self.IndexFile = FileName + GzipIndexSuffix
+    self.__Cmp = open(FileName, "rb")
+    st = os.fstat(self.__Cmp.fileno())
+    self.__Key = (st.st_size, int(st.st_mtime))
+    #extra values stored with the index (e.g., frame layout)
+    self.Info = {}
+    self.__USize = None
+    if self.UseIndexFile: self.__LoadIndex()
+    #checkpoints are (uncompressed pos, compressed pos, decompressor)
+    self.__Checkpoints = [(0, 0, self.__NewDecomp())]
+    self.__CheckPos = [0]
+    self.__Pos = 0
+    self.__Restart(0)
+
+  def __NewDecomp(self):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+  def __LoadIndex(self):
+    """Reads the sidecar index if it matches the gzipped file."""
+    if not os.path.isfile(self.IndexFile): return
+    try:
+      Dat = dict([l.split(None, 1) for l in open(self.IndexFile, "r")
+                  if len(l.split()) >= 2])
+      if not Dat.get("GZIDX", "").strip() == "1": return
+      if not (int(Dat["size"]), int(Dat["mtime"])) == self.__Key: return
+      self.__USize = int(Dat["usize"])
+      for (k, v) in Dat.items():
+        if not k in ["GZIDX", "size", "mtime", "usize"]:
+          self.Info[k] = int(v)
+    except (IOError, KeyError, ValueError):
+      self.__USize = None
+      self.Info = {}
+
+  def SaveIndex(self, **Info):
+    """Writes the sidecar index, adding any integer values in Info.
+Failures to write (e.g., a read-only directory) are ignored."""
+    self.Info.update(Info)
+    if not self.UseIndexFile: return
+    USize = self.Size()
+    s = "GZIDX 1\nsize %d\nmtime %d\nusize %d\n" % (self.__Key + (USize,))
+    s += "".join(["%s %d\n" % (k, v) for (k, v) in sorted(self.Info.items())])
+    try:
+      file(self.IndexFile, "w").write(s)
+    except IOError:
+      pass
+
+  def __Restart(self, Pos):
+    """Moves the decompressor to the last checkpoint at or before Pos."""
+    i = bisect.bisect_right(self.__CheckPos, Pos) - 1
+    UPos, CPos, D = self.__Checkpoints[i]
+    self.__D = D.copy()
+    self.__CPos = CPos
+    self.__BufStart = UPos
+    self.__Buf = ""
+    self.__EOF = False
+
+  def __Advance(self):
+    """Decompresses the next chunk onto the buffer; returns False at the end."""
+    if self.__EOF: return False
+    self.__Cmp.seek(self.__CPos)
+    Chunk = self.__Cmp.read(GzipIndexChunk)
+    self.__CPos += len(Chunk)
+    Out = []
+    try:
+      if len(Chunk) == 0:
+        Out.append(self.__D.flush())
+        self.__EOF = True
+      else:
+        Out.append(self.__D.decompress(Chunk))
+        #concatenated gzip members
+        while len(self.__D.unused_data) > 0:
+          Rest = self.__D.unused_data
+          self.__D = self.__NewDecomp()
+          Out.append(self.__D.decompress(Rest))
+    except zlib.error:
+      #treat a corrupt or truncated tail as the end of the file
+      self.__EOF = True
+    self.__Buf = self.__Buf + "".join(Out)
+    UEnd = self.__BufStart + len(self.__Buf)
+    if self.__EOF:
+      if self.__USize is None:
+        self.__USize = UEnd
+        if self.UseIndexFile: self.SaveIndex()
+    elif UEnd >= self.__CheckPos[-1] + self.Span:
+      #we're at the frontier of what has been decompressed
+      self.__Checkpoints.append((UEnd, self.__CPos, self.__D.copy()))
+      self.__CheckPos.append(UEnd)
+    return True
+
+  def __Fill(self, n):
+    """Makes sure the buffer holds n bytes starting at the current position."""
+    Pos = self.__Pos
+    #go back to a checkpoint if we're behind the buffer, or jump ahead
+    #if there's a checkpoint past the end of the buffer
+    if Pos < self.__BufStart or \
+       self.__CheckPos[bisect.bisect_right(self.__CheckPos, Pos) - 1] \
+       > self.__BufStart + len(self.__Buf):
+      self.__Restart(Pos)
+    while self.__BufStart + len(self.__Buf) < Pos + n:
+      #throw away what we've already passed to keep the buffer small
+      Drop = min(Pos - self.__BufStart, len(self.__Buf))
+      if Drop > 0:
+        self.__Buf = self.__Buf[Drop:]
+        self.__BufStart += Drop
+      if not self.__Advance(): break
+
+  def read(self, n = -1):
+    "Reads n bytes, or to the end of the file if n is negative."
+    if n < 0: n = self.Size() - self.__Pos
+    self.__Fill(n)
+    i = self.__Pos - self.__BufStart
+    s = self.__Buf[i:i+n]
+    self.__Pos += len(s)
+    return s
+
+  def readline(self):
+    "Reads one line."
+    l = []
+    while True:
+      self.__Fill(1)
+      i = self.__Pos - self.__BufStart
+      j = self.__Buf.find("\n", i)
+      if j >= 0:
+        s = self.__Buf[i:j+1]
+      else:
+        s = self.__Buf[i:]
+      self.__Pos += len(s)
+      l.append(s)
+      if j >= 0 or len(s) == 0: break
+    return "".join(l)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    s = self.readline()
+    if len(s) == 0: raise StopIteration
+    return s
+
+  def seek(self, Offset, Whence = 0):
+    "Moves to a position in the uncompressed data."
+    if Whence == 1:
+      Offset += self.__Pos
+    elif Whence == 2:
+      Offset += self.Size()
+    self.__Pos = max(Offset, 0)
+
+  def tell(self):
+    return self.__Pos
+
+  def Size(self):
+    "Returns the number of uncompressed bytes."
+    #run to the end, taking checkpoints on the way
+    while self.__USize is None:
+      self.__BufStart += len(self.__Buf)
+      self.__Buf = ""
+      if not self.__Advance(): break
+    return self.__USize
+
+  def close(self):
+    if self.__Cmp is not None:
+      self.__Cmp.close()
+      self.__Cmp = None
+    self.__Checkpoints, self.__CheckPos = [], []
+
+
 class TrjClass:
   "Provides a class for reading successive sets of coordinates from Amber trajectory files."
   
@@ -380,7 +947,8 @@ class TrjClass:
                NSkip = 0, NRead = None, NStride = 1,
                LinkPos = None):
     """Initializes the class and opens the trajectory file for reading.
-* TrjFile: string name of trj file
+* TrjFile: string name of trj file (ascii, gzipped ascii, netcdf, or
+  binary cache)
 * PrmtopFile: string name of prmtop file
 * Mask: list of strings; filter for atom names (default is no mask/empty list)
 * NSkip: number of configurations to skip
@@ -434,7 +1002,13 @@ class TrjClass:
 
   def __Open(self):
     """Opens the trajectory file for reading"""
-    if self.__Trj is None:
+    if self.Binary:
+      if self.__Frames is None:
+        self.__Frames = GetBinTrj(self.TrjFile)
+    elif self.NetCDF:
+      if self.__Frames is None:
+        self.__Frames = GetNetCDFTrj(self.TrjFile)[0]
+    elif self.__Trj is None:
       try:
         self.__Trj = self.__FileMthd(self.TrjFile, "r")
       except IOError:
@@ -445,6 +1019,7 @@ class TrjClass:
     if self.__Trj is not None:
       self.__Trj.close()
       self.__Trj = None
+    self.__Frames = None
 
   def __Init(self):
     """Initializes internal variables from disk data."""
@@ -458,16 +1033,22 @@ class TrjClass:
     self.AtomRes = GetPrmtopAtomRes(self.PrmtopFile)
     self.Seq = GetPrmtopSeq(self.PrmtopFile)
     #set the file method
+    self.Binary = IsBinTrj(self.TrjFile)
+    self.NetCDF = IsNetCDF(self.TrjFile)
     if self.TrjFile.split(".")[-1].strip().lower() == "gz":
-      self.__FileMthd = gzip.GzipFile
+      self.__FileMthd = GzipIndexFile
       self.Gzip = True
     else:
       self.__FileMthd = open
       self.Gzip = False
     self.__Trj = None
+    self.__Frames = None
     #count and reset
-    self.__Open()
-    self.__CountBytes()
+    if self.Binary or self.NetCDF:
+      self.__CountFrames()
+    else:
+      self.__Open()
+      self.__CountBytes()
     self.Reset()
     #get an initial set of positions
     if len(self) > 0:
@@ -494,14 +1075,11 @@ class TrjClass:
     for i in range(0, self.__NLine):
       self.BytesCoords += len(self.__Trj.readline())
     if self.Gzip:
-      #unfortunately for gzip files, we need to do this bit to get the total size:
-      self.__Trj.seek(0)
-      self.BytesTot = 0
-      Incr = os.path.getsize(self.TrjFile)
-      while self.BytesTot == self.__Trj.tell():
-        self.BytesTot += Incr
-        self.__Trj.seek(self.BytesTot)
-      self.BytesTot = max(self.__Trj.tell(), 0)
+      #the size comes from the sidecar index, or one pass that writes it
+      self.BytesTot = self.__Trj.Size()
+      if not self.__Trj.Info.get("frame", -1) == self.BytesCoords:
+        self.__Trj.SaveIndex(head = self.BytesHead, frame = self.BytesCoords,
+          frames = int((self.BytesTot - self.BytesHead) / self.BytesCoords))
     else:
       self.BytesTot = os.path.getsize(self.TrjFile)
     if 1==2: 
@@ -528,6 +1106,26 @@ class TrjClass:
     else:
       self.SliceNCoords = min(self.NRead, self.SliceNCoords)
 
+  def __CountFrames(self):
+    """Gets the number of configurations from a binary cache or netcdf header."""
+    if self.Binary:
+      NAtom, self.NCoords = GetBinTrjHead(self.TrjFile)
+    else:
+      self.__Open()
+      self.NCoords, NAtom = self.__Frames.shape[:2]
+      self.Close()
+    if not NAtom == self.NAtom:
+      raise IOError, "Trajectory has %d atoms but prmtop has %d." % (NAtom, self.NAtom)
+    self.NSkip = min(self.NSkip, self.NCoords)
+    a = self.NCoords - self.NSkip
+    self.SliceNCoords = a / self.NStride
+    if a % self.NStride > 0: self.SliceNCoords += 1
+    #set the limit of how many to read in
+    if self.NRead is None:
+      self.NRead = self.SliceNCoords
+    else:
+      self.SliceNCoords = min(self.NRead, self.SliceNCoords)
+
   def Get(self, ind, Mask = None):
     if Mask is None: Mask = self.Mask
     #this index is relative to the sliced version
@@ -543,6 +1141,15 @@ class TrjClass:
       #calculate the absolute index
       self.SliceIndex = ind
       self.Index = self.NSkip + self.NStride * ind
+      if self.Binary or self.NetCDF:
+        #binary frames come straight out of the memory map, without a copy
+        #unless a mask is used; netcdf frames are converted from big-endian
+        self.Pos = self.__Frames[self.Index]
+        if self.NetCDF: self.Pos = self.Pos.astype(float)
+        if not Mask == NoMask:
+          self.Pos = compress([a.strip() in Mask for a in self.AtomNames], self.Pos, 0)
+        if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
+        return self.Pos
       #seek to the right position
       self.__Trj.seek(self.BytesHead + self.BytesCoords*self.Index)
       #read the data
@@ -557,6 +1164,64 @@ class TrjClass:
       if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
       return self.Pos
 
+  def GetBlock(self, start, nframes, Mask = None):
+    """Returns an array of dimensions [n,N,3] for up to nframes configurations
+starting at start, relative to the sliced version.  The frames are read in
+one pass and parsed together, and the current configuration is moved to the
+last one read."""
+    if Mask is None: Mask = self.Mask
+    #check for reverse notation
+    if start < 0:
+      start += self.SliceNCoords
+    if start < 0 or start >= self.SliceNCoords:
+      raise IndexError, "Index out of bounds for trj class."
+    n = max(min(nframes, self.SliceNCoords - start), 0)
+    if n == 0:
+      if Mask == NoMask:
+        return zeros((0, len(self.AtomNames), 3), float)
+      return zeros((0, len(GetMaskInd(self.AtomNames, Mask)), 3), float)
+    #make sure we're open
+    self.__Open()
+    #calculate the absolute indices
+    First = self.NSkip + self.NStride * start
+    Last = First + self.NStride * (n - 1)
+    if self.Binary or self.NetCDF:
+      Pos = self.__Frames[First:Last+1:self.NStride]
+      if self.NetCDF: Pos = Pos.astype(float)
+      if not Mask == NoMask:
+        Pos = Pos.take(GetMaskInd(self.AtomNames, Mask), axis=1)
+    else:
+      if self.NStride == 1:
+        #the frames are contiguous, so grab them all with one read
+        self.__Trj.seek(self.BytesHead + self.BytesCoords*First)
+        s = self.__Trj.read(self.BytesCoords*n)
+      else:
+        l = []
+        for i in xrange(First, Last + 1, self.NStride):
+          self.__Trj.seek(self.BytesHead + self.BytesCoords*i)
+          l.append(self.__Trj.read(self.BytesCoords))
+        s = "".join(l)
+      #check to see if we ran out of coordinates
+      if len(s) < self.BytesCoords*n:
+        raise IOError, "Ran out of coordinates in %s." % self.TrjFile
+      Pos = ParseCrdBlock(s, n, self.AtomNames, Mask)
+    #update the current configuration
+    self.SliceIndex = start + n - 1
+    self.Index = Last
+    self.Pos = Pos[-1]
+    if not self.LinkPos is None: self.LinkPos[:,:] = self.Pos
+    return Pos
+
+  def IterBlocks(self, blocksize = 1000, Mask = None):
+    """Iterates over the trajectory, returning arrays of dimensions [n,N,3]
+with up to blocksize configurations each."""
+    self.Reset()
+    for start in xrange(0, self.SliceNCoords, max(blocksize, 1)):
+      Pos = self.GetBlock(start, blocksize, Mask)
+      self.Count += len(Pos)
+      yield Pos
+    self.Reset()
+
   def __getitem__(self, ind):
     return self.Get(ind)
 
@@ -153,6 +153,90 @@ Returns Vec, Ang such that Vec1 = dot(Vec2, RotMat(Vec, Ang))"""
         return Vec, Ang * DegPerRad
 
 
+#======== NEIGHBOR SEARCH ========
+
+#offsets to a cell and all of its neighboring cells
+CellOffsets = array([(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)], int)
+
+class CellListClass:
+  """Spatial hashing of positions into cubic cells, for finding all
+neighbors within a cutoff in time linear in the number of positions.
+* Pos: array of dimensions [N,3] of positions
+* CellSize: width of the cells; neighbors are found up to this distance"""
+
+  def __init__(self, Pos, CellSize):
+    self.Pos = asarray(Pos, float)
+    self.CellSize = float(CellSize)
+    if not self.CellSize > 0.:
+      raise ValueError, "Cell size must be positive."
+    self.Min = self.Pos.min(axis=0)
+    Cells = floor((self.Pos - self.Min) / self.CellSize).astype(int)
+    self.NCell = Cells.max(axis=0) + 1
+    Keys = self.__Key(Cells)
+    #positions sorted by cell and the start of each cell in that order
+    self.Order = argsort(Keys, kind = "mergesort")
+    self.SortedKeys = Keys[self.Order]
+    self.Cells = Cells
+
+  def __Key(self, Cells):
+    "Linear cell index, or -1 for cells outside the grid."
+    Out = logical_or(Cells < 0, Cells >= self.NCell).any(axis=-1)
+    Keys = (Cells[...,0] * self.NCell[1] + Cells[...,1]) * self.NCell[2] + Cells[...,2]
+    Keys[Out] = -1
+    return Keys
+
+  def __Candidates(self, Cells):
+    """For an array of [n,3] cells, returns index arrays (i, j) such that
+position self.Pos[j] is in a cell neighboring Cells[i]."""
+    I, J = [], []
+    for Offset in CellOffsets:
+      Keys = self.__Key(Cells + Offset)
+      Start = searchsorted(self.SortedKeys, Keys, side = "left")
+      Stop = searchsorted(self.SortedKeys, Keys, side = "right")
+      Stop[Keys < 0] = Start[Keys < 0]
+      Count = Stop - Start
+      n = Count.sum()
+      if n == 0: continue
+      i = repeat(arange(len(Cells)), Count)
+      #position within each run of candidates
+      First = cumsum(Count) - Count
+      j = arange(n) - repeat(First, Count) + repeat(Start, Count)
+      I.append(i)
+      J.append(self.Order[j])
+    if len(I) == 0:
+      return zeros(0, int), zeros(0, int)
+    return concatenate(I), concatenate(J)
+
+  def Pairs(self, Cutoff = None):
+    """Returns arrays (i, j, d) of all pairs i < j of positions within Cutoff
+(default and maximum is the cell size) of each other, sorted by i, and
+their distances d."""
+    if Cutoff is None: Cutoff = self.CellSize
+    if Cutoff > self.CellSize:
+      raise ValueError, "Cutoff is larger than the cell size."
+    i, j = self.__Candidates(self.Cells)
+    Mask = i < j
+    i, j = i[Mask], j[Mask]
+    d = self.Pos[j] - self.Pos[i]
+    d = sqrt((d*d).sum(axis=1))
+    Mask = d < Cutoff
+    i, j, d = i[Mask], j[Mask], d[Mask]
+    Sort = lexsort((j, i))
+    return i[Sort], j[Sort], d[Sort]
+
+  def Neighbors(self, Point, Cutoff = None):
+    """Returns the indices of all positions within Cutoff (default and
+maximum is the cell size) of Point."""
+    if Cutoff is None: Cutoff = self.CellSize
+    if Cutoff > self.CellSize:
+      raise ValueError, "Cutoff is larger than the cell size."
+    Point = asarray(Point, float)
+    Cell = floor((Point - self.Min) / self.CellSize).astype(int)
+    i, j = self.__Candidates(Cell[newaxis,:])
+    d = self.Pos[j] - Point
+    return sort(j[(d*d).sum(axis=1) < Cutoff*Cutoff])
+
+
 #======== SPHERE ROUTINES =======
 
 def SpherePoints(NPoints):
@@ -181,18 +265,30 @@ Returns an array of the surface area per sphere."""
   if USELIB:
     return geometrylib.spheresurfaceareas(Pos, Radii, Points)
   else:
+    Pos, Radii = asarray(Pos, float), asarray(Radii, float)
     Areas = zeros_like(Radii)
-    for (i,iPos) in enumerate(Pos):
-      ThisPoints = Points * Radii[i] + iPos
-      AreaPerPoint = 4.*pi*Radii[i]**2 / float(NPoints)
-      Exposed = ones(NPoints, int)
-      for (j,jPos) in enumerate(Pos):
-        if i == j: continue
-        if all(Exposed == 0): break
-        if sum((iPos - jPos)**2) > (Radii[i] + Radii[j])**2: continue
-        DistSq = sum((ThisPoints - jPos)**2, axis=1)
-        Exposed[DistSq < Radii[j]**2] = 0
-      Areas[i] = AreaPerPoint * sum(Exposed)
+    if len(Pos) == 0: return Areas
+    #find overlapping spheres using cells of the largest possible overlap
+    CellSize = max(2. * Radii.max(), 1.e-8)
+    i, j, d = CellListClass(Pos, CellSize).Pairs()
+    Mask = d < Radii[i] + Radii[j]
+    i, j = i[Mask], j[Mask]
+    #neighbor list in both directions, grouped by sphere
+    I, J = concatenate((i, j)), concatenate((j, i))
+    Sort = argsort(I, kind = "mergesort")
+    I, J = I[Sort], J[Sort]
+    Start = searchsorted(I, arange(len(Pos)), side = "left")
+    Stop = searchsorted(I, arange(len(Pos)), side = "right")
+    for (k,kPos) in enumerate(Pos):
+      ThisPoints = Points * Radii[k] + kPos
+      AreaPerPoint = 4.*pi*Radii[k]**2 / float(NPoints)
+      Nbr = J[Start[k]:Stop[k]]
+      if len(Nbr) == 0:
+        Areas[k] = AreaPerPoint * NPoints
+        continue
+      DistSq = ((ThisPoints[:,newaxis,:] - Pos[Nbr][newaxis,:,:])**2).sum(axis=2)
+      Buried = (DistSq < Radii[Nbr]**2).any(axis=1)
+      Areas[k] = AreaPerPoint * (NPoints - Buried.sum())
     return Areas
 
 def SphereVolumes(Pos, Radii, dx = 1.0):
@@ -444,6 +540,86 @@ dot(Pos2 + Pos2Vec, RotMat)."""
   Residuals = max(E0 - 2. * sum(S), 0.)
   return sqrt(Residuals / d1)
 
+def QCPRMSD(Pos, RefPos, Weights = None, Center = True, RetRotMat = False,
+            MaxIter = 50, Tol = 1.e-11):
+  """Returns the matrix of minimum RMSD values between each configuration in
+Pos, of dimensions [n,N,3], and each in RefPos, of dimensions [k,N,3], using
+the quaternion characteristic polynomial (QCP) method for all pairs at once.
+Weights gives optional per-position weights.  If RetRotMat is True, also
+returns the translation vectors PosVec [n,3] and RefVec [k,3] and rotation
+matrices RotMat [n,k,3,3], such that RefPos[j] + RefVec[j] is aligned to
+dot(Pos[i] + PosVec[i], RotMat[i,j])."""
+  Pos = asarray(Pos, float)
+  RefPos = asarray(RefPos, float)
+  if Pos.ndim == 2: Pos = Pos[newaxis]
+  if RefPos.ndim == 2: RefPos = RefPos[newaxis]
+  n, k, N = len(Pos), len(RefPos), Pos.shape[1]
+  if Weights is None:
+    w = ones(N, float)
+  else:
+    w = asarray(Weights, float)
+  W = w.sum()
+  #get centers
+  if Center:
+    PosVec = -dot(w, Pos) / W
+    RefVec = -dot(w, RefPos) / W
+    p = Pos + PosVec[:,newaxis,:]
+    r = RefPos + RefVec[:,newaxis,:]
+  else:
+    PosVec, RefVec = zeros((n,3), float), zeros((k,3), float)
+    p, r = Pos, RefPos
+  pw = p * w[newaxis,:,newaxis]
+  #calculate E0 and the inner product matrices
+  E0 = 0.5 * (einsum("nai,nai->n", pw, p)[:,newaxis] +
+              einsum("kai,kai->k", r * w[newaxis,:,newaxis], r)[newaxis,:])
+  A = einsum("nai,kaj->nkij", pw, r)
+  #build the symmetric, traceless key matrix for every pair
+  Sxx, Sxy, Sxz = A[...,0,0], A[...,0,1], A[...,0,2]
+  Syx, Syy, Syz = A[...,1,0], A[...,1,1], A[...,1,2]
+  Szx, Szy, Szz = A[...,2,0], A[...,2,1], A[...,2,2]
+  K = empty((n, k, 4, 4), float)
+  K[...,0,0] = Sxx + Syy + Szz
+  K[...,1,1] = Sxx - Syy - Szz
+  K[...,2,2] = -Sxx + Syy - Szz
+  K[...,3,3] = -Sxx - Syy + Szz
+  K[...,0,1] = K[...,1,0] = Syz - Szy
+  K[...,0,2] = K[...,2,0] = Szx - Sxz
+  K[...,0,3] = K[...,3,0] = Sxy - Syx
+  K[...,1,2] = K[...,2,1] = Sxy + Syx
+  K[...,1,3] = K[...,3,1] = Szx + Sxz
+  K[...,2,3] = K[...,3,2] = Syz + Szy
+  #characteristic polynomial x^4 + c2 x^2 + c1 x + c0 of a traceless matrix
+  K2 = einsum("...ij,...jk->...ik", K, K)
+  c2 = -0.5 * einsum("...ii->...", K2)
+  c1 = -einsum("...ij,...ji->...", K2, K) / 3.
+  c0 = linalg.det(K)
+  #Newton iterations for the largest root, starting from E0
+  Lambda = E0.copy()
+  for i in range(MaxIter):
+    L2 = Lambda * Lambda
+    P = (L2 + c2) * L2 + c1 * Lambda + c0
+    dP = 2. * (2. * L2 + c2) * Lambda + c1
+    Step = P / where(dP == 0., 1., dP)
+    Lambda = Lambda - Step
+    if abs(Step).max() <= Tol * max(abs(Lambda).max(), 1.): break
+  RMSD = sqrt(clip(2. * (E0 - Lambda) / W, 0., None))
+  if not RetRotMat:
+    return RMSD
+  #rotation from the quaternion eigenvector of the largest eigenvalue
+  q = linalg.eigh(K)[1][...,:,-1]
+  q0, q1, q2, q3 = q[...,0], q[...,1], q[...,2], q[...,3]
+  RotMat = empty((n, k, 3, 3), float)
+  RotMat[...,0,0] = q0*q0 + q1*q1 - q2*q2 - q3*q3
+  RotMat[...,1,0] = 2*(q1*q2 - q0*q3)
+  RotMat[...,2,0] = 2*(q1*q3 + q0*q2)
+  RotMat[...,0,1] = 2*(q1*q2 + q0*q3)
+  RotMat[...,1,1] = q0*q0 - q1*q1 + q2*q2 - q3*q3
+  RotMat[...,2,1] = 2*(q2*q3 - q0*q1)
+  RotMat[...,0,2] = 2*(q1*q3 - q0*q2)
+  RotMat[...,1,2] = 2*(q2*q3 + q0*q1)
+  RotMat[...,2,2] = q0*q0 - q1*q1 - q2*q2 + q3*q3
+  return RMSD, PosVec, RefVec, RotMat
+
 def dRMSD(Pos1, Pos2, Mask = None):
   """Returns the distance-based RMSD."""
   if USELIB:
@@ -24,7 +24,7 @@ if __name__ == "__main__" and len(sys.argv) == 1:
   sys.exit()
 
 from numpy import *  
-import copy, os, coords, random
+import copy, os, coords, random, tempfile
 import geometry, sequence, protein, scripttools
 
 
@@ -76,6 +76,53 @@ def RMSD(Pos1, Pos2, Align = False, Center = True,
     return r
 
 
+def RMSDBatch(Pos, RefPos, Center = True, CompInd = None, CalcInd = None,
+              Weights = None, RetAlignment = False):
+  """Calculates the RMSD between many conformations and many references.
+* Pos: array of dimensions [n,N,3] of conformations
+* RefPos: array of dimensions [k,N,3] of reference conformations
+* CompInd: indices in [0,N) for positions in Pos to perform alignment
+* CalcInd: indices in [0,N) for positions in Pos to compute RMSD
+* Weights: optional array of length N of per-position weights
+* RetAlignment: True to also return the translation vectors and rotation
+  matrices, such that RefPos[j] + RefVec[j] is aligned to
+  dot(Pos[i] + PosVec[i], RotMat[i,j])
+Returns an array of dimensions [n,k] of RMSD values, as RMSD(RefPos[j],
+Pos[i]) would, but with all pairs superposed at once."""
+  Pos, RefPos = asarray(Pos, float), asarray(RefPos, float)
+  if Pos.ndim == 2: Pos = Pos[newaxis]
+  if RefPos.ndim == 2: RefPos = RefPos[newaxis]
+  N = Pos.shape[1]
+  if Weights is None: Weights = ones(N, float)
+  Weights = asarray(Weights, float)
+  #clean indices
+  AllInd = arange(N, dtype = int)
+  if CompInd is None: CompInd = AllInd
+  if CalcInd is None: CalcInd = AllInd
+  CompInd, CalcInd = asarray(CompInd, int), asarray(CalcInd, int)
+  SameInd = len(CompInd) == len(CalcInd) and all(CompInd == CalcInd)
+  p1, p2 = Pos.take(CompInd, axis=1), RefPos.take(CompInd, axis=1)
+  w = Weights.take(CompInd)
+  if SameInd and not RetAlignment:
+    return geometry.QCPRMSD(p1, p2, Weights = w, Center = Center)
+  r, PosVec, RefVec, RotMat = geometry.QCPRMSD(p1, p2, Weights = w,
+                                    Center = Center, RetRotMat = True)
+  if not SameInd:
+    #residuals over the calc positions with the fit from the comp positions
+    w = Weights.take(CalcInd)
+    p1 = Pos.take(CalcInd, axis=1) + PosVec[:,newaxis,:]
+    p2 = RefPos.take(CalcInd, axis=1) + RefVec[:,newaxis,:]
+    pw = p1 * w[newaxis,:,newaxis]
+    Resid = einsum("nai,nai->n", pw, p1)[:,newaxis] \
+          + einsum("kai,kai->k", p2 * w[newaxis,:,newaxis], p2)[newaxis,:] \
+          - 2. * einsum("nkij,nkij->nk", RotMat, einsum("nai,kaj->nkij", pw, p2))
+    r = sqrt(clip(Resid / w.sum(), 0., None))
+  if RetAlignment:
+    return r, PosVec, RefVec, RotMat
+  else:
+    return r
+
+
 def GetProteinClassMasks(p, AtomMask = None, CompResInd = None,
                          CalcResInd = None):
   if AtomMask is None:
@@ -195,7 +242,7 @@ def RMSDPdb(PdbFile1, PdbFile2, Center = True, Backbone = True,
 def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
   MaxClusterWork = None, Method = 0, CompInd = None, CalcInd = None,
   Weights = None, Verbose = True, IterMaxCluster = False,
-  IterNormalize = False):
+  IterNormalize = False, InMemory = False, MaxMemory = None):
   """Clusters conformations in a trajectory based on RMSD distance.
 * CoordsObj: an object exposing the functions GetNextCoords() which
   returns an array object of the next set of coordinates (or None
@@ -214,7 +261,17 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
 * Weights: weighting factor for each conformation
 * IterMaxCluster: True will dump all but MaxCluster configs each iter
 * IterNormalize: True will dump previous iter contribs to centroids
+* InMemory: True to read the CompInd/CalcInd positions of every config
+  once into an array and cluster from it (see ClusterMSSInMemory)
+* MaxMemory: with InMemory, the size in MB above which that array is
+  kept in a temporary memory-mapped file instead
 """
+  if InMemory:
+    return ClusterMSSInMemory(CoordsObj, Cutoff, MaxIter = MaxIter,
+      MaxCluster = MaxCluster, MaxClusterWork = MaxClusterWork,
+      Method = Method, CompInd = CompInd, CalcInd = CalcInd,
+      Weights = Weights, Verbose = Verbose, IterMaxCluster = IterMaxCluster,
+      IterNormalize = IterNormalize, MaxMemory = MaxMemory)
   def BasicRMSD(Pos1, Pos2, Ind = None):
     "Calculates the rmsd between two configurations without alignment."
     if Ind is None:
@@ -257,7 +314,8 @@ def ClusterMSS(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
     if NewStartInd >= 0: StartInd = NewStartInd
     NewStartInd = -1
     for CurInd in range(StartInd, NCoord) + range(0, StartInd):
-      CurPos = CoordsObj[CurInd]
+      #copy, since alignment changes the positions in place
+      CurPos = array(CoordsObj[CurInd], float)
       #check for zero weight
       CurWeight = Weights[CurInd]
       if CurWeight == 0.:
@@ -453,6 +511,241 @@ def __CalcRmsd(CoordsObj, Pos, ClustNum,
   return Pos, ClustNum, ConfRmsd, ClustRmsd
 
 
+def LoadFrames(CoordsObj, AtomInd = None, MaxMemory = None, BlockSize = 1000,
+               FrameFile = None):
+  """Reads every configuration of a coordinate object into one array of
+dimensions [NCoord,len(AtomInd),3].  If the array would be larger than
+MaxMemory MB, it is put in a temporary memory-mapped file instead (which
+is removed as soon as the array is deleted).  If FrameFile is given, the
+array is always memory-mapped to that file, as raw float64 values, and
+the file is kept."""
+  NCoord = len(CoordsObj)
+  if AtomInd is None:
+    NAtom = len(CoordsObj[0])
+  else:
+    NAtom = len(AtomInd)
+  Size = NCoord * NAtom * 3 * 8 / 1024.**2
+  if not FrameFile is None:
+    Frames = memmap(FrameFile, dtype = float, mode = "w+", shape = (NCoord, NAtom, 3))
+  elif MaxMemory is None or Size <= MaxMemory:
+    Frames = empty((NCoord, NAtom, 3), float)
+  else:
+    f = tempfile.TemporaryFile(prefix = "frames")
+    Frames = memmap(f, dtype = float, mode = "w+", shape = (NCoord, NAtom, 3))
+  CoordsObj.Reset()
+  if hasattr(CoordsObj, "GetBlock"):
+    for i in xrange(0, NCoord, BlockSize):
+      Pos = CoordsObj.GetBlock(i, BlockSize)
+      if not AtomInd is None: Pos = Pos.take(AtomInd, axis=1)
+      Frames[i:i+len(Pos)] = Pos
+  else:
+    for i in xrange(NCoord):
+      Pos = CoordsObj[i]
+      if not AtomInd is None: Pos = Pos.take(AtomInd, axis=0)
+      Frames[i] = Pos
+  CoordsObj.Reset()
+  if not FrameFile is None: Frames.flush()
+  return Frames
+
+
+def ClusterMSSInMemory(CoordsObj, Cutoff, MaxIter = 3, MaxCluster = None,
+  MaxClusterWork = None, Method = 0, CompInd = None, CalcInd = None,
+  Weights = None, Verbose = True, IterMaxCluster = False,
+  IterNormalize = False, MaxMemory = None):
+  """Clusters conformations exactly as ClusterMSS does, but reads the
+CompInd/CalcInd positions of every configuration only once, with LoadFrames.
+Each configuration is compared to all working clusters at once with
+RMSDBatch, centroid sums are updated in place, and the final statistics
+are computed from the loaded array, so the coordinate object is only read
+again for the final cluster structures.  Arguments are as for ClusterMSS,
+with MaxMemory in MB as for LoadFrames."""
+  NCoord = len(CoordsObj)
+  if Weights is None: Weights = ones(NCoord, float)
+  Weights = array(Weights, float)
+  if not len(Weights) == NCoord:
+    raise IndexError, "Incorrect number of array elements in Weights."
+  #filter weights for too low values
+  Weights = Weights.copy()
+  Weights = Weights / Weights.max()
+  Weights[Weights < 1.e-100] = 0.
+  NFrameTot = int(sum(Weights > 0))
+  print "Using %d conformations in %d trajectory frames." % (NFrameTot, len(CoordsObj))
+  #only keep the positions used for alignment or rmsd
+  if CompInd is None or CalcInd is None:
+    AtomInd = None
+  else:
+    AtomInd = unique(concatenate((asarray(CompInd, int), asarray(CalcInd, int))))
+  Frames = LoadFrames(CoordsObj, AtomInd, MaxMemory)
+  NAtom = Frames.shape[1]
+  Map = dict([(j, i) for (i, j) in enumerate(range(NAtom) if AtomInd is None else AtomInd)])
+  if CompInd is None: CompInd = range(NAtom)
+  if CalcInd is None: CalcInd = range(NAtom)
+  CompInd = array([Map[i] for i in CompInd], int)
+  CalcInd = array([Map[i] for i in CalcInd], int)
+  if hasattr(CoordsObj, "GetIndices"):
+    Indices = list(CoordsObj.GetIndices())
+  else:
+    Indices = range(NCoord)
+  def CentRMSD(Cent, CurPos):
+    "RMSD between a configuration and every centroid."
+    if Method == 0:
+      return RMSDBatch(CurPos, Cent, CompInd = CompInd, CalcInd = CalcInd)[0]
+    else:
+      d = Cent[:,CalcInd,:] - CurPos[CalcInd]
+      return sqrt((d*d).sum(axis=2).sum(axis=1) / float(len(CalcInd)))
+  Iteration = 0   #iteration number
+  WeightSum = []  #total weights of clusters
+  PosSum = []     #list of cluster configuration arrays
+  FinalIters = 0  #number of iterations without additions/deletions of clusters
+  StartInd, NewStartInd = 0, -1
+  while FinalIters < 2:
+    Iteration += 1
+    FinalIters += 1
+    if Iteration > MaxIter:
+      if Verbose: print "Did not converge within maximum number of iterations"
+      break
+    if Verbose: print "Cluster iteration %d" % Iteration
+    if Verbose: print "Starting with %d clusters" % len(PosSum)
+    ClustNum = zeros(NCoord, int)  #cluster number of each configuration, starting at 1
+    NAddThis = [0]*len(PosSum)     #number of configs added to each cluster this iteration
+    #contributions from this iteration only, in place of copies of the sums
+    PosAdd = [zeros((NAtom, 3), float) for x in PosSum]
+    WeightAdd = [0.]*len(PosSum)
+    #centroids of all working clusters, kept up to date
+    Cent = array([x / y for (x, y) in zip(PosSum, WeightSum)], float).reshape((-1, NAtom, 3))
+    ThisFrame = 0
+    #check where to start
+    if NewStartInd >= 0: StartInd = NewStartInd
+    NewStartInd = -1
+    for CurInd in range(StartInd, NCoord) + range(0, StartInd):
+      #check for zero weight
+      CurWeight = Weights[CurInd]
+      if CurWeight == 0.:
+        ClustNum[CurInd] = 0
+        continue
+      CurPos = Frames[CurInd]
+      ThisFrame += 1
+      ind = -1  #cluster number assigned to this config; -1 means none
+      minRMSD = 1.e300
+      if len(PosSum) > 0:
+        r = CentRMSD(Cent, CurPos)
+        Below = flatnonzero(r < Cutoff)
+        if len(Below) > 0:
+          #go with the first cluster within the cutoff
+          ind = Below[0]
+        else:
+          minRMSD = r.min()
+        if Method == 0:
+          #align to the last cluster compared, as ClusterMSS does
+          j = len(PosSum) - 1
+          if ind >= 0: j = ind
+          x, PosVec, RefVec, RotMat = RMSDBatch(CurPos, Cent[j], CompInd = CompInd,
+                                                CalcInd = CalcInd, RetAlignment = True)
+          CurPos = dot(CurPos + PosVec[0], RotMat[0,0]) - RefVec[0]
+      if ind >= 0:
+        #add the configuration to the cluster
+        PosSum[ind] += CurPos * CurWeight
+        WeightSum[ind] = WeightSum[ind] + CurWeight
+        PosAdd[ind] += CurPos * CurWeight
+        WeightAdd[ind] = WeightAdd[ind] + CurWeight
+        Cent[ind] = PosSum[ind] / WeightSum[ind]
+        NAddThis[ind] = NAddThis[ind] + 1
+        ClustNum[CurInd] = ind+1
+      elif len(PosSum) < MaxClusterWork or MaxClusterWork is None:
+        #create a new cluster with this config, as long as it
+        #doesn't exceed the maximum number of working clusters
+        if minRMSD == 1.e300: minRMSD = 0.
+        if Verbose: print "Adding cluster: config %d (%d/%d) | min RMSD %.1f | %d clusters tot" % (Indices[CurInd]+1,
+                          ThisFrame, NFrameTot, minRMSD, len(PosSum)+1)
+        PosSum.append(CurPos * CurWeight)
+        WeightSum.append(CurWeight)
+        PosAdd.append(CurPos * CurWeight)
+        WeightAdd.append(CurWeight)
+        Cent = concatenate((Cent, CurPos[newaxis]))
+        NAddThis.append(1)
+        ClustNum[CurInd] = len(PosSum)
+        FinalIters = 0
+      else:
+        #cluster is nothing
+        ClustNum[CurInd] = 0
+        FinalIters = 0
+        if NewStartInd < 0:
+          NewStartInd = CurInd
+          if Verbose: print "Ran out of clusters. Next iteration starting from config %d" % (Indices[CurInd]+1,)
+    #remove contribution to centroids from all but this round
+    if IterNormalize:
+      PosSum, WeightSum = PosAdd, WeightAdd
+    del PosAdd, WeightAdd, Cent
+    #loop through clusters
+    i = 0
+    while i < len(PosSum):
+      #remove clusters that have no additions this iteration
+      if NAddThis[i] == 0:
+        if Verbose: print "Removing cluster %d" % (i+1,)
+        del PosSum[i]
+        del WeightSum[i]
+        del NAddThis[i]
+        ClustNum[ClustNum == i + 1] = -1
+        ClustNum[ClustNum > i + 1] -= 1
+        FinalIters = 0
+      else:
+        i += 1
+    #sort clusters and then remove any beyond MaxCluster
+    PosSum, ClustNum, WeightSum, NAddThis = __SortClust(PosSum, ClustNum, Weights, WeightSum, NAddThis, Verbose)
+    if IterMaxCluster and not MaxCluster is None and len(PosSum) > abs(MaxCluster):
+      del PosSum[abs(MaxCluster):]
+      WeightSum = WeightSum[:abs(MaxCluster)]
+      NAddThis = NAddThis[:abs(MaxCluster)]
+      ClustNum[abs(ClustNum) > abs(MaxCluster)] = 0
+  #crop off any extraneous clusters; clusterless configs
+  #are assigned a cluster index of 0
+  if not IterMaxCluster and not MaxCluster is None and len(PosSum) > abs(MaxCluster):
+    del PosSum[abs(MaxCluster):]
+    WeightSum = WeightSum[:abs(MaxCluster)]
+    NAddThis = NAddThis[:abs(MaxCluster)]
+    ClustNum[abs(ClustNum) > abs(MaxCluster)] = 0
+  #finalize things
+  if Verbose: print "Calculating average structures"
+  Pos = array([x / y for (x, y) in zip(PosSum, WeightSum)], float).reshape((-1, NAtom, 3))
+  del PosSum
+  del WeightSum
+  #get cluster populations
+  ClustWeights, ClustPop = __CalcClustPop(Pos, ClustNum, Weights)
+  #if there is a maximum cluster specification that's negative, force
+  #everything to the closest cluster
+  if not MaxCluster == None and MaxCluster < 0:
+    c = flatnonzero(ClustNum == 0)
+    if Verbose: print "Forcing %d extraneous configurations to existing clusters" % len(c)
+    for j in c:
+      ind = RMSDBatch(Frames[j], Pos, CompInd = CompInd, CalcInd = CalcInd)[0].argmin()
+      ClustNum[j] = ind + 1
+      ClustWeights[ind] = ClustWeights[ind] + Weights[j]
+      ClustPop[ind] = ClustPop[ind] + 1.
+  #calculate final rmsd values for configs and clusters
+  if Verbose: print "Calculating cluster rmsd values"
+  r = RMSDBatch(Pos, Pos, CompInd = CompInd, CalcInd = CalcInd)
+  ClustRmsd = triu(r.transpose(), 1)
+  ClustRmsd = ClustRmsd + ClustRmsd.transpose()
+  if Verbose: print "Calculating final rmsd values"
+  ConfRmsd = -1. * ones(len(ClustNum), float)
+  MinRmsd = [-1]*len(Pos)
+  for i in range(len(Pos)):
+    Ind = flatnonzero(abs(ClustNum) == i + 1)
+    if len(Ind) == 0: continue
+    ConfRmsd[Ind] = RMSDBatch(Frames.take(Ind, axis=0), Pos[i],
+                              CompInd = CompInd, CalcInd = CalcInd)[:,0]
+    MinRmsd[i] = Ind[ConfRmsd[Ind].argmin()]
+  del Frames
+  #extract the coords of the minimum-rmsd configs for each clust
+  if Verbose: print "Finding nearest cluster structures"
+  Pos = list(Pos)
+  for (i, ind) in enumerate(MinRmsd):
+    ClustNum[ind] = -ClustNum[ind]
+    Pos[i] = CoordsObj.Get(ind, coords.NoMask)
+  if Verbose: print "%d configurations sorted into %d clusters" % (NFrameTot, len(Pos))
+  return Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd
+
+
 def SaveClustResults(Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd,
   Prefix = "clust", ConfIndices = None, Verbose = False):
   #make the indices
@@ -493,6 +786,174 @@ def SaveClustResults(Pos, ClustNum, ClustWeights, ClustPop, ConfRmsd, ClustRmsd,
       file(fn, "w").write(s)
 
 
+def RMSDMatrixIndex(i, j, N):
+  """Returns the position of element (i,j), with i < j, in a packed upper
+triangle of an [N,N] matrix, as written by RMSDMatrix."""
+  return i * (2*N - i - 1) / 2 + j - i - 1
+
+
+def LoadRMSDMatrix(MatrixFile, Square = False):
+  """Opens a pairwise rmsd file written by RMSDMatrix.
+* MatrixFile: name of the file
+* Square: True to return the full symmetric [N,N] array in memory;
+  False to return a read-only memory map of the packed upper triangle,
+  for use with RMSDMatrixIndex
+Returns N and the array."""
+  L = os.path.getsize(MatrixFile) / 4
+  N = int(round((1. + sqrt(1. + 8.*L)) / 2.))
+  if not N * (N-1) / 2 == L:
+    raise ValueError, "%s is not a packed rmsd matrix." % MatrixFile
+  r = memmap(MatrixFile, dtype = float32, mode = "r", shape = (L,))
+  if not Square: return N, r
+  rSq = zeros((N, N), float32)
+  for i in xrange(N - 1):
+    k = RMSDMatrixIndex(i, i+1, N)
+    rSq[i,i+1:] = r[k:k+N-i-1]
+    rSq[i+1:,i] = r[k:k+N-i-1]
+  return N, rSq
+
+
+def __RMSDTile(Args):
+  "Computes one tile of the pairwise rmsd matrix; run by RMSDMatrix."
+  (FrameFile, Shape, MatrixFile, TileSize, bi, bj,
+   Superpose, Center, CompInd, CalcInd) = Args
+  N = Shape[0]
+  Frames = memmap(FrameFile, dtype = float, mode = "r", shape = Shape)
+  i0, i1 = bi * TileSize, min((bi+1) * TileSize, N)
+  j0, j1 = bj * TileSize, min((bj+1) * TileSize, N)
+  PosI, PosJ = array(Frames[i0:i1]), array(Frames[j0:j1])
+  if Superpose:
+    r = RMSDBatch(PosI, PosJ, Center = Center, CompInd = CompInd, CalcInd = CalcInd)
+  else:
+    PosI, PosJ = PosI.take(CalcInd, axis=1), PosJ.take(CalcInd, axis=1)
+    r = zeros((i1 - i0, j1 - j0), float)
+    for (k, Pos) in enumerate(PosI):
+      d = PosJ - Pos
+      r[k] = sqrt((d*d).sum(axis=2).sum(axis=1) / float(len(CalcInd)))
+  del Frames
+  #write the upper-triangle part of each row, which is contiguous
+  m = memmap(MatrixFile, dtype = float32, mode = "r+",
+             shape = (N * (N-1) / 2,))
+  for i in xrange(i0, i1):
+    j = max(j0, i + 1)
+    if j >= j1: continue
+    k = RMSDMatrixIndex(i, j, N)
+    m[k:k + j1 - j] = r[i - i0, j - j0:]
+  m.flush()
+  del m
+  return bi, bj
+
+
+def __RMSDMatrixInfo(CoordsObj, N, TileSize, Superpose, Center,
+                     CompInd, CalcInd):
+  "Describes the inputs of an RMSDMatrix run, to check before resuming it."
+  Info = [("N", N), ("TileSize", TileSize), ("Superpose", bool(Superpose)),
+          ("Center", bool(Center))]
+  for Ind in (CompInd, CalcInd):
+    if not Ind is None: Ind = [int(i) for i in Ind]
+    Info.append(("Ind", Ind))
+  for Attr in ("TrjFile", "PrmtopFile", "NSkip", "NRead", "NStride", "Mask"):
+    Info.append((Attr, getattr(CoordsObj, Attr, None)))
+  TrjFile = getattr(CoordsObj, "TrjFile", None)
+  if isinstance(TrjFile, str) and os.path.isfile(TrjFile):
+    st = os.stat(TrjFile)
+    Info.append(("TrjStamp", (os.path.abspath(TrjFile), st.st_size,
+                              int(st.st_mtime))))
+  return repr(Info) + "\n"
+
+
+def RMSDMatrix(CoordsObj, MatrixFile, Superpose = True, Center = True,
+               CompInd = None, CalcInd = None, TileSize = 256,
+               NProc = None, Resume = True, Verbose = True):
+  """Computes the rmsd between every pair of configurations in a
+coordinate object and writes the packed upper triangle to disk, as float32
+values in row order (see RMSDMatrixIndex and LoadRMSDMatrix).  The matrix
+is computed in square tiles of TileSize configurations over a pool of
+processes, so memory use scales with the tile size rather than with the
+matrix.  Progress is kept per tile in the file MatrixFile.tiles, so an
+interrupted run picks up where it stopped; MatrixFile.info records the
+trajectory and settings of the run, and a run is only resumed if they match.
+Nothing is written for fewer than two configurations.
+* CoordsObj: coordinate object, e.g. a coords.TrjClass
+* MatrixFile: name of the output file
+* Superpose: True to superimpose each pair on the CompInd positions before
+  computing the rmsd, as RMSD does; False to compare coordinates as is
+* Center: True to center the CompInd positions before superposition
+  (ignored without Superpose)
+* CompInd: indices of positions used for alignment (default is all)
+* CalcInd: indices of positions used for the rmsd (default is all)
+* TileSize: number of configurations per tile side
+* NProc: number of processes (default is the number of cpus)
+* Resume: True to keep tiles already finished by an earlier run for
+  the same MatrixFile; False to start over
+Returns the number of configurations."""
+  import multiprocessing
+  N = len(CoordsObj)
+  if N < 2: return N
+  NBlock = (N + TileSize - 1) / TileSize
+  Tiles = [(bi, bj) for bi in range(NBlock) for bj in range(bi, NBlock)]
+  TileFile = MatrixFile + ".tiles"
+  FrameFile = MatrixFile + ".frames"
+  InfoFile = MatrixFile + ".info"
+  Info = __RMSDMatrixInfo(CoordsObj, N, TileSize, Superpose, Center,
+                          CompInd, CalcInd)
+  #check for an earlier run of the same trajectory and settings
+  Size = N * (N-1) / 2 * 4
+  if not (Resume and os.path.isfile(MatrixFile) and os.path.isfile(TileFile)
+          and os.path.isfile(InfoFile) and file(InfoFile).read() == Info
+          and os.path.getsize(MatrixFile) == Size
+          and os.path.getsize(TileFile) == NBlock * NBlock):
+    if Verbose and Resume and os.path.isfile(MatrixFile):
+      print "%s is from a different run; starting over" % MatrixFile
+    file(TileFile, "wb").write("\0" * (NBlock * NBlock))
+    f = file(MatrixFile, "wb")
+    f.truncate(Size)
+    f.close()
+    file(InfoFile, "w").write(Info)
+  Done = memmap(TileFile, dtype = uint8, mode = "r+", shape = (NBlock, NBlock))
+  Todo = [(bi, bj) for (bi, bj) in Tiles if not Done[bi,bj]]
+  if Verbose: print "%d of %d tiles left to compute" % (len(Todo), len(Tiles))
+  if len(Todo) == 0:
+    del Done
+    return N
+  #only keep the positions used for alignment or rmsd
+  NAtom = len(CoordsObj[0])
+  if CompInd is None: CompInd = range(NAtom)
+  if CalcInd is None: CalcInd = range(NAtom)
+  AtomInd = unique(concatenate((asarray(CompInd, int), asarray(CalcInd, int))))
+  Map = dict([(j, i) for (i, j) in enumerate(AtomInd)])
+  CompInd = array([Map[i] for i in CompInd], int)
+  CalcInd = array([Map[i] for i in CalcInd], int)
+  if Verbose: print "Reading %d configurations" % N
+  Frames = LoadFrames(CoordsObj, AtomInd, FrameFile = FrameFile)
+  Shape = Frames.shape
+  del Frames
+  Args = [(FrameFile, Shape, MatrixFile, TileSize, bi, bj,
+           Superpose, Center, CompInd, CalcInd) for (bi, bj) in Todo]
+  if NProc is None: NProc = multiprocessing.cpu_count()
+  if NProc > 1:
+    Pool = multiprocessing.Pool(min(NProc, len(Todo)))
+    Results = Pool.imap_unordered(__RMSDTile, Args)
+  else:
+    Pool = None
+    Results = (__RMSDTile(x) for x in Args)
+  try:
+    for (n, (bi, bj)) in enumerate(Results):
+      #tiles are flushed by the workers before being marked done
+      Done[bi,bj] = 1
+      Done.flush()
+      if Verbose: print "Finished tile %d/%d" % (n + 1, len(Todo))
+  except:
+    if not Pool is None: Pool.terminate()
+    raise
+  if not Pool is None:
+    Pool.close()
+    Pool.join()
+  del Done
+  os.remove(FrameFile)
+  return N
+
+
 
 #======== COMMAND-LINE RUNNING ========
 
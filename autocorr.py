@@ -1,69 +1,302 @@
 #!/usr/bin/env python
 
+"""
+This module computes autocorrelation functions of (one or more columns of) a
+time series with zero-padded FFTs, which costs O(N log N) rather than the
+O(N^2) of a direct sum. Series that do not fit in memory can be processed in
+segments with StreamingAutocorrelation, up to a maximum lag. The integrated
+autocorrelation time and statistical inefficiency are estimated from the
+normalized autocorrelation function.
+
+Normalization modes:
+   none:     Raw sums of x(t)*x(t+k) (no mean subtracted)
+   standard: Mean subtracted, divided by N times the variance, so the value at
+             lag 0 is 1 (the biased estimator)
+   unbiased: Mean subtracted, divided by (N-k) times the variance
+"""
+
 import numpy as np
-from optparse import OptionParser
 import sys
 
-parser = OptionParser()
-parser.add_option('-f', '--file', dest="data_file", 
-                  help="Input data file", default=None)
-parser.add_option('-o', '--output', dest="output_file",
-                  help="Autocorrelation output file", default=None)
-parser.add_option('-n', '--normalize', dest="normalize", action="store_true",
-                  default=False, help="Normalize the histograms")
-parser.add_option('-d', '--delimiter', dest="delimiter", default=None,
-               help="The column delimiter (defaults to any kind of whitespace)")
-parser.add_option('-c', '--column', dest='column', default=1, type="int",
-                  help="Which column to pull the data from")
-
-opt, arg = parser.parse_args()
-
-# read in data, check for existing file
-if opt.data_file is None:
-   input_data = sys.stdin
-else:
+# Number of lines parsed at a time when reading data in segments
+SEGMENT_SIZE = 1000000
+
+NORMALIZATIONS = ('none', 'standard', 'unbiased')
+
+class AutocorrError(Exception):
+   """ Raised for bad input to the autocorrelation routines """
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _fft_size(n):
+   """ Smallest power of 2 of at least n """
+   size = 1
+   while size < n: size *= 2
+   return size
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _as_columns(data):
+   """ Returns data as a 2-D (N, ncols) float array """
+   data = np.asarray(data, float)
+   if data.ndim == 1: return data[:,np.newaxis]
+   if data.ndim != 2:
+      raise AutocorrError('Expected a 1-D or 2-D array of data!')
+   return data
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _normalize(sums, n, variance, normalize):
+   """ Turns mean-subtracted lag sums into the requested normalization """
+   if normalize == 'standard':
+      return sums / (n * variance)
+   if normalize == 'unbiased':
+      return sums / ((n - np.arange(len(sums)))[:,np.newaxis] * variance)
+   return sums
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def autocorrelation(data, normalize='standard', maxlag=None):
+   """
+   Autocorrelation function of each column of data (a 1-D series or an
+   (N, ncols) array) for lags 0 through maxlag (default N-1). Returns an
+   array of shape (maxlag+1,) for 1-D data or (maxlag+1, ncols) otherwise
+   """
+   if not normalize in NORMALIZATIONS:
+      raise AutocorrError('Unknown normalization %s' % normalize)
+   one_d = np.ndim(data) == 1
+   data = _as_columns(data)
+   n = data.shape[0]
+   if n == 0: raise AutocorrError('No data to correlate!')
+   if maxlag is None or maxlag > n - 1: maxlag = n - 1
+   size = _fft_size(2 * n - 1)
+   acor = np.empty((maxlag+1, data.shape[1]))
+   # One column at a time keeps the memory to a couple of transforms
+   for i in range(data.shape[1]):
+      col = data[:,i]
+      if normalize != 'none': col = col - col.mean()
+      fft = np.fft.rfft(col, size)
+      acor[:,i] = np.fft.irfft(fft * fft.conj(), size)[:maxlag+1]
+   if normalize != 'none':
+      acor = _normalize(acor, n, data.var(axis=0), normalize)
+   if one_d: return acor[:,0]
+   return acor
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class StreamingAutocorrelation(object):
+   """
+   Accumulates the autocorrelation function up to maxlag of one or more
+   columns of a series that is fed in segments (via add), in one pass. Only
+   the last maxlag points are kept between segments. The mean is subtracted
+   at the end using running sums, so it does not need to be known up front
+   """
+
+   def __init__(self, maxlag, ncols=1):
+      if maxlag < 0: raise AutocorrError('maxlag must be non-negative!')
+      self.maxlag = maxlag
+      self.ncols = ncols
+      self.n = 0
+      self.sums = np.zeros((maxlag+1, ncols))   # sum of x(t)*x(t+k)
+      self.total = np.zeros(ncols)
+      self.total2 = np.zeros(ncols)
+      self.head = np.zeros((0, ncols))          # first maxlag points
+      self.tail = np.zeros((0, ncols))          # last maxlag points
+
+   #================================================
+
+   def add(self, segment):
+      """ Adds the next segment of the series (1-D or (n, ncols)) """
+      segment = _as_columns(segment)
+      if segment.shape[1] != self.ncols:
+         raise AutocorrError('Expected %d columns, got %d' %
+                             (self.ncols, segment.shape[1]))
+      nseg = segment.shape[0]
+      if nseg == 0: return
+      # Pair every new point with itself and the maxlag points before it
+      window = np.concatenate((self.tail, segment))
+      ntail = self.tail.shape[0]
+      size = _fft_size(window.shape[0] + nseg)
+      for i in range(self.ncols):
+         fwin = np.fft.rfft(window[:,i], size)
+         fseg = np.fft.rfft(segment[:,i], size)
+         corr = np.fft.irfft(fwin * fseg.conj(), size)
+         # corr[ntail-k] = sum_j window[j+ntail-k] * segment[j]
+         nlag = min(self.maxlag, ntail + nseg - 1)
+         self.sums[:nlag+1,i] += corr[ntail-np.arange(nlag+1)]
+      self.n += nseg
+      self.total += segment.sum(axis=0)
+      self.total2 += (segment * segment).sum(axis=0)
+      if self.head.shape[0] < self.maxlag:
+         self.head = np.concatenate((self.head,
+                                     segment[:self.maxlag-self.head.shape[0]]))
+      self.tail = window[max(window.shape[0]-self.maxlag, 0):]
+
+   #================================================
+
+   def result(self, normalize='standard'):
+      """
+      The (maxlag+1, ncols) autocorrelation function of everything added so
+      far (lags beyond the length of the series are 0)
+      """
+      if not normalize in NORMALIZATIONS:
+         raise AutocorrError('Unknown normalization %s' % normalize)
+      if self.n == 0: raise AutocorrError('No data to correlate!')
+      nlag = min(self.maxlag, self.n - 1)
+      if normalize == 'none': return self.sums.copy()
+      mean = self.total / self.n
+      lags = np.arange(nlag+1)
+      # Sums of the first n-k and last n-k points for each lag k
+      head = np.concatenate((np.zeros((1, self.ncols)),
+                             np.cumsum(self.head[:nlag], axis=0)))
+      tail = np.concatenate((np.zeros((1, self.ncols)),
+                             np.cumsum(self.tail[::-1][:nlag], axis=0)))
+      first = self.total - tail[lags]
+      last = self.total - head[lags]
+      sums = np.zeros_like(self.sums)
+      sums[:nlag+1] = self.sums[:nlag+1] - mean * (first + last) + \
+                      (self.n - lags)[:,np.newaxis] * mean * mean
+      variance = self.total2 / self.n - mean * mean
+      acor = np.zeros_like(sums)
+      acor[:nlag+1] = _normalize(sums[:nlag+1], self.n, variance, normalize)
+      return acor
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def statistical_inefficiency(acor, n=None):
+   """
+   Statistical inefficiency g = 1 + 2 sum_k (1 - k/N) C(k) of each column of
+   a normalized autocorrelation function C, summed until C first drops to
+   zero or below (N defaults to the number of lags). The integrated
+   autocorrelation time is (g - 1) / 2. Returns g (an array for 2-D input)
+   """
+   one_d = np.ndim(acor) == 1
+   acor = _as_columns(acor)
+   if n is None: n = acor.shape[0]
+   weights = 1 - np.arange(acor.shape[0]) / float(n)
+   ineff = np.ones(acor.shape[1])
+   for i in range(acor.shape[1]):
+      col = acor[:,i] / acor[0,i]
+      stop = np.flatnonzero(col[1:] <= 0)
+      stop = stop[0] + 1 if len(stop) else len(col)
+      ineff[i] = max(1 + 2 * np.sum(weights[1:stop] * col[1:stop]), 1)
+   if one_d: return ineff[0]
+   return ineff
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def autocorrelation_time(acor, n=None):
+   """ Integrated autocorrelation time (in frames) from the normalized acor """
+   return (statistical_inefficiency(acor, n) - 1) / 2
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def read_segments(infile, columns, delimiter=None, segment_size=SEGMENT_SIZE):
+   """
+   Generator of (n, len(columns)) arrays of the given (1-based) columns of a
+   data file, segment_size lines at a time. Comments and lines that do not
+   have a number in every column are skipped
+   """
+   rows = []
+   for line in infile:
+      # Skip comments
+      if line.startswith('#'): continue
+      words = line.split(delimiter)
+      # Skip over non-qualifying lines
+      try:
+         rows.append([float(words[col-1].strip()) for col in columns])
+      except (ValueError, IndexError):
+         continue
+      if len(rows) == segment_size:
+         yield np.array(rows)
+         rows = []
+   if rows: yield np.array(rows)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+if __name__ == '__main__':
+   from optparse import OptionParser
+
+   parser = OptionParser()
+   parser.add_option('-f', '--file', dest="data_file",
+                     help="Input data file", default=None)
+   parser.add_option('-o', '--output', dest="output_file",
+                     help="Autocorrelation output file", default=None)
+   parser.add_option('-n', '--normalize', dest="normalize",
+                     action="store_const", const='standard', default='none',
+                     help="Normalize the autocorrelation function (same as " +
+                     "--mode=standard)")
+   parser.add_option('-m', '--mode', dest="normalize", metavar='MODE',
+                     choices=NORMALIZATIONS, help="Normalization: none " +
+                     "(raw sums), standard (biased, 1 at lag 0) or unbiased " +
+                     "(divide lag k by N-k). Default none")
+   parser.add_option('-d', '--delimiter', dest="delimiter", default=None,
+                  help="The column delimiter (defaults to any kind of whitespace)")
+   parser.add_option('-c', '--column', dest='column', default='1',
+                     metavar='INT[,INT,...]', help="Which column(s) to pull " +
+                     "the data from. Several columns are written side by side")
+   parser.add_option('-l', '--max-lag', dest='maxlag', default=None, type='int',
+                     metavar='INT', help="Largest lag to compute. Default " +
+                     "all of them")
+   parser.add_option('-s', '--segment-size', dest='segment', default=None,
+                     type='int', metavar='INT', help="Read and correlate the " +
+                     "data this many lines at a time rather than all at once " +
+                     "(requires --max-lag)")
+   parser.add_option('-i', '--inefficiency', dest='stats', default=False,
+                     action='store_true', help="Write the statistical " +
+                     "inefficiency and integrated autocorrelation time of " +
+                     "each column as comments at the top of the output")
+
+   opt, arg = parser.parse_args()
+
    try:
-      input_data = open(opt.data_file,'r')
-   except IOError:
-      print 'Error: data file ' + opt.data_file + ' not found!'
+      columns = [int(col) for col in opt.column.split(',')]
+   except ValueError:
+      print 'Error: bad column specification ' + opt.column
       sys.exit(1)
 
-if opt.output_file is None:
-   outfile = sys.stdout
-else:
-   outfile = open(opt.output_file, 'w')
-
-if opt.delimiter is None:
-   splitmethod = lambda x: str.split(x)
-else:
-   splitmethod = lambda x: str.split(x, opt.delimiter)
-
-data = []
-for line in input_data:
-   # Skip comments
-   if line.startswith('#'): continue
-   # Skip over non-qualifying lines
-   try:
-      data.append(float(splitmethod(line)[opt.column-1].strip()))
-   except (ValueError, IndexError):
-      pass
-
-# Now we have our data, convert to ndarray
-data = np.asarray(data)
-
-# If we normalize it then subtract off the mean, divide by the standard
-# deviation, and divide by sqrt of the length
-if opt.normalize:
-   data -= data.mean()
-   data /= data.std()
-   data2 = data.copy() / data.shape[0]
-   acor = np.correlate(data, data2, 'full')
-else:
-   acor = np.correlate(data, data2, 'full')
-
-# Only keep the positive lags
-acor = acor[len(acor)//2:]
-
-# Dump the data
-for i, val in enumerate(acor):
-   outfile.write('%12s %15s\n' % (i, val))
+   if opt.segment is not None and opt.maxlag is None:
+      print 'Error: --segment-size requires --max-lag'
+      sys.exit(1)
+
+   # read in data, check for existing file
+   if opt.data_file is None:
+      input_data = sys.stdin
+   else:
+      try:
+         input_data = open(opt.data_file,'r')
+      except IOError:
+         print 'Error: data file ' + opt.data_file + ' not found!'
+         sys.exit(1)
+
+   if opt.output_file is None:
+      outfile = sys.stdout
+   else:
+      outfile = open(opt.output_file, 'w')
+
+   if opt.segment is not None:
+      stream = StreamingAutocorrelation(opt.maxlag, len(columns))
+      for segment in read_segments(input_data, columns, opt.delimiter,
+                                   opt.segment):
+         stream.add(segment)
+      n = stream.n
+      acor = stream.result(opt.normalize)[:n]
+      if opt.stats: normalized = stream.result('unbiased')[:n]
+   else:
+      data = np.concatenate(list(read_segments(input_data, columns,
+                                               opt.delimiter)) or
+                            [np.zeros((0, len(columns)))])
+      n = data.shape[0]
+      acor = autocorrelation(data, opt.normalize, opt.maxlag)
+      if opt.stats: normalized = autocorrelation(data, 'unbiased', opt.maxlag)
+
+   if opt.stats:
+      ineff = statistical_inefficiency(normalized, n)
+      for col, g in zip(columns, ineff):
+         outfile.write('# Column %d: statistical inefficiency %g, integrated '
+                       'autocorrelation time %g\n' % (col, g, (g - 1) / 2))
+
+   # Dump the data
+   for i, vals in enumerate(acor):
+      outfile.write('%12s' % i + ''.join([' %15s' % val for val in vals]) +
+                    '\n')
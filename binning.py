@@ -0,0 +1,494 @@
+"""
+This module is the histogramming engine behind 1Dbinning.py and 2Dbinning.py.
+Columns of data files are parsed a large block at a time (with a vectorized
+fast path for regular, all-numeric blocks), and points are binned on a
+regular N-dimensional grid by computing flat bin indices and counting them
+with np.bincount. Dimensions can be periodic (e.g., dihedrals), in which case
+points are wrapped into the range rather than discarded, and every point can
+carry a weight. Data sets larger than memory can be streamed from files (in
+parallel) with scan_files and histogram_files. BinnedKDE is the kernel density
+estimator behind kde.py.
+"""
+
+from __future__ import division
+
+import numpy as np
+import math, os, sys
+
+# Number of bytes of the input file parsed at once
+READ_SIZE = 1 << 24
+
+class BinningError(Exception):
+   """ Raised for bad histogram parameters """
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _parse_lines(lines, columns, delimiter, max_fields=None):
+   """ Slow path: parses lines one at a time, skipping bad ones """
+   rows = []
+   for line in lines:
+      words = line.split(delimiter)
+      if max_fields is not None and len(words) > max_fields: continue
+      try:
+         rows.append([float(words[col]) for col in columns])
+      except (ValueError, IndexError):
+         continue
+   return np.array(rows, float).reshape((len(rows), len(columns)))
+
+def _parse_block(text, columns, delimiter, max_fields=None):
+   """
+   Parses the given (0-based) columns of a block of complete lines, skipping
+   lines that are too short, have more than max_fields fields, or have a
+   non-number in one of the columns. Blocks of whitespace-delimited lines
+   that all have the same number of fields are converted in one call
+   """
+   if delimiter is None and text:
+      chars = np.frombuffer(text, np.uint8)
+      space = (chars == 32) | (chars == 9) | (chars == 10) | (chars == 13)
+      # Count the fields on each line from the starts of the words
+      starts = ~space
+      starts[1:] &= space[:-1]
+      ends = np.flatnonzero(chars == 10)
+      fields = np.diff(np.concatenate(([0], np.cumsum(starts)[ends])))
+      nfields = fields[0] if len(fields) else 0
+      if len(fields) and (fields == nfields).all() and nfields > max(columns):
+         if max_fields is not None and nfields > max_fields:
+            return np.zeros((0, len(columns)))
+         values = np.fromstring(text, sep=' ')
+         if values.size == len(fields) * nfields:
+            return values.reshape((len(fields), nfields))[:,columns]
+   return _parse_lines(text.splitlines(), columns, delimiter, max_fields)
+
+def read_columns(infile, columns, delimiter=None, read_size=READ_SIZE,
+                 limit=None, max_fields=None):
+   """
+   Generator of (n, len(columns)) arrays with the given (1-based) columns of
+   a data file, one block of lines at a time. If limit is given, only that
+   many bytes are read from the current position of the file. If max_fields
+   is given, lines with more fields than that are skipped
+   """
+   columns = [col - 1 for col in columns]
+   rest = ''
+   while limit is None or limit > 0:
+      if limit is None: chunk = infile.read(read_size)
+      else:
+         chunk = infile.read(min(read_size, limit))
+         limit -= len(chunk)
+      if not chunk: break
+      chunk = rest + chunk
+      end = chunk.rfind('\n') + 1
+      rest = chunk[end:]
+      if end: yield _parse_block(chunk[:end], columns, delimiter, max_fields)
+   if rest: yield _parse_block(rest + '\n', columns, delimiter, max_fields)
+
+def load_columns(infile, columns, delimiter=None):
+   """ Loads the given (1-based) columns of a data file into an array """
+   blocks = list(read_columns(infile, columns, delimiter))
+   if not blocks: return np.zeros((0, len(columns)))
+   return np.concatenate(blocks)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def default_range(values):
+   """ The default histogram range of a data set: [floor(min), ceil(max)] """
+   return [math.floor(values.min()), math.ceil(values.max())]
+
+def scott_bins(values, lo, hi):
+   """ Number of bins in [lo, hi] from "Scott's Choice" for the bin width """
+   width = 3.5 * values.std() / len(values) ** (1/3)
+   return int(math.ceil((hi - lo) / width))
+
+class ColumnStats(object):
+   """
+   Running minimum, maximum, mean and variance of each column of a data set
+   fed a block at a time, so default ranges and bin counts can be chosen for
+   data that never sits in memory all at once
+   """
+
+   def __init__(self, ncols):
+      self.n = 0
+      self.min = np.empty(ncols); self.min.fill(np.inf)
+      self.max = np.empty(ncols); self.max.fill(-np.inf)
+      self.mean = np.zeros(ncols)
+      self.m2 = np.zeros(ncols)   # sum of squared deviations from the mean
+
+   def update(self, block):
+      """ Adds an (n, ncols) block of data """
+      if len(block) == 0: return
+      other = ColumnStats(block.shape[1])
+      other.n = len(block)
+      other.min, other.max = block.min(axis=0), block.max(axis=0)
+      other.mean = block.mean(axis=0)
+      other.m2 = ((block - other.mean) ** 2).sum(axis=0)
+      self.merge(other)
+
+   def merge(self, other):
+      """ Combines the statistics of another data set into these """
+      if other.n == 0: return
+      n = self.n + other.n
+      delta = other.mean - self.mean
+      self.m2 = self.m2 + other.m2 + delta * delta * self.n * other.n / n
+      self.mean = self.mean + delta * other.n / n
+      self.min = np.minimum(self.min, other.min)
+      self.max = np.maximum(self.max, other.max)
+      self.n = n
+
+   def default_range(self, col):
+      """ [floor(min), ceil(max)] of a column """
+      return [math.floor(self.min[col]), math.ceil(self.max[col])]
+
+   def scott_bins(self, col, lo, hi):
+      """ Number of bins in [lo, hi] from "Scott's Choice" for a column """
+      width = 3.5 * math.sqrt(self.m2[col] / self.n) / self.n ** (1/3)
+      return int(math.ceil((hi - lo) / width))
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class Histogram(object):
+   """
+   An N-dimensional histogram on a regular grid. Points are added with add;
+   the (weighted) counts are kept in the flat array counts, with the last
+   dimension varying fastest:
+      ranges:   [(lo, hi), ...] for each dimension
+      bins:     number of bins in each dimension
+      periodic: which dimensions wrap around (default none)
+      numpy_edges: find bins by searching the bin edges the way numpy's
+               histogram functions do, rather than by flooring (x-lo)/width.
+               The two differ for points within rounding of an inner edge
+   Points outside the range of a non-periodic dimension are discarded. The
+   upper edge of the range belongs to the last bin
+   """
+
+   #================================================
+
+   def __init__(self, ranges, bins, periodic=None, numpy_edges=False):
+      self.lo = np.array([r[0] for r in ranges], float)
+      self.hi = np.array([r[1] for r in ranges], float)
+      self.bins = np.array(bins, int)
+      if len(self.bins) != len(self.lo):
+         raise BinningError('Need a number of bins for each dimension!')
+      if (self.bins < 1).any() or (self.hi <= self.lo).any():
+         raise BinningError('Bad histogram bins or range!')
+      if periodic is None: periodic = [False] * len(self.bins)
+      self.periodic = np.array(periodic, bool)
+      self.width = (self.hi - self.lo) / self.bins
+      self.numpy_edges = numpy_edges
+      self.counts = np.zeros(int(np.prod(self.bins)))
+      self.npoints = 0        # number of points added
+      self.total_weight = 0.0 # total weight of points added
+      self.discarded = 0      # number of points outside the range
+
+   #================================================
+
+   @property
+   def ndim(self):
+      return len(self.bins)
+
+   #================================================
+
+   def bin_indices(self, points):
+      """
+      Returns the flat bin index of each point (an (n, ndim) array, or a 1-D
+      array for 1-D histograms), or -1 for points outside the range
+      """
+      points = np.asarray(points, float).reshape((-1, self.ndim))
+      span = self.hi - self.lo
+      if self.periodic.any():
+         points = points.copy()
+         for dim in np.flatnonzero(self.periodic):
+            points[:,dim] = self.lo[dim] + np.mod(points[:,dim] - self.lo[dim],
+                                                  span[dim])
+      keep = np.all((points >= self.lo) & (points <= self.hi), axis=1)
+      if self.numpy_edges:
+         index = np.empty(points.shape, int)
+         for dim in range(self.ndim):
+            edges = np.linspace(self.lo[dim], self.hi[dim], self.bins[dim]+1)
+            index[:,dim] = np.searchsorted(edges, points[:,dim], 'right') - 1
+      else:
+         index = np.floor((points - self.lo) / self.width).astype(int)
+      # Points on (or rounded up to) the upper edge go in the last bin
+      index = np.minimum(np.maximum(index, 0), self.bins - 1)
+      flat = np.zeros(len(points), int)
+      for dim in range(self.ndim):
+         flat = flat * self.bins[dim] + index[:,dim]
+      flat[~keep] = -1
+      return flat
+
+   #================================================
+
+   def add(self, points, weights=None):
+      """ Bins a set of points, each with an optional weight """
+      flat = self.bin_indices(points)
+      keep = flat >= 0
+      self.npoints += len(flat)
+      self.discarded += len(flat) - keep.sum()
+      if weights is None:
+         self.total_weight += len(flat)
+         self.counts += np.bincount(flat[keep], minlength=len(self.counts))
+      else:
+         weights = np.asarray(weights, float)
+         self.total_weight += weights.sum()
+         self.counts += np.bincount(flat[keep], weights[keep],
+                                    minlength=len(self.counts))
+
+   #================================================
+
+   def merge(self, other):
+      """ Adds the points of another histogram on the same grid to this one """
+      if not ((self.bins == other.bins).all() and (self.lo == other.lo).all()
+              and (self.hi == other.hi).all()
+              and self.numpy_edges == other.numpy_edges):
+         raise BinningError('Cannot merge histograms on different grids!')
+      self.counts += other.counts
+      self.npoints += other.npoints
+      self.total_weight += other.total_weight
+      self.discarded += other.discarded
+
+   #================================================
+
+   def values(self, normalize=False):
+      """
+      The histogram values in flat order. With normalize, they are divided by
+      the total weight of all points added (including discarded ones) and by
+      the volume of a bin, so they form a probability density
+      """
+      if not normalize: return self.counts.copy()
+      volume = self.total_weight
+      for span in self.hi - self.lo: volume *= span
+      return self.counts * (1.0 / (volume / np.prod(self.bins)))
+
+   #================================================
+
+   def bin_starts(self, dim):
+      """
+      The lower edge of each bin along a dimension, accumulated one bin
+      width at a time from the bottom of the range
+      """
+      steps = np.empty(self.bins[dim])
+      steps[0] = self.lo[dim]
+      steps[1:] = self.width[dim]
+      return np.add.accumulate(steps)
+
+   #================================================
+
+   def write(self, outfile, normalize=False):
+      """
+      Writes the histogram for plotting with gnuplot: one line per bin with
+      the lower edge in each dimension followed by the value, with a blank
+      line whenever any but the last dimension changes. Empty bins are
+      written as 0
+      """
+      vals = self.values(normalize)
+      text = np.array(['0' if count == 0 else str(float(val))
+                       for count, val in zip(self.counts, vals)], object)
+      for dim in range(self.ndim-1, -1, -1):
+         edges = np.array([str(float(e)) for e in self.bin_starts(dim)],
+                          object)
+         repeat = int(np.prod(self.bins[dim+1:]))
+         tile = int(np.prod(self.bins[:dim]))
+         text = np.tile(np.repeat(edges, repeat), tile) + ' ' + text
+      text = text + '\n'
+      if self.ndim > 1:
+         # Blank line after every row of the last dimension but the final one
+         text[self.bins[-1]-1:-1:self.bins[-1]] += '\n'
+      outfile.write(''.join(text))
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+# Streaming mode: data files are read a block at a time and never held in
+# memory. Files (or byte ranges of large files) are handed to worker processes
+# whose results are merged, so the memory use does not depend on the amount
+# of data. A file name of '-' is standard input, which can only be read once
+# (so needs explicit ranges and bins) and is not split up.
+
+def file_shards(fname, nshards):
+   """
+   Splits a file into (fname, start, end) byte ranges of whole lines, about
+   nshards of them of similar size
+   """
+   if fname == '-': return [(fname, 0, None)]
+   size = os.path.getsize(fname)
+   bounds = [0]
+   fil = open(fname, 'r')
+   for i in range(1, nshards):
+      fil.seek(max(size * i // nshards - 1, bounds[-1]))
+      fil.readline()
+      bounds.append(min(fil.tell(), size))
+   fil.close()
+   bounds.append(size)
+   return [(fname, start, end) for start, end in zip(bounds[:-1], bounds[1:])
+           if end > start]
+
+def _read_shard(shard, columns, delimiter, max_fields):
+   """ Generator of the data blocks in a shard from file_shards """
+   fname, start, end = shard
+   if fname == '-':
+      for block in read_columns(sys.stdin, columns, delimiter,
+                                max_fields=max_fields):
+         yield block
+      return
+   fil = open(fname, 'r')
+   fil.seek(start)
+   for block in read_columns(fil, columns, delimiter, limit=end-start,
+                             max_fields=max_fields):
+      yield block
+   fil.close()
+
+def _scan_shard(args):
+   """ ColumnStats of one shard (run in the worker processes) """
+   shard, columns, delimiter, max_fields = args
+   stats = ColumnStats(len(columns))
+   for block in _read_shard(shard, columns, delimiter, max_fields):
+      stats.update(block)
+   return stats
+
+def _histogram_shard(args):
+   """ Histogram of one shard (run in the worker processes) """
+   (shard, columns, weight_column, delimiter, max_fields, ranges, bins,
+    periodic, numpy_edges) = args
+   hist = Histogram(ranges, bins, periodic, numpy_edges)
+   if weight_column is not None: columns = columns + [weight_column]
+   for block in _read_shard(shard, columns, delimiter, max_fields):
+      if weight_column is None: hist.add(block)
+      else: hist.add(block[:,:-1], block[:,-1])
+   return hist
+
+def _map_shards(func, fnames, args, nproc):
+   """
+   Runs func over the shards of every file (split nproc ways) in nproc
+   processes and returns the results
+   """
+   shards = []
+   for fname in fnames:
+      shards.extend(file_shards(fname, nproc))
+   jobs = [(shard,) + args for shard in shards]
+   if nproc <= 1 or len(jobs) == 1:
+      return [func(job) for job in jobs]
+   from multiprocessing import Pool
+   pool = Pool(min(nproc, len(jobs)))
+   try:
+      return pool.map(func, jobs, 1)
+   finally:
+      pool.terminate()
+
+def scan_files(fnames, columns, delimiter=None, nproc=1, max_fields=None):
+   """
+   ColumnStats of the given (1-based) columns of a set of data files,
+   skipping lines with more than max_fields fields if it is given
+   """
+   stats = ColumnStats(len(columns))
+   for other in _map_shards(_scan_shard, fnames,
+                            (columns, delimiter, max_fields), nproc):
+      stats.merge(other)
+   return stats
+
+def histogram_files(fnames, columns, ranges, bins, periodic=None,
+                    weight_column=None, delimiter=None, nproc=1,
+                    max_fields=None, numpy_edges=False):
+   """
+   Histograms the given (1-based) columns of a set of data files in nproc
+   processes without loading the data into memory, optionally weighting each
+   point by the value in weight_column and skipping lines with more than
+   max_fields fields. Returns the merged Histogram (see Histogram for
+   numpy_edges)
+   """
+   hist = Histogram(ranges, bins, periodic, numpy_edges)
+   for other in _map_shards(_histogram_shard, fnames,
+                            (list(columns), weight_column, delimiter,
+                             max_fields, ranges, bins, periodic, numpy_edges),
+                            nproc):
+      hist.merge(other)
+   return hist
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+# Binned kernel density estimation: the samples are linearly binned onto a fine
+# regular grid, which is convolved with a Gaussian kernel by FFT. The density
+# anywhere is interpolated from the grid. The cost is O(N + G log G) for N
+# samples on a G-point grid, rather than O(N) per evaluation point
+
+# Kernel extends this many bandwidths from each sample
+KDE_CUTOFF = 6.0
+# Grid points per bandwidth, and the most grid points to use
+KDE_GRID_DENSITY = 50
+KDE_MAX_GRID = 1 << 22
+
+def kde_factor(n, method='scott'):
+   """
+   Bandwidth factor (kernel width in units of the sample standard deviation)
+   for n samples by Scott's or Silverman's rule, as scipy's gaussian_kde
+   """
+   if method == 'scott': return n ** (-1/5)
+   if method == 'silverman': return (n * 3 / 4) ** (-1/5)
+   raise BinningError('Unknown bandwidth method %s' % method)
+
+def linear_binning(data, lo, delta, npts, weights=None):
+   """
+   Spreads each point (with its weight) between the two grid points lo+i*delta
+   on either side of it, in proportion to its distance to the other one. All
+   points must lie on the grid
+   """
+   pos = (np.asarray(data, float) - lo) / delta
+   left = np.minimum(np.floor(pos).astype(int), npts - 2)
+   right = pos - left
+   if weights is None: weights = np.ones(len(pos))
+   return np.bincount(left, weights * (1 - right), minlength=npts) + \
+          np.bincount(left + 1, weights * right, minlength=npts)
+
+class BinnedKDE(object):
+   """
+   Gaussian kernel density estimate of 1-D data evaluated from a linearly
+   binned, FFT-convolved grid:
+      factor:  bandwidth as a multiple of the sample standard deviation
+               (default from method, 'scott' or 'silverman')
+      reflect: optional (lo, hi) bounds of the data; samples near a bound are
+               reflected about it so no density leaks past it
+   The interface mimics scipy.stats.gaussian_kde (factor, evaluate)
+   """
+
+   def __init__(self, data, factor=None, method='scott', reflect=None):
+      data = np.asarray(data, float).ravel()
+      if len(data) < 2:
+         raise BinningError('Need at least 2 points for a KDE!')
+      self.n = len(data)
+      if factor is None: factor = kde_factor(self.n, method)
+      self.factor = factor
+      self.bandwidth = factor * data.std(ddof=1)
+      if not self.bandwidth > 0:
+         raise BinningError('Data has no spread to estimate a bandwidth from!')
+      self.reflect = reflect
+      cutoff = KDE_CUTOFF * self.bandwidth
+      if reflect is not None:
+         lo, hi = reflect
+         data = np.concatenate((data, 2 * lo - data[data - lo < cutoff],
+                                2 * hi - data[hi - data < cutoff]))
+
+      # Grid covering every sample plus the reach of its kernel
+      start = data.min() - cutoff
+      span = data.max() + cutoff - start
+      npts = int(min(math.ceil(span / self.bandwidth * KDE_GRID_DENSITY) + 1,
+                     KDE_MAX_GRID))
+      delta = span / (npts - 1)
+      counts = linear_binning(data, start, delta, npts)
+
+      # Convolve with the kernel sampled out to the cutoff
+      nkern = int(min(math.ceil(cutoff / delta), npts - 1))
+      offsets = np.arange(-nkern, nkern + 1) * delta
+      kernel = np.exp(-0.5 * (offsets / self.bandwidth) ** 2)
+      size = 1
+      while size < npts + 2 * nkern: size *= 2
+      conv = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size),
+                          size)[nkern:nkern+npts]
+      norm = self.n * self.bandwidth * math.sqrt(2 * math.pi)
+      self.grid = start + np.arange(npts) * delta
+      self.density = np.maximum(conv, 0) / norm
+
+   def evaluate(self, points):
+      """ Density at each of the given points """
+      points = np.atleast_1d(np.asarray(points, float))
+      density = np.interp(points, self.grid, self.density, left=0, right=0)
+      if self.reflect is not None:
+         density[(points < self.reflect[0]) | (points > self.reflect[1])] = 0
+      return density
+
+   __call__ = evaluate
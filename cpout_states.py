@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+This module reads constant pH cpout files (plain or gzipped) into a compact
+protonation state matrix: one uint8 row per record (frame) and one column per
+titratable residue, along with the solvent pH, MD step and time of every
+frame and whether its record was a full or a delta record. Delta records are
+expanded by carrying the states of the residues they do not list forward from
+the previous frame.
+
+The matrix can be saved to a binary file that is loaded back as memory maps,
+so analyses (fraction protonated, running averages, correlations) reduce over
+arrays rather than re-scanning the cpout text.
+"""
+
+import re, struct, gzip
+import numpy as np
+from remake_cpouts import CpoutSplitter, CpoutError, READ_SIZE
+
+# Number of records parsed and expanded at once
+BLOCK_SIZE = 10000
+
+# Binary state matrix file: magic, number of frames, number of residues, then
+# the (nframes, nres) uint8 states followed by the per-frame arrays
+MAGIC = 'CPSTATE1'
+HEADER = struct.Struct('<8sqq')
+FRAME_ARRAYS = (('pH', np.float64), ('step', np.int64), ('time', np.float64),
+                ('full', np.bool_))
+
+# Marks a residue whose state is not known yet
+NO_STATE = 255
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+def open_cpout(fname):
+   " Opens a cpout file for reading, decompressing it if it is gzipped "
+   fil = open(fname, 'rb')
+   magic = fil.read(2)
+   fil.close()
+   if magic == '\x1f\x8b': return gzip.open(fname, 'rb')
+   return open(fname, 'r')
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+class StateMatrix(object):
+   """ Protonation states of every titratable residue at every frame:
+         states: (nframes, nres) uint8 array of state indices
+         pH:     solvent pH of each frame
+         step:   MD step of each frame
+         time:   time (ps) of each frame
+         full:   True for frames read from a full record
+   """
+
+   #======================================================
+
+   def __init__(self, states, pH, step, time, full):
+      self.states = states
+      self.pH = pH
+      self.step = step
+      self.time = time
+      self.full = full
+
+   #======================================================
+
+   @property
+   def nframes(self):
+      return self.states.shape[0]
+
+   #======================================================
+
+   @property
+   def nres(self):
+      return self.states.shape[1]
+
+   #======================================================
+
+   def populations(self, nstates=None):
+      """ Returns an (nres, nstates) array with the number of frames each
+          residue spent in each state. Frames before a residue's state is
+          first known (NO_STATE) are not counted
+      """
+      if nstates is None:
+         known = self.states[self.states != NO_STATE]
+         nstates = int(known.max()) + 1 if known.size else 0
+      counts = np.zeros((self.nres, nstates), int)
+      for i in range(self.nres):
+         column = self.states[:,i]
+         counts[i] = np.bincount(column[column != NO_STATE],
+                                 minlength=nstates)[:nstates]
+      return counts
+
+   #======================================================
+
+   def fraction_in(self, residue, states):
+      """ Returns the fraction of frames the given residue spent in any of the
+          given states (e.g., its protonated states)
+      """
+      return np.in1d(self.states[:,residue], states).mean()
+
+   #======================================================
+
+   def save(self, fname):
+      " Writes the state matrix to a binary file readable by load_states "
+      out = open(fname, 'wb')
+      out.write(HEADER.pack(MAGIC, self.nframes, self.nres))
+      out.write(np.ascontiguousarray(self.states, np.uint8).tostring())
+      for name, dtype in FRAME_ARRAYS:
+         out.write(np.asarray(getattr(self, name), dtype).tostring())
+      out.close()
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+def load_states(fname, mmap=True):
+   """ Loads a state matrix written by StateMatrix.save. With mmap, the arrays
+       are read-only memory maps of the file rather than copies in memory
+   """
+   fil = open(fname, 'rb')
+   magic, nframes, nres = HEADER.unpack(fil.read(HEADER.size))
+   if magic != MAGIC:
+      raise CpoutError('%s is not a protonation state matrix file' % fname)
+   arrays = []
+   offset = HEADER.size
+   for dtype, shape in [(np.uint8, (nframes, nres))] + \
+                       [(dtype, (nframes,)) for name, dtype in FRAME_ARRAYS]:
+      count = int(np.prod(shape))
+      if mmap and count:
+         arrays.append(np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                                 shape=shape))
+      else:
+         fil.seek(offset)
+         arrays.append(np.fromfile(fil, dtype, count).reshape(shape))
+      offset += count * np.dtype(dtype).itemsize
+   fil.close()
+   return StateMatrix(*arrays)
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+class _CpoutParser(object):
+   """ Parses blocks of cpout records into expanded state rows, carrying the
+       current states, pH, step and time from one block (and file) to the next
+   """
+
+   full_re = re.compile(r'Solvent pH: *([+-]?\d+\.\d+)\s+'
+                        r'Monte Carlo step size: *(\d+)\s+'
+                        r'Time step: *(\d+)\s+'
+                        r'Time: *([+-]?\d+\.\d+)')
+   res_re = re.compile(r'Residue *(\d+) State: *(\d+)(?: pH: *([+-]?\d+\.\d+))?')
+
+   #======================================================
+
+   def __init__(self):
+      self.fname = None   # file being parsed, for error messages
+      self.last = None    # states of the last frame
+      self.pH = 0.0
+      self.mcstep = 0
+      self.step = 0
+      self.time = 0.0
+      self.dt = None      # time per MD step, from the first full record
+
+   #======================================================
+
+   def error(self, msg):
+      " Returns a CpoutError naming the file being parsed "
+      if self.fname is None: return CpoutError(msg)
+      return CpoutError('%s: %s' % (self.fname, msg))
+
+   #======================================================
+
+   def parse(self, records):
+      """ Returns the states (len(records), nres) and the per-frame arrays of
+          a list of record texts
+      """
+      nrec = len(records)
+      pH, step, time = np.zeros(nrec), np.zeros(nrec, int), np.zeros(nrec)
+      full = np.zeros(nrec, bool)
+      frames, residues, states = [], [], []
+      for i, record in enumerate(records):
+         match = self.full_re.search(record)
+         if match:
+            self.pH = float(match.group(1))
+            self.mcstep = int(match.group(2))
+            self.step = int(match.group(3))
+            self.time = float(match.group(4))
+            if self.dt is None and self.step > 0:
+               self.dt = self.time / self.step
+            full[i] = True
+         else:
+            self.step += self.mcstep
+            if self.dt is not None: self.time += self.mcstep * self.dt
+         entries = self.res_re.findall(record)
+         if not entries and not match:
+            raise self.error('Did not find expected line in cpout record!')
+         # pH-REMD cpouts print the pH on every residue line
+         if entries and entries[0][2]: self.pH = float(entries[0][2])
+         pH[i], step[i], time[i] = self.pH, self.step, self.time
+         frames.extend([i] * len(entries))
+         residues.extend([e[0] for e in entries])
+         states.extend([e[1] for e in entries])
+      frames = np.array(frames, int)
+      residues = np.array(residues, int)
+      states = np.array(states, int)
+
+      # The first full record lists every titratable residue
+      if self.last is None:
+         if not full[0]:
+            raise self.error('First cpout record is not a full record!')
+         if not len(frames) or frames[0] != 0:
+            raise self.error('First cpout record lists no residues!')
+         self.last = np.empty(residues[frames == 0].max() + 1, np.uint8)
+         self.last.fill(NO_STATE)
+      nres = len(self.last)
+      if len(residues) and residues.max() >= nres:
+         raise self.error('Residue %d not in the first full record!' %
+                          residues.max())
+
+      # Row 0 is the last frame of the previous block; fill forward from it
+      block = np.empty((nrec + 1, nres), np.uint8)
+      block.fill(NO_STATE)
+      block[0] = self.last
+      block[frames + 1, residues] = states
+      rows = np.where(block != NO_STATE, np.arange(nrec + 1)[:,np.newaxis], 0)
+      np.maximum.accumulate(rows, axis=0, out=rows)
+      block = block[rows, np.arange(nres)[np.newaxis,:]]
+      self.last = block[-1].copy()
+      return block[1:], pH, step, time, full
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+def read_cpouts(fnames, output=None, block_size=BLOCK_SIZE, read_size=READ_SIZE):
+   """ Reads one or more (optionally gzipped) cpout files, in order, into a
+       StateMatrix. If output is given, the state matrix is written there
+       block by block (so it never has to fit in memory) and returned as
+       memory maps of that file
+   """
+   if isinstance(fnames, basestring): fnames = [fnames]
+   parser = _CpoutParser()
+   blocks = []
+   frame_arrays = [[] for name, dtype in FRAME_ARRAYS]
+   nframes = 0
+   out = None
+   if output is not None:
+      out = open(output, 'wb')
+      out.write(HEADER.pack(MAGIC, 0, 0))
+   try:
+      for fname in fnames:
+         fil = open_cpout(fname)
+         parser.fname = fname
+         splitter = CpoutSplitter(fil, read_size)
+         while True:
+            records = splitter.get_records(block_size)
+            if not records: break
+            parsed = parser.parse(records)
+            if out is None: blocks.append(parsed[0])
+            else: out.write(parsed[0].tostring())
+            for arrays, array in zip(frame_arrays, parsed[1:]):
+               arrays.append(array)
+            nframes += len(records)
+         fil.close()
+      if parser.last is None:
+         raise CpoutError('No cpout records found!')
+      frame_arrays = [np.concatenate(arrays).astype(dtype) for arrays, (name,
+                      dtype) in zip(frame_arrays, FRAME_ARRAYS)]
+      if out is None:
+         return StateMatrix(np.concatenate(blocks), *frame_arrays)
+      for array in frame_arrays:
+         out.write(array.tostring())
+      out.seek(0)
+      out.write(HEADER.pack(MAGIC, nframes, len(parser.last)))
+   finally:
+      if out is not None: out.close()
+   return load_states(output)
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+if __name__ == '__main__':
+   from optparse import OptionParser
+   import sys
+
+   parser = OptionParser(usage='%prog [options] cpout1 [cpout2 ...]')
+   parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                     help='Binary state matrix file to write', default=None)
+   parser.add_option('-b', '--block-size', dest='block_size', type='int',
+                     default=BLOCK_SIZE, metavar='INT',
+                     help='Number of records to expand at once. Default %d' %
+                     BLOCK_SIZE)
+   parser.add_option('-p', '--populations', dest='populations', default=False,
+                     action='store_true', help='Print the fraction of frames ' +
+                     'each residue spent in each state')
+
+   opt, args = parser.parse_args()
+
+   if not args or not (opt.output or opt.populations):
+      parser.print_help()
+      sys.exit(1)
+
+   matrix = read_cpouts(args, opt.output, opt.block_size)
+
+   print 'Read %d frames of %d residues (%d full records)' % (matrix.nframes,
+            matrix.nres, matrix.full.sum())
+
+   if opt.populations:
+      counts = matrix.populations()
+      # Fractions of the frames in which each residue's state is known
+      fractions = counts / np.maximum(counts.sum(axis=1), 1).astype(float)[:,
+                                                                  np.newaxis]
+      print 'Residue' + ''.join(['%8s' % ('State %d' % i)
+                                 for i in range(counts.shape[1])])
+      for i, row in enumerate(fractions):
+         print '%7d' % i + ''.join(['%8.4f' % f for f in row])
@@ -6,6 +6,9 @@ from __future__ import division
 import numpy as np
 import math
 import sys
+
+# Number of values parsed from a file before they are copied into a DataBuffer
+CHUNK_SIZE = 65536
    
 class DatasetError(Exception):
    """ If you gave a bad parameter... """
@@ -41,36 +44,75 @@ class DataSet(np.ndarray):
       if not hasattr(ofile, 'write'):
          raise TypeError("ofile must be of type 'str' or derived from 'file'!")
 
+      self._check_interval(interval)
+
+      # Calculate our total histogram if we haven't already
+      if not hasattr(self, 'tot_dist'):
+         self._finalhist()
+
+      for i, kl in self.iter_kullback_leibler(interval):
+         ofile.write("%d %g\n" % (i, kl))
+
+      if close_file_after: ofile.close()
+
+   def _check_interval(self, interval):
+      """
+      Makes sure interval is usable for Kullback-Leibler analysis of this data
+      set and that the histogram parameters are set
+      """
+      if type(interval).__name__ != 'int':
+         raise TypeError("interval expected to be an integer!")
+
+      if interval < 1:
+         raise DatasetError("interval (%d) must be positive!" % interval)
+
       if interval > self.size:
          raise DatasetError("interval (%d) is larger than my size (%d)!" %
-                            interval, self.size)
+                            (interval, self.size))
       
       # Make sure we set up our histogram preferences
       if not hasattr(self, 'hmin'):
          raise DatasetError("Histogram parameters are not set!")
 
-      # Calculate our total histogram if we haven't already
+   def iter_kullback_leibler(self, interval):
+      """
+      Generator for the Kullback-Leibler divergence of the first i*interval
+      points from the final distribution, yielding (i, divergence) for each
+      interval and finally for the whole data set. The histogram of the
+      growing portion is updated with only the newest 'interval' points, so
+      the total cost is linear in the size of the data set
+      """
       if not hasattr(self, 'tot_dist'):
          self._finalhist()
 
-      if type(interval).__name__ != 'int':
-         raise TypeError("interval expected to be an integer!")
+      counts = np.zeros(self.nbins, int)
+      nintervals = (self.size-1) // interval
+      for i in range(1, nintervals+1):
+         counts += self._bin_counts(self[(i-1)*interval:i*interval])
+         yield i, _kull_leib(self._density(counts), self.tot_dist[0])
+      counts += self._bin_counts(self[nintervals*interval:])
+      yield nintervals+1, _kull_leib(self._density(counts), self.tot_dist[0])
 
-      for i in range(1, (self.size-1) // interval+1):
-         hist = np.histogram(self[:i*interval],
-                             bins=self.nbins,
-                             range=(self.hmin, self.hmax),
-                             weights=None,
-                             density=self.norm)
-         ofile.write("%d %g\n" % (i, _kull_leib(hist[0], self.tot_dist[0])))
-      hist = np.histogram(self[:],
-                          bins=self.nbins,
-                          range=(self.hmin, self.hmax),
-                          weights=None,
-                          density=self.norm)
-      ofile.write("%d %g\n" % (i+1, _kull_leib(hist[0], self.tot_dist[0])))
+   def _bin_counts(self, values):
+      """
+      Histograms values into the bins from set_hist_params, assigning values
+      on (or within rounding of) bin edges the same way np.histogram does
+      """
+      edges = self.tot_dist[1]
+      values = np.asarray(values, dtype=edges.dtype)
+      values = values[(values >= edges[0]) & (values <= edges[-1])]
+      scale = self.nbins / (edges[-1] - edges[0])
+      indices = ((values - edges[0]) * scale).astype(np.intp)
+      indices[indices == self.nbins] -= 1
+      indices[values < edges[indices]] -= 1
+      indices[(values >= edges[indices+1]) & (indices != self.nbins-1)] += 1
+      return np.bincount(indices, minlength=self.nbins)
 
-      if close_file_after: ofile.close()
+   def _density(self, counts):
+      """ Converts bin counts to a histogram like np.histogram would """
+      if not self.norm: return counts
+      widths = np.array(np.diff(self.tot_dist[1]), float)
+      return counts / widths / counts.sum()
 
    def set_hist_params(self, hmin=None, hmax=None, nbins=None, spacing=None,
                        norm=True):
@@ -114,18 +156,33 @@ class DataSet(np.ndarray):
                                    weights=None,
                                    density=self.norm)
    def append(self, val):
-      """ Adds a new element to the array """
+      """
+      Adds a new element to the array. This reallocates the array every time,
+      so use extend or a DataBuffer to add many values
+      """
       # Assume it is a float, to save time
       self.resize(self.size+1, refcheck=False)
       self[self.size-1] = val
 
+   def extend(self, values):
+      """ Adds a sequence, iterable or array of values with one reallocation """
+      values = _as_values(values)
+      start = self.size
+      self.resize(start+values.size, refcheck=False)
+      self[start:] = values
+
    def add_value(self, val):
-      """ Add a float to my array """
+      """
+      Add a float to my array after the last one added (counter). If the
+      array is full, its size is doubled; truncate returns just the values
+      that were added
+      """
       if not isinstance(val, float):
          raise TypeError('add_value expects a float!')
       if self.counter >= self.shape[0]:
-         raise IndexError('Cannot add_value to DataSet, out of bounds (%d)!' % 
-                          self.counter)
+         counter = self.counter
+         self.resize(max(2*self.shape[0], 16), refcheck=False)
+         self.counter = counter
       self[self.counter] = val
       self.counter += 1
 
@@ -133,6 +190,55 @@ class DataSet(np.ndarray):
       """ Get rid of everything after counter """
       return np.resize(self, self.counter)
 
+class DataBuffer(object):
+   """
+   Growable storage for building a DataSet one value (or block of values) at
+   a time. The capacity doubles whenever it runs out, so adding N values costs
+   O(N) rather than the O(N^2) of growing a DataSet one element at a time
+   """
+
+   def __init__(self, capacity=1024):
+      self.data = DataSet(max(capacity, 1))
+      self.length = 0
+
+   def __len__(self):
+      return self.length
+
+   def _reserve(self, length):
+      """ Makes sure there is room for length values """
+      if length <= self.data.size: return
+      self.data.resize(max(length, 2*self.data.size), refcheck=False)
+
+   def append(self, val):
+      """ Adds a single value """
+      self._reserve(self.length+1)
+      self.data[self.length] = val
+      self.length += 1
+
+   def extend(self, values):
+      """ Adds a sequence, iterable or array of values """
+      values = _as_values(values)
+      self._reserve(self.length+values.size)
+      self.data[self.length:self.length+values.size] = values
+      self.length += values.size
+
+   def dataset(self):
+      """
+      Returns the values added so far as a DataSet. The storage is trimmed in
+      place and handed over, so the buffer is empty afterwards
+      """
+      ret = self.data
+      ret.resize(self.length, refcheck=False)
+      self.data = DataSet(1)
+      self.length = 0
+      return ret
+
+def _as_values(values):
+   """ Converts a sequence, iterable or array into a 1-D float array """
+   if isinstance(values, (np.ndarray, list, tuple)):
+      return np.asarray(values, float).ravel()
+   return np.fromiter(values, float)
+
 def _kull_leib(hist1, hist2):
    """ 
    Integrates two histograms hist1 and hist2 according to the formula shown
@@ -141,22 +247,50 @@ def _kull_leib(hist1, hist2):
    if hist1.size != hist2.size:
       raise DatasetError("Cannot integrate distributions of different sizes!")
 
-   runsum = 0.0
-   for i in range(hist1.size):
-      if hist1[i] == 0 or hist2[i] == 0: continue
-      runsum += hist1[i] * math.log(hist1[i]/hist2[i])
+   hist1, hist2 = np.asarray(hist1, float), np.asarray(hist2, float)
+   use = (hist1 != 0) & (hist2 != 0)
+   return float(np.sum(hist1[use] * np.log(hist1[use] / hist2[use])))
 
-   return runsum
+def multi_kullback_leibler(datasets, interval, ofile=sys.stdout):
+   """
+   Kullback-Leibler convergence of several DataSets (e.g., columns of the
+   same file) in one pass, writing one line per interval with the interval
+   number followed by the divergence of each data set. The data sets must all
+   be the same size so their intervals line up
+   """
+   if len(set([data.size for data in datasets])) > 1:
+      raise DatasetError("Data sets must all be the same size!")
+   for data in datasets:
+      data._check_interval(interval)
+   for results in zip(*[data.iter_kullback_leibler(interval)
+                        for data in datasets]):
+      ofile.write("%d " % results[0][0] +
+                  " ".join(["%g" % kl for i, kl in results]) + "\n")
 
 def load_from_file(infile, column):
    """ Loads a DataSet from a file """
-   ret = DataSet(0)
+   return load_columns_from_file(infile, [column])[0]
+
+def load_columns_from_file(infile, columns):
+   """
+   Loads a DataSet for each of several columns from a file in one pass. Lines
+   without a number in any of the columns are skipped for all of them, so the
+   data sets stay the same length and line up. Values are parsed into
+   fixed-size chunks that are copied into growable buffers
+   """
+   buffers = [DataBuffer(CHUNK_SIZE) for column in columns]
+   chunk = np.empty((CHUNK_SIZE, len(columns)))
+   count = 0
    for line in infile:
+      words = line.split()
       try:
-         val = float(line.split()[column-1])
+         chunk[count] = [float(words[column-1]) for column in columns]
       except IndexError: continue
       except ValueError: continue
-      ret.resize(ret.size+1, refcheck=False)
-      ret[ret.size-1] = val
+      count += 1
+      if count == CHUNK_SIZE:
+         for i, buf in enumerate(buffers): buf.extend(chunk[:,i])
+         count = 0
 
-   return ret
+   for i, buf in enumerate(buffers): buf.extend(chunk[:count,i])
+   return [buf.dataset() for buf in buffers]
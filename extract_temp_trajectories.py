@@ -4,13 +4,23 @@
 This program will take a list of REMD trajectory files and temperatures and it
 will extract temperature-specific trajectories from those trajectory files for
 each temperature provided.
+
+If the rem.log of the run is given, all of the trajectories are instead read
+together in a single pass through the coords readers and every frame is routed
+to its temperature's (or, with --by-replica, its replica's) output file using
+the exchange history in the log.
 """
 from optparse import OptionParser, OptionGroup
 from subprocess import Popen, PIPE
-import sys, time
+import numpy as np
+import sys, os, time
 
 start_time = time.time()
 
+# Largest amount of coordinate data (bytes) demultiplex holds at once when no
+# block size is given
+BLOCK_MEMORY = 1 << 28
+
 def which(program):
    import os
    def is_exe(fpath):
@@ -27,12 +37,81 @@ def which(program):
             return exe_file
    return None
 
+def frame_format(natom):
+   " Format string for one frame of an ASCII trajectory "
+   nval = natom * 3
+   fmt = ('%8.3f' * 10 + '\n') * (nval // 10)
+   if nval % 10: fmt += '%8.3f' * (nval % 10) + '\n'
+   return fmt
+
+def demultiplex(trajs, prmtop, routes, outnames, frames_per_exchange=1,
+                block_size=None, buffer_size=1<<20):
+   """ Reads all trajectories in lockstep in one pass and writes every frame
+       to the output it belongs to. routes is an (nexch, ntrajs) array giving,
+       for each exchange, the output index of each trajectory's frames (-1 to
+       drop them); frames past the last exchange follow its last row. Each
+       output must get exactly one trajectory's frames per exchange. Frames
+       are read block_size at a time from each trajectory; by default, as
+       many as fit in BLOCK_MEMORY bytes over all trajectories
+   """
+   import coords
+   readers = [coords.TrjClass(traj, prmtop) for traj in trajs]
+   lengths = [len(reader) for reader in readers]
+   nframes = min(lengths)
+   if max(lengths) != nframes:
+      print 'Warning: trajectories differ in length; using %d frames' % nframes
+   natom = len(readers[0][0])
+   fmt = frame_format(natom)
+   if block_size is None:
+      block_size = BLOCK_MEMORY // (len(readers) * natom * 3 * 8)
+   block_size = max(block_size, 1)
+   outputs = [open(name, 'w', buffer_size) for name in outnames]
+   for out in outputs: out.write('demultiplexed by extract_temp_trajectories.py\n')
+   ntrajs, nout = len(trajs), len(outnames)
+   for start in range(0, nframes, block_size):
+      n = min(block_size, nframes - start)
+      # One block per trajectory; never stacked into a single array
+      blocks = [reader.GetBlock(start, n) for reader in readers]
+      exch = np.minimum((start + np.arange(n)) // frames_per_exchange,
+                        len(routes) - 1)
+      # source[j, o] is the trajectory holding output o's frame j
+      source = -np.ones((n, nout), int)
+      rows = np.arange(n)[:,np.newaxis].repeat(ntrajs, axis=1)
+      cols = routes[exch]
+      keep = cols >= 0
+      source[rows[keep], cols[keep]] = np.tile(np.arange(ntrajs), (n, 1))[keep]
+      for o, out in enumerate(outputs):
+         have = np.flatnonzero(source[:,o] >= 0)
+         for j in have:
+            out.write(fmt % tuple(blocks[source[j,o]][j].ravel()))
+      del blocks
+   for out in outputs: out.close()
+   for reader in readers: reader.Close()
+   return nframes
+
 parser = OptionParser('usage: %prog [Options] mdcrd1 [mdcrd2 [mdcrd3 ...] ]')
 parser.add_option('--temperatures', dest='temp_list', help='Comma-separated ' +
                   'list of temperatures to extract trajectories for')
 parser.add_option('--prefix', dest='prefix', help='Prefix for trajectory ' +
                   'file names. They will be named PREFIX.temp.nc')
 parser.add_option('--prmtop', dest='prmtop', help='Prmtop for your system')
+group = OptionGroup(parser, 'Single-pass Options', 'If a REMLOG is given, ' +
+                    'the trajectories (one per replica, in replica order) ' +
+                    'are demultiplexed in one pass into ASCII trajectories ' +
+                    'named PREFIX.temp.crd')
+group.add_option('--remlog', dest='remlog', help='rem.log of the simulation')
+group.add_option('--frames-per-exchange', dest='nfpe', type='int', default=1,
+                 help='Number of trajectory frames written between ' +
+                 'exchanges. Default 1')
+group.add_option('--by-replica', dest='by_replica', default=False,
+                 action='store_true', help='The trajectories are one per ' +
+                 'temperature, in increasing order; write one trajectory ' +
+                 'per replica instead, named PREFIX.rep.NUM.crd')
+group.add_option('--block-size', dest='block_size', type='int', default=None,
+                 help='Number of frames read from each trajectory at once. ' +
+                 'Default is as many as fit in %d MB over all trajectories' %
+                 (BLOCK_MEMORY >> 20))
+parser.add_option_group(group)
 group = OptionGroup(parser, 'RMSd Options', 'If a REFSTRUCT is specified, ' +
                     'these options will be used to RMS fit a structure')
 group.add_option('--rmsd', dest='refstruct', help='Reference structure for ' +
@@ -45,10 +124,54 @@ group.add_option('--rmsd-output', dest='rmsout', default='rms',
 parser.add_option_group(group)
 opt,trajs = parser.parse_args()
 
-if not opt.temp_list or not opt.prefix or not opt.prmtop or not trajs:
+if not (opt.temp_list or opt.remlog) or not opt.prefix or not opt.prmtop or \
+      not trajs:
    parser.print_help()
    sys.exit(1)
 
+if opt.remlog:
+   try:
+      import coords
+   except ImportError:
+      sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'UCSB_Python_Mods'))
+   from remd import TempRemLog
+   if opt.refstruct:
+      print 'RMS fitting is only available without --remlog'
+      sys.exit(1)
+   remlog = TempRemLog(opt.remlog)
+   if len(trajs) != len(remlog.reps):
+      print 'Expected %d trajectories (one per replica), got %d' % (
+            len(remlog.reps), len(trajs))
+      sys.exit(1)
+   n = remlog.nexch
+   # Temperature index of each replica during each exchange's MD segment, and
+   # during the segment after the last exchange
+   states = np.vstack((remlog.index[:n],
+                       np.searchsorted(remlog.values, remlog.new_temp[n-1])))
+   if opt.by_replica:
+      # Input k holds temperature k; send it to the replica at that temperature
+      routes = np.argsort(states, axis=1)
+      outnames = ['%s.rep.%03d.crd' % (opt.prefix, i+1)
+                  for i in range(len(trajs))]
+   else:
+      routes = states.copy()
+      outnames = ['%s.%f.crd' % (opt.prefix, t) for t in remlog.values]
+      if opt.temp_list:
+         # Only write the requested temperatures
+         wanted = [float(t) for t in opt.temp_list.split(',')]
+         keep = [i for i, t in enumerate(remlog.values) if t in wanted]
+         newidx = -np.ones(len(remlog.values), int)
+         newidx[keep] = np.arange(len(keep))
+         routes = newidx[routes]
+         outnames = [outnames[i] for i in keep]
+   nframes = demultiplex(trajs, opt.prmtop, routes, outnames, opt.nfpe,
+                         opt.block_size)
+   print 'Demultiplexed %d frames from each of %d trajectories' % (nframes,
+                                                                   len(trajs))
+   print '\n\nThis took %f min.' % ((time.time() - start_time) / 60)
+   sys.exit(0)
+
 cpptraj = which('cpptraj')
 
 assert(cpptraj)
@@ -19,6 +19,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as pyplot
 import matplotlib.colors as colours
+import binning
 
 parser = OptionParser(usage="usage: %prog [options] <datafile>")
 
@@ -28,7 +29,8 @@ parser = OptionParser(usage="usage: %prog [options] <datafile>")
 parser.set_defaults(binsize=0.1, normalise=True, freeEnergy=False,
 	unicode=False, raw=False, temperature=None, xub=None, xlb=None,
 	xtickspacing=5.0, xlabel="X axis", yub=None, ylb=None,
-	ytickspacing=5.0, ylabel="Y axis", resolution=80.0)
+	ytickspacing=5.0, ylabel="Y axis", resolution=80.0, stream=False,
+	nproc=1)
 
 parser.add_option("-b", "--binsize", type="float", dest="binsize",
 	metavar="NUM", help="Width of each bin ( > 0) [default: 0.1]")
@@ -75,6 +77,14 @@ parser.add_option("--y-label", type="string", dest="ylabel", metavar="STRING",
 parser.add_option("--resolution", type="float", dest="resolution",
 	metavar="NUM",
 	help="Resolution of final image (dpi) [default: 80.0]")
+parser.add_option("--stream", action="store_true", dest="stream",
+	help="Histogram the data file in blocks without holding it in " + \
+	"memory. Unless all of the axis bounds are given, the file is " + \
+	"read twice. Lines without 2 or 3 fields are skipped as usual, " + \
+	"but without a warning for each")
+parser.add_option("--nproc", type="int", dest="nproc", metavar="NUM",
+	help="Number of processes to histogram with in --stream mode " + \
+	"[default: 1]")
 
 (options, args) = parser.parse_args()
 
@@ -141,6 +151,11 @@ try:
 except IOError as exc:
 	print >> sys.stderr, exc
 	sys.exit(1)
+# In streaming mode, the data is histogrammed straight from the file below,
+# skipping the same lines (more than 3 or fewer than 2 fields) quietly
+if (options.stream == True):
+	datafile.close()
+	datafile = []
 
 xvals = []
 yvals = []
@@ -191,12 +206,23 @@ for line in datafile:
 		xvals.append(xval)
 		yvals.append(yval)
 
-datafile.close()
+if (options.stream == True):
+	# Only the bounds that were not given are needed from the data
+	if (None in (options.xub, options.xlb, options.yub, options.ylb)):
+		stats = binning.scan_files([args[0]], [1, 2], nproc=options.nproc,
+			max_fields=3)
+		if (stats.n == 0):
+			print >> sys.stderr, "Error: No data found in " + args[0]
+			sys.exit(1)
+		xmin, ymin = stats.min
+		xmax, ymax = stats.max
+else:
+	datafile.close()
 
-xmax = max(xvals)
-xmin = min(xvals)
-ymax = max(yvals)
-ymin = min(yvals)
+	xmax = max(xvals)
+	xmin = min(xvals)
+	ymax = max(yvals)
+	ymin = min(yvals)
 
 if (options.xub == None):
 	options.xub = float(int((xmax / options.xtickspacing) + 1.0)
@@ -307,9 +333,20 @@ if (((options.yub-options.ylb)*recbin) - ybins > epsilon):
 # judicious swap.
 if (options.freeEnergy == True):
 	options.normalise = False
-h2d, horizedges, vertedges = numpy.histogram2d(yvals, xvals,
-	bins=[ybins,xbins], range=[[options.ylb,options.yub],
-	[options.xlb,options.xub]], normed=options.normalise)
+if (options.stream == True):
+	hist = binning.histogram_files([args[0]], [2, 1],
+		[[options.ylb,options.yub], [options.xlb,options.xub]],
+		[ybins, xbins], nproc=options.nproc, max_fields=3,
+		numpy_edges=True)
+	h2d = hist.counts.reshape((ybins, xbins))
+	if (options.normalise == True):
+		h2d = h2d / h2d.sum() / numpy.prod(hist.width)
+	horizedges = numpy.linspace(options.ylb, options.yub, ybins+1)
+	vertedges = numpy.linspace(options.xlb, options.xub, xbins+1)
+else:
+	h2d, horizedges, vertedges = numpy.histogram2d(yvals, xvals,
+		bins=[ybins,xbins], range=[[options.ylb,options.yub],
+		[options.xlb,options.xub]], normed=options.normalise)
 
 extent = [vertedges[0], vertedges[-1], horizedges[0], horizedges[-1]]
 
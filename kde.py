@@ -3,7 +3,7 @@ from __future__ import division
 
 from array import array
 from argparse import ArgumentParser
-import matplotlib.pyplot as plt
+from binning import BinnedKDE
 import numpy as np
 from scipy import stats
 from signal import signal, SIGINT
@@ -36,6 +36,17 @@ group.add_argument('-res', '--resolution', metavar='INT', type=int, dest='res',
 group.add_argument('-b', '--bandwidth', default=None, type=float,
                    metavar='FLOAT', dest='bandwidth', help='''Kernel bandwidth
                    to use. Defaults to Scott's choice.''')
+group.add_argument('--bw-method', dest='bw_method', default='scott',
+                   choices=('scott', 'silverman'), help='''Rule for the default
+                   kernel bandwidth. Default scott.''')
+group.add_argument('--reflect', default=False, dest='reflect',
+                   action='store_true', help='''Reflect the data about the
+                   bounds of the output range so that no density is lost past
+                   them (for data that cannot leave that range)''')
+group.add_argument('--exact', default=False, dest='exact', action='store_true',
+                   help='''Sum the kernel of every point at every output point
+                   (scipy's gaussian_kde) rather than convolving the binned
+                   data. Much slower for large data sets.''')
 group = parser.add_argument_group('Plotting Options')
 group.add_argument('--plot', dest='plot', action='store_true', default=False,
                    help='''Show surface plot using matplotlib. Default is not
@@ -71,8 +82,8 @@ elif opt.torsion:
    print('Data is from a torsion. Using -180 to 180 range.')
    xmin, xmax = -180.0, 180.0
 else:
-   print('X-min: %g; X-max: %g' % tuple(opt.xrange))
-   xmin, xmax = opt.xrange
+   print('X-min: %g; X-max: %g' % tuple(opt.range))
+   xmin, xmax = opt.range
 
 if opt.input is None:
    infile = sys.stdin
@@ -96,13 +107,22 @@ if xmin is None:
 # Now convert to numpy array
 data = np.asarray(data)
 
+if opt.reflect and (data.min() < xmin or data.max() > xmax):
+   warnings.warn('Data lies outside the range it is reflected about')
+
 # Now pass it in and get a KDE
-try:
-   kernel = stats.gaussian_kde(data, bw_method=opt.bandwidth)
-except TypeError:
-   kernel = stats.gaussian_kde(data)
-   if opt.bandwidth is not None:
-      kernel.factor = opt.bandwidth
+if not opt.exact:
+   kernel = BinnedKDE(data, opt.bandwidth, opt.bw_method,
+                      (xmin, xmax) if opt.reflect else None)
+else:
+   if opt.reflect:
+      sys.exit('--reflect cannot be used with --exact')
+   try:
+      kernel = stats.gaussian_kde(data, bw_method=opt.bandwidth or opt.bw_method)
+   except TypeError:
+      kernel = stats.gaussian_kde(data)
+      if opt.bandwidth is not None:
+         kernel.factor = opt.bandwidth
 
 # Output the results in a gnuplot-readable way
 if opt.output is None:
@@ -114,13 +134,14 @@ print ('The bandwidth is %s' % kernel.factor)
 spacing = (xmax - xmin) / opt.res
 
 if opt.output is not None or not opt.plot:
+   xvals = xmin + spacing * np.arange(opt.res)
    outfile.write('#             X           KDE\n')
-   for i in range(opt.res):
-      xval = xmin + spacing * i
-      outfile.write('%13.7E %13.7E\n' % (xval, kernel.evaluate((xval))))
+   outfile.write(''.join(['%13.7E %13.7E\n' % point for point in
+                          zip(xvals, kernel.evaluate(xvals))]))
 
 # Plot the KDE
 if opt.plot:
+   import matplotlib.pyplot as plt
    xdata = np.arange(xmin, xmax, spacing)
    ydata = kernel.evaluate(xdata)
    fig = plt.figure(1, figsize=(8,5))
@@ -17,8 +17,10 @@ group = OptionGroup(parser, "Input Options",
                     "Options pertaining to the input data")
 group.add_option('-i', '--input-data', metavar='FILE', dest='infile',
                  default=None, help='Input file with RMSD data')
-group.add_option('-c', '--column', metavar='INT', type='int', dest='col',
-                 help='Column with RMSD data (Default=%default)', default=2)
+group.add_option('-c', '--column', metavar='INT[,INT,...]', dest='col',
+                 help='Column(s) with RMSD data. Several comma-separated ' +
+                 'columns are analyzed together in one pass, writing one ' +
+                 'output column for each (Default=%default)', default='2')
 parser.add_option_group(group)
 group = OptionGroup(parser, 'Output Options',
                     'Options pertaining to the output data')
@@ -71,13 +73,24 @@ else:
       print >> sys.stderr, 'Could not open %s for writing!' % opt.outfile
       sys.exit(1)
 
-data = ds.load_from_file(infile, opt.col)
+try:
+   columns = [int(col) for col in opt.col.split(',')]
+except ValueError:
+   print >> sys.stderr, 'Error: Bad column specification %s' % opt.col
+   sys.exit(1)
 
 if opt.spacing is not None and opt.bins is not None:
    print >> sys.stderr, 'Error: Cannot specify --bins and --spacing!'
    sys.exit(1)
 
-data.set_hist_params(hmin=opt.hmin, hmax=opt.hmax, nbins=opt.bins,
-                     spacing=opt.spacing, norm=True)
-
-data.KullbackLeibler(opt.interval, outfile)
+if len(columns) == 1:
+   data = ds.load_from_file(infile, columns[0])
+   data.set_hist_params(hmin=opt.hmin, hmax=opt.hmax, nbins=opt.bins,
+                        spacing=opt.spacing, norm=True)
+   data.KullbackLeibler(opt.interval, outfile)
+else:
+   datasets = ds.load_columns_from_file(infile, columns)
+   for data in datasets:
+      data.set_hist_params(hmin=opt.hmin, hmax=opt.hmax, nbins=opt.bins,
+                           spacing=opt.spacing, norm=True)
+   ds.multi_kullback_leibler(datasets, opt.interval, outfile)
@@ -4,7 +4,7 @@ generating useful data sets for analyzing them.
 """
 
 import numpy as np
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
 from utilities import which
 import re, sys, os
 
@@ -22,16 +22,287 @@ class RMSError(Exception): pass
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
+# Frame counts of trajectory files, keyed by absolute path. Each entry is
+# (size, mtime, frames), so a file that changes on disk is counted again
+_frame_cache = {}
+
+def _file_stamp(fname):
+   " Returns the (size, mtime) pair used to validate cached frame counts "
+   st = os.stat(fname)
+   return st.st_size, st.st_mtime
+
+def _cached_counts(traj_list):
+   """ Returns a dict of the cached frame counts of the trajectories that are
+       still valid, and the list of trajectories that need counting
+   """
+   counts, todo = {}, []
+   for traj in traj_list:
+      key = os.path.abspath(traj)
+      if key in _frame_cache and os.path.exists(traj) and \
+            _frame_cache[key][:2] == _file_stamp(traj):
+         counts[traj] = _frame_cache[key][2]
+      elif not traj in todo:
+         todo.append(traj)
+   return counts, todo
+
+def _parse_counts(out, todo, counts):
+   """ Adds the frame counts cpptraj printed for each trajectory in todo to
+       counts (and the cache)
+   """
+   found = dict(re.findall(r'\[(.+)\] contains (\d+) frames', out))
+   for traj in todo:
+      if not traj in found:
+         raise TrajError('Bad trajectory file (%s):\nOutput: %s' % (traj, out))
+      counts[traj] = int(found[traj])
+      if os.path.exists(traj):
+         _frame_cache[os.path.abspath(traj)] = _file_stamp(traj) + \
+                                               (counts[traj],)
+   return counts
+
+def frame_counts(cpptraj, parm, traj_list):
+   """ Returns a dict of the number of frames in each trajectory file, counted
+       by a single cpptraj run (files with a valid cached count are skipped)
+   """
+   counts, todo = _cached_counts(traj_list)
+   if not todo: return counts
+   process = Popen([cpptraj, str(parm)], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+   out, err = process.communicate(''.join(['trajin %s\n' % traj
+                                           for traj in todo]))
+   # cpptraj does not usually bail out with a non-zero exit code; it just
+   # prints errors, which _parse_counts catches
+   if process.wait():
+      raise TrajError('Bad trajectory file(s) %s:\nOutput: %s\nError: %s' %
+                      (', '.join(todo), out, err))
+   return _parse_counts(out, todo, counts)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class CpptrajSession(object):
+   """
+   A long-lived cpptraj process with one topology loaded, fed commands
+   through stdin. Each call to execute() is terminated by a sentinel command
+   whose echo marks the end of that call's output, so the process (and the
+   loaded topology) can be reused for any number of calls
+   """
+   # Commands that reset cpptraj state between calls, keeping the topology
+   reset_commands = ['clear trajin', 'clear trajout', 'clear ref',
+                     'clear actions', 'clear analysis', 'clear datafile',
+                     'clear dataset']
+
+   def __init__(self, cpptraj, parm):
+      self.cpptraj = cpptraj
+      self.parm = str(parm)
+      # cpptraj buffers its output when writing to a pipe, so it must be
+      # line-buffered or we would never see the sentinel until it quits
+      stdbuf = which('stdbuf')
+      if not stdbuf:
+         raise TrajError('cpptraj sessions need stdbuf, which was not found')
+      self.process = Popen([stdbuf, '-oL', self.cpptraj, self.parm], stdin=PIPE,
+                           stdout=PIPE, stderr=STDOUT)
+      self._ncalls = 0
+      # Swallow the start-up banner and topology loading output
+      self.startup = self.execute('')
+
+   #===================================================
+
+   def alive(self):
+      " Is the cpptraj process still running? "
+      return self.process.poll() is None
+
+   #===================================================
+
+   def execute(self, commands):
+      """ Sends a block of commands to cpptraj and returns all of the output
+          they generated
+      """
+      if not self.alive():
+         raise TrajError('cpptraj session for %s has exited' % self.parm)
+      self._ncalls += 1
+      sentinel = 'mdcrd_py_done_%d' % self._ncalls
+      if commands and not commands.endswith('\n'): commands += '\n'
+      self.process.stdin.write(commands + 'help %s\n' % sentinel)
+      self.process.stdin.flush()
+      out = []
+      while True:
+         line = self.process.stdout.readline()
+         if not line:
+            raise TrajError('cpptraj exited unexpectedly:\n%s' % ''.join(out))
+         if sentinel in line: break
+         # Skip anything cpptraj printed about earlier sentinels
+         if not 'mdcrd_py_done_' in line: out.append(line)
+      return ''.join(out)
+
+   #===================================================
+
+   def reset(self):
+      " Clears all trajectories, actions, and data, keeping the topology "
+      return self.execute('\n'.join(self.reset_commands))
+
+   #===================================================
+
+   def close(self):
+      " Ends the cpptraj process "
+      if self.alive():
+         try:
+            self.process.stdin.write('quit\n')
+            self.process.stdin.close()
+         except IOError:
+            pass
+         self.process.wait()
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class CpptrajPool(object):
+   """
+   Keeps one cpptraj session per topology file alive, so that frame counts
+   and analyses on the same topology do not start cpptraj again. At most
+   max_sessions sessions are kept; the least recently used one is closed
+   when a new topology needs a session. Sessions need the stdbuf utility to
+   line-buffer cpptraj's output. This class is not thread-safe.
+   """
+
+   def __init__(self, cpptraj=None, max_sessions=4):
+      self.cpptraj = cpptraj or which('cpptraj')
+      if not self.cpptraj:
+         raise TrajError('Could not find cpptraj!')
+      if not which('stdbuf'):
+         raise TrajError('CpptrajPool needs stdbuf, which was not found')
+      self.max_sessions = max_sessions
+      # Most recently used sessions are at the end
+      self._sessions = []
+
+   #===================================================
+
+   def session(self, parm):
+      " Returns a live cpptraj session for a topology, starting it if needed "
+      parm = str(parm)
+      for sess in self._sessions:
+         if sess.parm != parm: continue
+         self._sessions.remove(sess)
+         if sess.alive():
+            self._sessions.append(sess)
+            return sess
+         break
+      while len(self._sessions) >= self.max_sessions:
+         self._sessions.pop(0).close()
+      sess = CpptrajSession(self.cpptraj, parm)
+      self._sessions.append(sess)
+      return sess
+
+   #===================================================
+
+   def frame_counts(self, parm, traj_list):
+      """ Returns a dict of the number of frames in each trajectory file.
+          Counts are cached per file until its size or mtime changes, and
+          all files that are not cached are counted in a single call
+      """
+      counts, todo = _cached_counts(traj_list)
+      if not todo: return counts
+      sess = self.session(parm)
+      out = sess.execute(''.join(['trajin %s\n' % traj for traj in todo]))
+      sess.reset()
+      return _parse_counts(out, todo, counts)
+
+   #===================================================
+
+   def run(self, parm, commands):
+      """ Runs one trajectory pass with the given trajin and action commands
+          and returns cpptraj's output
+      """
+      sess = self.session(parm)
+      try:
+         out = sess.execute(commands + 'run\n')
+      finally:
+         if sess.alive(): sess.reset()
+      return out
+
+   #===================================================
+
+   def close(self):
+      " Ends all cpptraj sessions "
+      while self._sessions:
+         self._sessions.pop().close()
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _cpptraj_failed(out):
+   " Did cpptraj report an error in its output? "
+   return re.search(r'^\s*Error:', out, re.M) is not None
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def _split_passes(members):
+   """ Splits the AmberTraj instances sharing a trajectory pass into as few
+       passes as possible such that no two in one pass define the same data
+       set or reference name
+   """
+   passes = []
+   for traj in members:
+      for names, group in passes:
+         if not names & traj._cpptraj_names:
+            names |= traj._cpptraj_names
+            group.append(traj)
+            break
+      else:
+         passes.append((set(traj._cpptraj_names), [traj]))
+   return [group for names, group in passes]
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def run_batch(trajs, pool):
+   """ Runs the queued analyses of several AmberTraj instances. Instances
+       that share a topology and the same trajectory frames are run together
+       in a single trajectory pass of a session in the given CpptrajPool,
+       unless their data set or reference names clash, in which case they get
+       separate passes
+   """
+   groups, order = {}, []
+   for traj in trajs:
+      key = (traj.parm, traj._trajin_commands())
+      if not key in groups:
+         groups[key] = []
+         order.append(key)
+      groups[key].append(traj)
+   for key in order:
+      parm, trajin = key
+      for members in _split_passes(groups[key]):
+         commands = ''.join([t._cpptraj_commands for t in members])
+         logfiles = []
+         for t in members:
+            if not t.logfile in logfiles: logfiles.append(t.logfile)
+         for log in logfiles: print >> log, 'Running cpptraj:'
+         try:
+            out = pool.run(parm, trajin + commands)
+            # cpptraj keeps running after most errors, so look for them
+            failed = _cpptraj_failed(out)
+         except TrajError, err:
+            out, failed = str(err), True
+         for log in logfiles:
+            log.write(out)
+            if failed:
+               print >> log, 'Running cpptraj failed.'
+            else:
+               print >> log, 'cpptraj ran successfully!'
+         for t in members:
+            t._cpptraj_commands = ''
+            t._cpptraj_names = set()
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
 class AmberTraj(object):
    " This is a class to analyze trajectory files (a series of them, or just 1) "
    
    def __init__(self, parm, traj_list, start=1, stride=1, end=99999999,
-                logfile=None, overwrite=False):
+                logfile=None, overwrite=False, pool=None):
       # Get cpptraj
       self.cpptraj = which('cpptraj')
       if not self.cpptraj:
          raise TrajError('Could not find cpptraj!')
 
+      # A CpptrajPool to count frames and run analyses in. If pool is None,
+      # each of those starts its own cpptraj process
+      self.pool = pool
+
       # Load instance data
       self.parm = str(parm)
 
@@ -74,8 +345,10 @@ class AmberTraj(object):
       else:
          self.logfile = sys.stdout
 
-      # Start keeping track of the commands we want to run
+      # Start keeping track of the commands we want to run, and the data set
+      # and reference names they define
       self._cpptraj_commands = ''
+      self._cpptraj_names = set()
 
    #===================================================
 
@@ -100,27 +373,15 @@ class AmberTraj(object):
 
    def _query(self):
       " Determine how many frames are in each trajectory "
-      get_num_frames = re.compile(r' *\[.+\] contains (\d+) frames.')
-      for traj in self.traj_list:
-         # Skip over any frames we've already determined
-         if self.traj_list[traj] != -1: continue
-         # Now launch a subprocess where we just trajin the file and parse
-         # the output to find out how many frames are present
-         process = Popen([self.cpptraj, self.parm], stdin=PIPE, stdout=PIPE,
-                         stderr=PIPE)
-         out, err = process.communicate('trajin %s' % traj)
-         # This shouldn't be reached, since cpptraj doesn't bail out with a
-         # non-zero exit code, it just prints errors.
-         if process.wait():
-            raise TrajError('Bad trajectory file %s:\nOutput: %s\nError: %s' % 
-                            (traj, out, err))
-         nframes = get_num_frames.search(out)
-         # This really means we put in a bad trajectory file
-         if len(nframes.groups()) != 1:
-            raise TrajError('Bad trajectory file (%s):\nOutput: %s\nError: %s' %
-                            (traj, out, err))
-         # Otherwise, we got our number of frames
-         self.traj_list[traj] = int(nframes.groups()[0])
+      # Skip over any frames we've already determined
+      todo = [traj for traj in self.traj_name_list if self.traj_list[traj] == -1]
+      if not todo: return
+      if self.pool is None:
+         counts = frame_counts(self.cpptraj, self.parm, todo)
+      else:
+         counts = self.pool.frame_counts(self.parm, todo)
+      for traj in todo:
+         self.traj_list[traj] = counts[traj]
 
    #===================================================
 
@@ -130,8 +391,10 @@ class AmberTraj(object):
       if outfile and os.path.exists(outfile) and not self.overwrite:
          raise TrajError('Cannot overwrite %s' % outfile)
 
+      self._cpptraj_names.add('dataset %s' % setname)
       # See if we RMSD to a reference
       if ref:
+         self._cpptraj_names.add('reference ref')
          self._cpptraj_commands += 'reference %s\n' % ref
       # Now start the RMS commands
       self._cpptraj_commands += 'rmsd %s %s ' % (setname, mask)
@@ -151,8 +414,8 @@ class AmberTraj(object):
 
    #===================================================
 
-   def run(self):
-      """ This runs cpptraj with the given commands """
+   def _trajin_commands(self):
+      " Returns the trajin commands for all of the trajectories "
       # adjust the ends to be either the highest frame # or the value of end
       self.end = [min(self.end[i], self.traj_list[j]) 
                   for i,j in enumerate(self.traj_name_list)]
@@ -160,6 +423,17 @@ class AmberTraj(object):
       for i, traj in enumerate(self.traj_name_list):
          cmd_str += 'trajin %s %d %d %d \n' % (traj, self.start[i], self.end[i],
                                                self.stride[i])
+      return cmd_str
+
+   #===================================================
+
+   def run(self):
+      """ This runs cpptraj with the given commands """
+      if self.pool is not None:
+         run_batch([self], self.pool)
+         return
+
+      cmd_str = self._trajin_commands()
       
       process = Popen([self.cpptraj, self.parm], stdin=PIPE,
                       stdout=self.logfile, stderr=self.logfile)
@@ -209,6 +483,8 @@ if __name__ == '__main__':
    parser = OptionParser('python %prog [Options] mdcrd1 [mdcrd2 [...] ]')
    parser.add_option('-p', '--parm', dest='prmtop', metavar='FILE',
                    default=None, help='Topology file matching the trajectories')
+   parser.add_option('-n', '--frames-only', dest='frames_only', default=False,
+                   action='store_true', help='Only print the number of frames')
    opt, args = parser.parse_args()
 
    if not args or not opt.prmtop:
@@ -222,6 +498,8 @@ if __name__ == '__main__':
    for traj in mytraj.traj_name_list:
       print 'Trajectory %20s has %10d frames.' % (traj, mytraj.traj_list[traj])
 
+   if opt.frames_only: sys.exit(0)
+
    # separator
    print ''
 
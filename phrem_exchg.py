@@ -2,6 +2,7 @@
 
 from optparse import OptionParser
 from remd import pHRemLog
+import numpy as np
 import sys, math, os
 
 debug_printlevel = 1
@@ -19,6 +20,32 @@ def excepthook(exception_type, exception_value, tb):
 
 sys.excepthook = excepthook
 
+# How many pair probabilities to hold in memory at once
+CHUNK_ELEMENTS = 1 << 22
+
+def pair_acceptance(remlog, chunk_elements=CHUNK_ELEMENTS):
+   """ Returns an (nreps, nreps) array whose [i,j] element (i < j, in order of
+       increasing pH) is the sum over all exchanges of the Metropolis
+       acceptance probability for exchanging the replicas at pH values i and
+       j. Exchanges are processed in chunks so memory stays bounded
+   """
+   numreps = len(remlog.reps)
+   pH_vals = np.array(remlog.values)
+   # Exchange probability is exp(DELTA prot_cnt * DELTA pH * LN_TO_LOG)
+   dpH = (pH_vals[:,np.newaxis] - pH_vals[np.newaxis,:]) * math.log(10)
+   upper = np.triu(np.ones((numreps, numreps), bool), 1)
+   total = np.zeros((numreps, numreps))
+   nchunk = max(1, chunk_elements // (numreps * numreps))
+   for first in range(0, remlog.nexch, nchunk):
+      last = min(first + nchunk, remlog.nexch)
+      # Protonation counts ordered by the pH of each replica
+      prot_cnts = np.empty((last - first, numreps))
+      rows = np.arange(last - first)[:,np.newaxis]
+      prot_cnts[rows, remlog.index[first:last]] = remlog.prot_cnt[first:last]
+      x = dpH * (prot_cnts[:,:,np.newaxis] - prot_cnts[:,np.newaxis,:])
+      total += np.exp(np.minimum(x, 0.0)).sum(axis=0)
+   return np.where(upper, total, 0.0)
+
 epilog = '''This program will calculate what would be the success ratio between
 every pair of pH values in a given pH REM simulation'''
 
@@ -39,42 +66,14 @@ debug_printlevel = opt.debug
 remlog = pHRemLog(opt.input)
 
 numreps = len(remlog.reps)
-numexchg = remlog.numexchg
-LN_TO_LOG = math.log(10)
+numexchg = remlog.nexch
 
 pH_vals = remlog.values[:]
 
-# probs is the array of probability arrays. Each element is an array that stores
-# the probability of exchange success with every replica that has a higher pH
-# (i.e. we are assuming a symmetric matrix)
-probs = [[] for i in range(numreps-1)]
-for i in range(numreps-1): probs[i] = [0 for j in range(numreps-i-1)]
-
-# Now let's go through each step and calculate the probability of exchange of
-# every pH with every other pH
-for i in range(numexchg):
-   indexes = [rep.index[i] for rep in remlog.reps]
-   prot_cnts = [rep.prot_cnt[i] for rep in remlog.reps]
-   old_phs = [rep.old_pH[i] for rep in remlog.reps]
-   new_phs = [rep.new_pH[i] for rep in remlog.reps]
-#  print 'Indexes are: ', indexes
-#  print prot_cnts
-#  print old_phs
-#  print new_phs
-   for j in range(numreps):
-      idx1 = indexes[j]
-      for k in range(numreps):
-         idx2 = indexes[k]
-         if idx2 <= idx1: continue
-#        print 'idx1,2 = ', idx1, idx2
-#        print 'delta pH, delta prot = ', pH_vals[idx1]-pH_vals[idx2], prot_cnts[j]-prot_cnts[k]
-         # Exchange probability is exp(DELTA prot_cnt * DELTA pH * LN_TO_LOG)
-         delta = -(pH_vals[idx1]-pH_vals[idx2])*(prot_cnts[j]-prot_cnts[k]) * LN_TO_LOG
-#        print idx1, idx2, len(probs), idx2-idx1-1, len(probs[idx1])
-         probs[idx1][idx2-idx1-1] += min(1.0,math.exp(-delta))
-#        print 'changing ',idx1, ', ',idx2-idx1-1, ' by (', delta,') ', min(1.0,math.exp(-delta))
-#  print 'Probs are: ', probs
-
+# probs stores the summed probability of exchange success between every pair
+# of pH values, with the lower pH first (i.e. we are assuming a symmetric
+# matrix)
+probs = pair_acceptance(remlog)
 
 # Now we can report the averages:
 
@@ -83,4 +82,4 @@ print "------------------------------------------------"
 for i in range(numreps-1):
    for j in range(i+1, numreps):
       print "%7.2f |%7.2f |%30.6f" % (pH_vals[i], pH_vals[j], 
-                                      probs[i][j-i-1]/numexchg)
+                                      probs[i,j]/numexchg)
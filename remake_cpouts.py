@@ -5,6 +5,12 @@
 import re, os, sys
 from optparse import OptionParser
 
+# Number of records from each cpout handed to a worker at once
+BATCH_SIZE = 2000
+
+# Size of each read from a cpout file
+READ_SIZE = 1 << 22
+
 class CpoutError(Exception):
    """ Raised for an error reading/parsing CPOUT file """
 
@@ -74,16 +80,143 @@ class TitrationRecord(object):
 
 #-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
+class CpoutSplitter(object):
+   """ Splits a cpout file into the text of its records (separated by blank
+       lines) with one scan over large reads, without parsing them
+   """
+
+   sep_re = re.compile(r'\n[ \t\r]*\n')
+
+   #======================================================
+
+   def __init__(self, fil, read_size=READ_SIZE):
+      self.file = fil
+      self.read_size = read_size
+      self.records = []
+      self.rest = ''
+      self.eof = False
+
+   #======================================================
+
+   def _fill(self):
+      " Reads more of the file and splits off any complete records "
+      chunk = self.file.read(self.read_size)
+      if not chunk:
+         self.eof = True
+         if self.rest.strip(): self.records.append(self.rest)
+         self.rest = ''
+         return
+      pieces = self.sep_re.split(self.rest + chunk)
+      self.rest = pieces.pop()
+      self.records.extend([p for p in pieces if p.strip()])
+
+   #======================================================
+
+   def get_records(self, n):
+      " Returns the text of (up to) the next n records "
+      while len(self.records) < n and not self.eof:
+         self._fill()
+      records, self.records = self.records[:n], self.records[n:]
+      return records
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+def convert_records(records):
+   """ Parses the text of a list of records and returns a list of (pH, text)
+       of each record as it should be written to its pH-specific cpout.
+       Run in the worker processes
+   """
+   full_re, rec_re = TitrationRecord.full_re, TitrationRecord.rec_re
+   ph_rec = TitrationRecord.ph_rec
+   converted = []
+   for record in records:
+      lines = [l.strip() for l in record.strip().split('\n')]
+      lines = [l for l in lines if l]
+      fullmatch = full_re.match(lines[0])
+      if fullmatch:
+         pH = float(fullmatch.groups()[0])
+         head, lines = lines[:4], lines[4:]
+      else:
+         recmatch = rec_re.match(lines[0])
+         if not recmatch:
+            raise CpoutError('Did not find expected line in cpout record!')
+         pH = float(recmatch.groups()[2])
+         head = []
+      text = os.linesep.join(head + [ph_rec.sub('', l) for l in lines])
+      converted.append((pH, text + os.linesep + os.linesep))
+   return converted
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+def demultiplex(files, prefix, nproc=1, batch_size=BATCH_SIZE, max_pending=None):
+   """ Writes the records of a set of pH-REM cpout files to pH-specific cpout
+       files named <prefix>.pH_<pH>. Each file is split into records in one
+       scan; batches of records are parsed in nproc worker processes, and at
+       most max_pending batches (default 2*nproc) per file are held in memory.
+       Batches are written in order, so the output is the same as writing
+       record i of every cpout before record i+1, stopping when the first
+       cpout runs out
+   """
+   splitters = [CpoutSplitter(f) for f in files]
+   if max_pending is None: max_pending = 2 * nproc
+   pool = None
+   if nproc > 1:
+      from multiprocessing import Pool
+      pool = Pool(nproc)
+   outfiles = {}
+   pending = []  # batches of one result per cpout, oldest first
+
+   def submit():
+      " Reads the next batch from every file and queues it for parsing "
+      batch = [s.get_records(batch_size) for s in splitters]
+      if not batch[0]: return False
+      if pool is None:
+         pending.append([convert_records(b) for b in batch])
+      else:
+         pending.append([pool.apply_async(convert_records, (b,))
+                         for b in batch])
+      return True
+
+   def write_oldest():
+      " Writes the oldest batch, interleaving the cpouts record by record "
+      batch = pending.pop(0)
+      if pool is not None: batch = [result.get() for result in batch]
+      for i in range(len(batch[0])):
+         for converted in batch:
+            if i >= len(converted): continue
+            pH, text = converted[i]
+            if not pH in outfiles:
+               outfiles[pH] = open(prefix + '.pH_%.2f' % pH, 'w', 1 << 20)
+            outfiles[pH].write(text)
+
+   try:
+      more = True
+      while more or pending:
+         while more and len(pending) < max_pending:
+            more = submit()
+         if pending: write_oldest()
+   finally:
+      if pool is not None:
+         pool.terminate()
+         pool.join()
+      for f in outfiles.values(): f.close()
+   return sorted(outfiles.keys())
+
+#-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
 def main():
    usage = '%prog [Options] cpout1 cpout2 cpout3 ... cpoutN'
    parser = OptionParser(usage=usage)
    parser.add_option('-p', '--prefix', dest='prefix', default=None,
                      help='Prefix of output cpout files. Output cpout files '
                      'are named <prefix>.pH_<pH>')
+   parser.add_option('-n', '--nproc', dest='nproc', default=1, type='int',
+                     help='Number of processes to parse records with. ' +
+                     'Default 1')
    opt, arg = parser.parse_args()
 
    try:
-      cpout_list = [RemCpout(open(f, 'r')) for f in arg]
+      cpout_list = [open(f, 'r') for f in arg]
    except IOError:
       print 'Could not find file %s' % f
       sys.exit(1)
@@ -93,18 +226,7 @@ def main():
       parser.print_help()
       sys.exit(1)
 
-   records = [cpout.get_next_record() for cpout in cpout_list]
-
-   pH_list = [rec.pH for rec in records]
-
-   files = {}
-   for pH in pH_list:
-      files[pH] = open(opt.prefix + '.pH_%.2f' % pH, 'w')
-
-   while records[0]:
-      for rec in records:
-         if rec: rec.write_to(files[rec.pH])
-      records = [cpout.get_next_record() for cpout in cpout_list]
+   demultiplex(cpout_list, opt.prefix, max(opt.nproc, 1))
 
    print 'Done!'
 
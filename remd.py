@@ -3,7 +3,7 @@ This file provides classes to interact with replica exchange files and provide
 statistics for the simulation
 """
 
-import re
+import os, re, time
 import numpy as np
 
 class Replica(object):
@@ -18,19 +18,44 @@ class RemLog(object):
    """ Replica exchange log file """
 
    numexch_desc_re = re.compile(r'# numexchg is *(\d+)')
+   comment_re = re.compile(r'^#.*\n?', re.M)
+   exchange_re = re.compile(r'^# exchange', re.M)
+
+   # Number of columns in each replica record -- must be set by subclasses
+   ncols = None
+
+   # (name, column) of the per-exchange arrays copied straight from the
+   # records. Subclasses fill in anything else in _fill
+   columns = ()
+
+   # How many bytes of the log to convert at once
+   chunk_size = 1 << 23
+
+   # Bump this whenever the layout of the cache changes
+   cache_version = 1
 
    #================================================
 
-   def __init__(self, fname):
-      """ Loads a replica exchange log file """
+   def __init__(self, fname, cache=True):
+      """ Loads a replica exchange log file. If cache is True, the parsed
+          log is kept in fname.npz and reused (and extended with anything
+          appended to the log) the next time the log is loaded
+      """
       self.fname = fname
       self.reps = [] # list of all replicas
       self.numexchg = 0
+      self.values = []
+      self.nexch = 0 # number of exchanges parsed so far
+      self.capacity = 0 # number of exchanges the arrays have room for
+      self.cache = cache
+      if cache and self._load_cache(): return
       self.file = open(fname, 'r')
       self.numexchg = self._get_numexchg()
-      self.values = []
       self._get_replicas()
+      self.file.close()
+      self._allocate()
       self._parse()
+      if cache: self._save_cache()
 
    #================================================
 
@@ -45,221 +70,407 @@ class RemLog(object):
 
    #================================================
 
-   def _get_replicas(self):
-      " Gets replica information from the first block -- must be inherited! "
-      raise RemdError('_get_replicas: Virtual method only!')
+   def _first_block(self):
+      """ Returns the records of the first exchange block as a list of
+          column lists, and remembers where that block starts in the file
+      """
+      self._data_start = self.file.tell()
+      rawline = self.file.readline()
+      while rawline and rawline.startswith('#'):
+         self._data_start = self.file.tell() - len(rawline)
+         rawline = self.file.readline()
+      records = []
+      while rawline and not rawline.startswith('#'):
+         words = rawline.split()
+         if len(words) != self.ncols:
+            raise RemdError('Bad replica record in %s: %s' % (self.fname,
+                            rawline))
+         records.append(words)
+         rawline = self.file.readline()
+      if not records:
+         raise RemdError('Could not find any replicas in %s' % self.fname)
+      return records
+
+   #================================================
+
+   def _prepare_chunk(self, text):
+      " Makes a block of records purely numeric, if needed, before parsing "
+      return text
+
+   #================================================
+
+   def _read_records(self, start):
+      """ Reads every complete exchange block from byte offset start (which
+          must be the start of a block) to the end of the file. Returns the
+          records as a (nexch, nreps, ncols) float array, with the records in
+          each block ordered by replica number, and the offset just past the
+          last complete block. An incomplete final block (a run that is
+          still going, for instance) is left for the next read
+      """
+      nreps = len(self.reps)
+      logfile = open(self.fname, 'r')
+      logfile.seek(start)
+      pieces, blocks, rest, offset = [], [], '', start
+      while True:
+         chunk = logfile.read(self.chunk_size)
+         # Only convert whole lines. A trailing partial line may still be
+         # being written, so it is never converted
+         text = rest + chunk
+         cut = text.rfind('\n') + 1
+         text, rest = text[:cut], text[cut:]
+         blocks.extend([offset + m.start() for m in
+                        self.exchange_re.finditer(text)])
+         offset += len(text)
+         text = self._prepare_chunk(self.comment_re.sub('', text))
+         if text.strip():
+            pieces.append(np.fromstring(text, sep=' '))
+         if not chunk: break
+      logfile.close()
+      if pieces:
+         values = np.concatenate(pieces)
+      else:
+         values = np.zeros(0)
+      if values.size % self.ncols:
+         raise RemdError('Bad replica records in %s' % self.fname)
+      nexch = values.size // (self.ncols * nreps)
+      if len(blocks) > nexch:
+         end = blocks[nexch]
+      elif nexch * nreps * self.ncols == values.size:
+         end = offset
+      else:
+         end = start
+         nexch = 0
+      values = values[:nexch*nreps*self.ncols].reshape((nexch, nreps,
+                                                        self.ncols))
+      # Put the records of each block in replica order
+      repnum = values[:,:,0].astype(int) - 1
+      if (np.sort(repnum, axis=1) != np.arange(nreps)).any():
+         raise RemdError('Bad replica numbers in %s' % self.fname)
+      records = np.empty_like(values)
+      records[np.arange(nexch)[:,np.newaxis], repnum] = values
+      return records, end
+
+   #================================================
+
+   def _value_indices(self, vals):
+      " Maps an array of exchanged values to their (sorted) replica indices "
+      self.value_index = dict([(v, i) for i, v in enumerate(self.values)])
+      sorted_vals = np.array(self.values)
+      idx = np.searchsorted(sorted_vals, vals).clip(0, len(sorted_vals) - 1)
+      if (sorted_vals[idx] != vals).any():
+         raise RemdError('Unknown replica value in %s' % self.fname)
+      return idx
+
+   #================================================
+
+   def _array(self, dtype=float):
+      " A new (capacity, nreps) array for one replica property "
+      return np.zeros((self.capacity, len(self.reps)), dtype)
+
+   #================================================
+
+   def _allocate(self, capacity=0):
+      """ Sets up the (capacity, nreps) arrays of every property, with room
+          for at least numexchg exchanges, and makes each replica's
+          attributes views of its column of those arrays
+      """
+      self.capacity = max(capacity, self.numexchg)
+      self.records = np.zeros((self.capacity, len(self.reps), self.ncols))
+      self.nsuccess = np.zeros(len(self.reps), int)
+      self._names = self._allocate_arrays()
+      for i, rep in enumerate(self.reps):
+         for name in self._names:
+            setattr(rep, name, getattr(self, name)[:,i])
+
+   #================================================
+
+   def _grow(self, needed):
+      """ Makes room for at least needed exchanges, at least doubling the
+          capacity so that repeated appends take amortized linear time
+      """
+      old = dict([(name, getattr(self, name)) for name in self._names])
+      records, nsuccess = self.records, self.nsuccess
+      self._allocate(max(needed, 2 * self.capacity))
+      n = self.nexch
+      self.records[:n] = records[:n]
+      self.nsuccess[:] = nsuccess
+      for name in self._names:
+         getattr(self, name)[:n] = old[name][:n]
+
+   #================================================
+
+   def _allocate_arrays(self):
+      """ Creates the property arrays and returns their names. Each replica
+          has an index array to trace its trajectory through replica space.
+          Indexing starts from 0
+      """
+      self.index = self._array(int)
+      for name, col in self.columns:
+         setattr(self, name, self._array())
+      return ['index'] + [name for name, col in self.columns]
+
+   #================================================
+
+   def _fill(self, first, last):
+      " Fills the property arrays for exchanges first to last-1 "
+      for name, col in self.columns:
+         getattr(self, name)[first:last] = self.records[first:last,:,col]
+
+   #================================================
+
+   def _accepted(self, first, last):
+      """ Returns a (last-first, nreps) bool array of which replicas had an
+          exchange accepted in exchanges first to last-1 -- must be inherited!
+      """
+      raise RemdError('_accepted: Virtual method only!')
+
+   #================================================
+
+   def _append(self, records):
+      " Adds newly parsed exchanges to the records and property arrays "
+      first, last = self.nexch, self.nexch + len(records)
+      if last > self.capacity: self._grow(last)
+      self.records[first:last] = records
+      self.nexch = last
+      self._fill(first, last)
+      self.nsuccess += self._accepted(first, last).sum(axis=0)
+
+   #================================================
+
+   def acceptance_ratio(self):
+      """ Fraction of the exchanges parsed so far in which each replica had
+          an exchange accepted
+      """
+      return self.nsuccess / float(max(self.nexch, 1))
+
+   #================================================
+
+   def refresh(self, save_cache=False):
+      """ Parses only the exchange blocks appended to the log since the last
+          parse (an incomplete block is left for the next refresh) and
+          extends the data arrays. Returns the number of new exchanges
+      """
+      records, self._data_end = self._read_records(self._data_end)
+      self._append(records)
+      if save_cache and self.cache and len(records): self._save_cache()
+      return len(records)
+
+   #================================================
+
+   def follow(self, interval=60.0):
+      """ Generator that polls a running simulation's log every interval
+          seconds, yielding the number of new exchanges whenever there are
+          some. Stops once numexchg exchanges have been read
+      """
+      while self.nexch < self.numexchg:
+         nnew = self.refresh()
+         if nnew:
+            yield nnew
+         else:
+            time.sleep(interval)
 
    #================================================
 
    def _parse(self):
-      """ Parses the file -- must be inherited! """
-      raise RemdError('_parse: Virtual method only!')
+      """ Parses the file and loads the data arrays """
+      records, self._data_end = self._read_records(self._data_start)
+      self._append(records)
+
+   #================================================
+
+   def _cache_name(self):
+      return self.fname + '.npz'
+
+   #================================================
+
+   def _signature(self, logfile, end):
+      " The bytes just before offset end, to check the log was not rewritten "
+      logfile.seek(max(end - 256, 0))
+      return logfile.read(end - max(end - 256, 0))
+
+   #================================================
+
+   def _save_cache(self):
+      " Writes the parsed log to the cache file. Failures are not fatal "
+      st = os.stat(self.fname)
+      logfile = open(self.fname, 'r')
+      signature = self._signature(logfile, self._data_end)
+      logfile.close()
+      tmpname = self._cache_name() + '.tmp.npz'
+      try:
+         np.savez_compressed(tmpname, kind=type(self).__name__,
+               version=self.cache_version, numexchg=self.numexchg,
+               values=np.array(self.values), nreps=len(self.reps),
+               data_start=self._data_start, data_end=self._data_end,
+               size=st.st_size, mtime=st.st_mtime, signature=signature,
+               records=self.records[:self.nexch])
+         os.rename(tmpname, self._cache_name())
+      except (IOError, OSError):
+         if os.path.exists(tmpname): os.remove(tmpname)
+
+   #================================================
+
+   def _load_cache(self):
+      """ Loads the parsed log from the cache file if it is valid, parsing
+          only what was appended to the log since the cache was written.
+          Returns False if there is no usable cache
+      """
+      try:
+         cache = np.load(self._cache_name())
+         if str(cache['kind']) != type(self).__name__ or \
+               int(cache['version']) != self.cache_version:
+            return False
+         size, mtime = int(cache['size']), float(cache['mtime'])
+         data_end = int(cache['data_end'])
+         st = os.stat(self.fname)
+         if st.st_size < size or (st.st_size == size and
+                                  st.st_mtime != mtime):
+            return False
+         logfile = open(self.fname, 'r')
+         signature = self._signature(logfile, data_end)
+         logfile.close()
+         if signature != str(cache['signature']):
+            return False
+         self.numexchg = int(cache['numexchg'])
+         self.values = [float(v) for v in cache['values']]
+         self.reps = [Replica() for i in range(int(cache['nreps']))]
+         self._data_start = int(cache['data_start'])
+         self._data_end = data_end
+         records = cache['records']
+      except (IOError, OSError, KeyError, ValueError):
+         return False
+      self._allocate(len(records))
+      self._append(records)
+      if st.st_size != size or st.st_mtime != mtime:
+         # Only parse what was appended since the cache was written
+         records, self._data_end = self._read_records(self._data_end)
+         self._append(records)
+         self._save_cache()
+      return True
+
+   #================================================
+
+   def _get_replicas(self):
+      " Gets replica information from the first block -- must be inherited! "
+      raise RemdError('_get_replicas: Virtual method only!')
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
 class TempRemLog(RemLog):
    """ Replica exchange log file """
 
-   line_re = re.compile(r' *(\d+) *([-+]?\d\.\d+) *(\d+\.\d+) *([-+]?\d+\.\d+) *(\d+\.\d+) *(\d+\.\d+) *(\d\.\d+) *([+-]?\d+)')
+   # Rep#, Velocity Scaling, T, Eptot, Temp0, NewTemp0, Success rate, ResStruct#
+   ncols = 8
+   columns = (('potene', 3), ('old_temp', 4), ('new_temp', 5),
+              ('success_rate', 6))
 
    #================================================
 
    def _get_replicas(self):
       " Gets all of the replica information from the first block of repinfo "
-      rawline = self.file.readline()
-      while rawline:
-         rematch = self.line_re.match(rawline)
-         if not rematch:
-            rawline = self.file.readline()
-            continue
-         # Now we have our first block of replicas!
-         while rematch:
-            rep = Replica()
-            self.reps.append(rep)
-            # Each replica will have an index array to trace its trajectory
-            # through replica space. Indexing starts from 0
-            rep.index = [0 for i in range(self.numexchg)]
-            rep.potene = np.zeros(self.numexchg)
-            rep.success_rate = np.zeros(self.numexchg)
-            rep.old_temp = np.zeros(self.numexchg)
-            rep.new_temp = np.zeros(self.numexchg)
-            rep.index[0] = int(rematch.groups()[0]) - 1
-            rep.potene[0] = float(rematch.groups()[3])
-            rep.success_rate[0] = float(rematch.groups()[6])
-            rep.old_temp[0] = float(rematch.groups()[4])
-            rep.new_temp[0] = float(rematch.groups()[5])
-            self.values.append(rep.old_temp[0])
-            rematch = self.line_re.match(self.file.readline())
-         # Finished our first block of replicas. Bail out now
-         break
-      # Now sort our temperatures and adjust our index
+      for words in self._first_block():
+         self.reps.append(Replica())
+         self.values.append(float(words[4]))
+      # Now sort our temperatures
       self.values.sort()
-      for rep in self.reps:
-         rep.index[0] = self.values.index(rep.old_temp[0])
 
    #================================================
 
-   def _parse(self):
-      """ Parses the rem.log file and loads the data arrays """
-      rawline = self.file.readline()
-      num_record = 1
-      while rawline:
-         rematch = self.line_re.match(rawline)
-         if not rematch:
-            rawline = self.file.readline()
-            continue
-         while rematch:
-            repnum,j1,j2,potene,old_temp,new_temp,success_rate,j4 = \
-                                 rematch.groups()
-            repnum = int(repnum) - 1
-            potene = float(potene)
-            old_temp = float(old_temp)
-            new_temp = float(new_temp)
-            success_rate = float(success_rate)
-            self.reps[repnum].potene[num_record] = potene
-            self.reps[repnum].old_temp[num_record] = old_temp
-            self.reps[repnum].new_temp[num_record] = new_temp
-            self.reps[repnum].success_rate[num_record] = success_rate
-            self.reps[repnum].index[num_record] = self.values.index(old_temp)
-            rematch = self.line_re.match(self.file.readline())
-         num_record += 1
-         rawline = self.file.readline()
+   def _fill(self, first, last):
+      " Fills the property arrays for exchanges first to last-1 "
+      RemLog._fill(self, first, last)
+      self.index[first:last] = self._value_indices(self.old_temp[first:last])
+
+   #================================================
+
+   def _accepted(self, first, last):
+      " Replicas whose temperature changed in exchanges first to last-1 "
+      return self.new_temp[first:last] != self.old_temp[first:last]
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
 class HRemLog(RemLog):
    """ A class for H-REMD log file """
 
-   line_re = re.compile(r' *(\d+) *(\d+) *([-+]?\d+\.\d+) *([-+]?\d+\.\d+) *([-+]?\d+\.\d+) *([-+]?\d+\.\d+) *([-+]?\d+\.\d+) *([TF]) *([-+]?\d+\.\d+)')
+   # Rep#, Neibr#, Temp, PotE(x_1), PotE(x_2), left_fe, right_fe, Success,
+   # Success rate
+   ncols = 9
+   columns = (('temp', 2), ('potene1', 3), ('potene2', 4), ('left_fe', 5),
+              ('right_fe', 6), ('success_rate', 8))
+   success_re = re.compile(r'(?<=\s)([TF])(?=\s)')
+
+   #================================================
 
    def _get_replicas(self):
       " Gets all of the replica information from the first block of repinfo "
-      rawline = self.file.readline()
-      while rawline:
-         rematch = self.line_re.match(rawline)
-         if not rematch:
-            rawline = self.file.readline()
-            continue
-         # Now we have our first block of replicas
-         while rematch:
-            rep = Replica()
-            self.reps.append(rep)
-            # Each replica will have an index array to trace its trajectory
-            # through replica space. Indexing starts from 0
-            rep.index = [0 for i in range(self.numexchg)]
-            rep.neighbor_index = [0 for i in range(self.numexchg)]
-            rep.temp = np.zeros(self.numexchg)
-            rep.potene1 = np.zeros(self.numexchg)
-            rep.potene2 = np.zeros(self.numexchg)
-            rep.left_fe = np.zeros(self.numexchg)
-            rep.right_fe = np.zeros(self.numexchg)
-            rep.success = ['F' for i in range(self.numexchg)]
-            rep.success_rate = np.zeros(self.numexchg)
-            rep.index[0] = int(rematch.groups()[0]) - 1
-            rep.neighbor_index[0] = int(rematch.groups()[1]) - 1
-            rep.temp[0] = float(rematch.groups()[2])
-            rep.potene1[0] = float(rematch.groups()[3])
-            rep.potene2[0] = float(rematch.groups()[4])
-            rep.left_fe[0] = float(rematch.groups()[5])
-            rep.right_fe[0] = float(rematch.groups()[6])
-            rep.success[0] = rematch.groups()[7]
-            rep.success_rate[0] = float(rematch.groups()[8])
-            rematch = self.line_re.match(self.file.readline())
-         # Finished with our first block of replicas. Bail out now
-         break
+      for words in self._first_block():
+         self.reps.append(Replica())
 
    #================================================
 
-   def _parse(self):
-      """ Parses the rem.log file and loads the data arrays """
-      rawline = self.file.readline()
-      num_record = 1
-      while rawline:
-         rematch = self.line_re.match(rawline)
-         if not rematch:
-            rawline = self.file.readline()
-            continue
-         while rematch:
-            n, m, t, p1, p2, lfe, rfe, suc, suc_rate = rematch.groups()
-            n = int(n) - 1
-            m = int(m) - 1
-            self.reps[n].index[num_record] = n
-            self.reps[n].neighbor_index[num_record] = m
-            self.reps[n].temp[num_record] = float(t)
-            self.reps[n].potene1[num_record] = float(p1)
-            self.reps[n].potene2[num_record] = float(p2)
-            self.reps[n].left_fe[num_record] = float(lfe)
-            self.reps[n].right_fe[num_record] = float(rfe)
-            self.reps[n].success[num_record] = suc
-            self.reps[n].success_rate[num_record] = float(suc_rate)
-            rematch = self.line_re.match(self.file.readline())
-         num_record += 1
-         rawline = self.file.readline()
+   def _prepare_chunk(self, text):
+      " Turn the T/F success column into 1/0 "
+      return self.success_re.sub(lambda m: m.group(1) == 'T' and '1' or '0',
+                                 text)
+
+   #================================================
+
+   def _allocate_arrays(self):
+      " Creates the property arrays and returns their names "
+      names = RemLog._allocate_arrays(self)
+      self.neighbor_index = self._array(int)
+      self.success = self._array('S1')
+      self.success[:] = 'F'
+      return names + ['neighbor_index', 'success']
+
+   #================================================
+
+   def _fill(self, first, last):
+      " Fills the property arrays for exchanges first to last-1 "
+      RemLog._fill(self, first, last)
+      records = self.records[first:last]
+      self.index[first:last] = records[:,:,0] - 1
+      self.neighbor_index[first:last] = records[:,:,1] - 1
+      self.success[first:last][records[:,:,7] == 1] = 'T'
+
+   #================================================
+
+   def _accepted(self, first, last):
+      " Replicas whose exchange succeeded in exchanges first to last-1 "
+      return self.records[first:last,:,7] == 1
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
 class pHRemLog(RemLog):
    """ A class for a rem.log file in pH exchange """
 
-   line_re = re.compile(r' *(\d+) *(\d+) *([-+]?\d+\.\d+) *(\d+\.\d+) *([-+]?\d+\.\d+)')
+   # Rep#, N_prot, old_pH, new_pH, Success rate
+   ncols = 5
+   columns = (('prot_cnt', 1), ('old_pH', 2), ('new_pH', 3),
+              ('success_rate', 4))
 
    #================================================
 
    def _get_replicas(self):
       " Gets all of the replica information from the first block of repinfo "
-      rawline = self.file.readline()
-      while rawline:
-         rematch = self.line_re.match(rawline)
-         if not rematch:
-            rawline = self.file.readline()
-            continue
-         # Now we have our first block of replicas!
-         while rematch:
-            rep = Replica()
-            self.reps.append(rep)
-            # Each replica will have an index array to trace its trajectory
-            # through replica space. Indexing starts from 0
-            rep.index = [0 for i in range(self.numexchg)]
-            rep.prot_cnt = np.zeros(self.numexchg)
-            rep.success_rate = np.zeros(self.numexchg)
-            rep.old_pH = np.zeros(self.numexchg)
-            rep.new_pH = np.zeros(self.numexchg)
-            rep.index[0] = int(rematch.groups()[0]) - 1
-            rep.prot_cnt[0] = float(rematch.groups()[1])
-            rep.old_pH[0] = float(rematch.groups()[2])
-            rep.new_pH[0] = float(rematch.groups()[3])
-            rep.success_rate[0] = float(rematch.groups()[4])
-            self.values.append(rep.old_pH[0])
-            rematch = self.line_re.match(self.file.readline())
-         # Finished our first block of replicas. Bail out now
-         break
-      # Now sort our temperatures and adjust our index
+      for words in self._first_block():
+         self.reps.append(Replica())
+         self.values.append(float(words[2]))
+      # Now sort our pHs
       self.values.sort()
-      for rep in self.reps:
-         rep.index[0] = self.values.index(rep.old_pH[0])
 
    #================================================
 
-   def _parse(self):
-      """ Parses the rem.log file and loads the data arrays """
-      rawline = self.file.readline()
-      num_record = 1
-      while rawline:
-         rematch = self.line_re.match(rawline)
-         if not rematch:
-            rawline = self.file.readline()
-            continue
-         while rematch:
-            repnum, prot_cnt, old_pH, new_pH, success_rate = rematch.groups()
-            repnum = int(repnum) - 1
-            self.reps[repnum].prot_cnt[num_record] = int(prot_cnt)
-            self.reps[repnum].old_pH[num_record] = float(old_pH)
-            self.reps[repnum].new_pH[num_record] = float(new_pH)
-            self.reps[repnum].success_rate[num_record] = float(success_rate)
-            self.reps[repnum].index[num_record] = self.values.index(float(old_pH))
-            rematch = self.line_re.match(self.file.readline())
-         num_record += 1
-         rawline = self.file.readline()
+   def _fill(self, first, last):
+      " Fills the property arrays for exchanges first to last-1 "
+      RemLog._fill(self, first, last)
+      self.index[first:last] = self._value_indices(self.old_pH[first:last])
+
+   #================================================
+
+   def _accepted(self, first, last):
+      " Replicas whose pH changed in exchanges first to last-1 "
+      return self.new_pH[first:last] != self.old_pH[first:last]
 
 #~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
 
@@ -274,6 +485,9 @@ if __name__ == '__main__':
                      help='Output file', default=None)
    parser.add_option('-t', '--type', dest='type', default='TEMP',
                      help='Type of REM log file (TEMP/ph)')
+   parser.add_option('-n', '--no-cache', dest='cache', default=True,
+                     action='store_false', help='Do not read or write the ' +
+                     'parsed log cache (FILE.npz)')
    
    opt, args = parser.parse_args()
 
@@ -290,9 +504,9 @@ if __name__ == '__main__':
    else: output = open(opt.output, 'w')
 
    if opt.type == 'TEMP':
-      remlog = TempRemLog(opt.input)
+      remlog = TempRemLog(opt.input, opt.cache)
    elif opt.type == 'pH':
-      remlog = pHRemLog(opt.input)
+      remlog = pHRemLog(opt.input, opt.cache)
 
    output.write('NUMEXCHG = %d\n' % remlog.numexchg)
 
@@ -0,0 +1,172 @@
+"""
+This module computes mixing diagnostics for replica exchange simulations from
+the index arrays of a remd.RemLog: the state (sorted value index) of every
+replica at every exchange, how often each replica visits each state, the
+state-to-state transition matrix, and round trips and first passages between
+the two end states of the ladder. Every routine is linear in the number of
+replica-steps.
+"""
+
+import numpy as np
+from remd import TempRemLog, pHRemLog, RemdError
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def state_trajectories(remlog):
+   """ Returns an (nexch, nreps) array of the state each replica occupied at
+       each exchange parsed from the log
+   """
+   return remlog.index[:remlog.nexch]
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def occupancy(remlog):
+   """ Returns an (nreps, nstates) array with the number of exchanges each
+       replica spent in each state
+   """
+   states = state_trajectories(remlog)
+   nreps = states.shape[1]
+   nstates = len(remlog.reps)
+   reps = np.arange(nreps)[np.newaxis,:]
+   counts = np.bincount((reps * nstates + states).ravel(),
+                        minlength=nreps*nstates)
+   return counts.reshape((nreps, nstates))
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def transition_matrix(remlog, normalize=True):
+   """ Returns the (nstates, nstates) matrix of transitions from state i to
+       state j between consecutive exchanges, pooled over all replicas. With
+       normalize, each row is divided by its total so it holds probabilities
+   """
+   states = state_trajectories(remlog)
+   nstates = len(remlog.reps)
+   counts = np.bincount((states[:-1] * nstates + states[1:]).ravel(),
+                        minlength=nstates*nstates)
+   counts = counts.reshape((nstates, nstates))
+   if not normalize: return counts
+   totals = counts.sum(axis=1)
+   return counts / np.maximum(totals, 1).astype(float)[:,np.newaxis]
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+def end_arrivals(states, nstates):
+   """ For one replica's state trajectory, returns the exchanges at which it
+       arrived at an end state it was not at last, and which end that was (0
+       for the lowest state, 1 for the highest). Arrivals alternate ends
+   """
+   ends = np.flatnonzero((states == 0) | (states == nstates - 1))
+   if len(ends) == 0:
+      return np.zeros(0, int), np.zeros(0, int)
+   top = (states[ends] == nstates - 1).astype(int)
+   # Only keep the first visit after the other end was last seen
+   first = np.concatenate(([0], np.flatnonzero(np.diff(top)) + 1))
+   return ends[first], top[first]
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+class Passages(object):
+   """ Round trips and first passages of every replica between the end
+       states. For each replica (lists indexed by replica):
+         round_trips: times (in exchanges) of each lowest -> highest -> lowest
+                      trip
+         up:          first passage times from lowest to highest state
+         down:        first passage times from highest to lowest state
+   """
+
+   def __init__(self, remlog):
+      states = state_trajectories(remlog)
+      nstates = len(remlog.reps)
+      self.round_trips, self.up, self.down = [], [], []
+      for i in range(states.shape[1]):
+         times, top = end_arrivals(states[:,i], nstates)
+         steps = np.diff(times)
+         self.up.append(steps[top[:-1] == 0])
+         self.down.append(steps[top[:-1] == 1])
+         self.round_trips.append(np.diff(times[top == 0]))
+
+   #================================================
+
+   def num_round_trips(self):
+      " Number of completed round trips of each replica "
+      return np.array([len(rt) for rt in self.round_trips])
+
+   #================================================
+
+   @staticmethod
+   def _mean(arrays):
+      all = np.concatenate(arrays)
+      if len(all) == 0: return 0.0
+      return all.mean()
+
+   #================================================
+
+   def mean_round_trip(self):
+      " Mean round trip time over all replicas (0 if there were none) "
+      return self._mean(self.round_trips)
+
+   #================================================
+
+   def mfpt(self):
+      " Mean first passage times (lowest->highest, highest->lowest) "
+      return self._mean(self.up), self._mean(self.down)
+
+#~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~+~
+
+if __name__ == '__main__':
+   from optparse import OptionParser
+   import sys
+
+   parser = OptionParser()
+   parser.add_option('-l', '--remlog', dest='input', metavar='FILE',
+                     help='Input rem.log file.', default=None)
+   parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                     help='Output file', default=None)
+   parser.add_option('-t', '--type', dest='type', default='TEMP',
+                     help='Type of REM log file (TEMP/ph)')
+   parser.add_option('-n', '--no-cache', dest='cache', default=True,
+                     action='store_false', help='Do not read or write the ' +
+                     'parsed log cache (FILE.npz)')
+
+   opt, args = parser.parse_args()
+
+   if args or not opt.input:
+      parser.print_help()
+      sys.exit(1)
+
+   if opt.type.upper() == 'TEMPERATURE'[:len(opt.type)] and len(opt.type) >= 4:
+      remlog = TempRemLog(opt.input, opt.cache)
+   elif opt.type.upper() == 'PH':
+      remlog = pHRemLog(opt.input, opt.cache)
+   else:
+      raise RemdError('Unknown REM log type %s' % opt.type)
+
+   if not opt.output: output = sys.stdout
+   else: output = open(opt.output, 'w')
+
+   nreps = len(remlog.reps)
+   passages = Passages(remlog)
+   ntrips = passages.num_round_trips()
+
+   output.write('Analyzed %d exchanges of %d replicas\n\n' %
+                (remlog.nexch, nreps))
+
+   output.write('Round trips between %s and %s:\n' %
+                (remlog.values[0], remlog.values[-1]))
+   output.write('\n'.join(['Rep %3d: %5d' % (i+1, n)
+                           for i, n in enumerate(ntrips)]))
+   output.write('\nTotal: %d   Mean round trip time: %.2f\n' %
+                (ntrips.sum(), passages.mean_round_trip()))
+   up, down = passages.mfpt()
+   output.write('Mean first passage time up: %.2f   down: %.2f\n\n' %
+                (up, down))
+
+   output.write('State occupancy (replica x state):\n')
+   for i, row in enumerate(occupancy(remlog)):
+      output.write('Rep %3d:' % (i+1) + ''.join(['%7d' % n for n in row]) +
+                   '\n')
+
+   output.write('\nState transition matrix:\n')
+   for i, row in enumerate(transition_matrix(remlog)):
+      output.write('%9s' % remlog.values[i] +
+                   ''.join(['%7.3f' % p for p in row]) + '\n')
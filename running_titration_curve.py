@@ -95,6 +95,19 @@ class pHStatFile(object):
       # If we hit here, we are out of lines, or something
       return None
 
+   def get_all_residues(self):
+      """
+      Reads every remaining residue record from this file. Returns a tuple of
+      lists: (resnames, resnums, offsets, preds, frac_prots, transitions)
+      """
+      records = []
+      stuff = self.get_next_residue()
+      while stuff:
+         records.append(stuff)
+         stuff = self.get_next_residue()
+      if not records: return [], [], [], [], [], []
+      return tuple([list(column) for column in zip(*records)])
+
 #-------------------------------------------------------------------------------
 
 def curve_with_hillcoef(ph, pka, hillcoef):
@@ -124,7 +137,171 @@ def get_avg_pka(predicted_pkas):
 
 #-------------------------------------------------------------------------------
 
-def main(file_list, outname, fit_func, starting_guess, chunk, hill):
+# Convergence controls for the batched Levenberg-Marquardt fits
+MAX_ITER = 200
+FTOL = 1e-12
+XTOL = 1e-10
+MAX_LAMBDA = 1e10
+# Smallest curvature (diagonal of J^T J) we consider well-conditioned
+MIN_CURVATURE = 1e-14
+# Batched fits with a pKa further than this outside the sampled pH range are
+# not trusted and are redone by fallback_fit
+PKA_MARGIN = 5.0
+LN10 = math.log(10)
+
+def linearized_fit(xdata, ydata, hill):
+   """
+   Closed-form starting parameters for each row of ydata (fraction
+   deprotonated at each pH in xdata) from a weighted linear fit of the logit:
+   log10(y/(1-y)) = hillcoef * (pH - pKa). Returns an (nfits, nparams) array
+   """
+   y = np.clip(ydata, 1e-3, 1 - 1e-3)
+   z = np.log10(y / (1 - y))
+   w = y * (1 - y)
+   x = xdata[np.newaxis,:]
+   sw = w.sum(axis=1)
+   if not hill:
+      return (np.sum(w * (x - z), axis=1) / sw)[:,np.newaxis]
+   xm = np.sum(w * x, axis=1) / sw
+   zm = np.sum(w * z, axis=1) / sw
+   dx = x - xm[:,np.newaxis]
+   sxx = np.sum(w * dx * dx, axis=1)
+   sxz = np.sum(w * dx * (z - zm[:,np.newaxis]), axis=1)
+   hillcoef = np.where(sxx > 0, sxz / np.where(sxx > 0, sxx, 1), 1)
+   hillcoef = np.where(np.abs(hillcoef) > 1e-3, hillcoef, 1)
+   return np.column_stack((xm - zm / hillcoef, hillcoef))
+
+#-------------------------------------------------------------------------------
+
+def _batch_curve(params, xdata):
+   """ Fraction deprotonated and its derivatives for each row of params """
+   pka = params[:,0:1]
+   if params.shape[1] > 1: hillcoef = params[:,1:2]
+   else: hillcoef = 1
+   arg = np.clip(LN10 * hillcoef * (pka - xdata[np.newaxis,:]), -700, 700)
+   curve = 1 / (1 + np.exp(arg))
+   dcurve = -LN10 * curve * (1 - curve)
+   jac = np.empty(curve.shape + params.shape[1:])
+   jac[:,:,0] = dcurve * hillcoef
+   if params.shape[1] > 1: jac[:,:,1] = dcurve * (pka - xdata[np.newaxis,:])
+   return curve, jac
+
+#-------------------------------------------------------------------------------
+
+def batch_fit(xdata, ydata, hill, maxiter=MAX_ITER):
+   """
+   Fits every row of ydata to curve_with_hillcoef (hill) or curve_no_hillcoef
+   simultaneously with a vectorized Levenberg-Marquardt least squares fit,
+   seeded with linearized_fit. Returns the (nfits, nparams) parameters and a
+   mask of which fits converged; fits whose curvature vanishes (e.g., fully
+   (de)protonated data), that do not converge, or that converge to a
+   non-positive Hill coefficient or a pKa more than PKA_MARGIN outside the
+   sampled pH range are flagged for fallback_fit
+   """
+   params = linearized_fit(xdata, ydata, hill)
+   nfits, nparams = params.shape
+   curve, jac = _batch_curve(params, xdata)
+   resid = curve - ydata
+   ssr = np.sum(resid * resid, axis=1)
+   lam = np.empty(nfits); lam.fill(1e-3)
+   active = np.isfinite(ssr)
+   converged = np.zeros(nfits, bool)
+   ident = np.eye(nparams)[np.newaxis,:,:]
+
+   for iteration in range(maxiter):
+      act = np.flatnonzero(active)
+      if len(act) == 0: break
+      J = jac[act]
+      jtj = np.einsum('ipk,ipl->ikl', J, J)
+      grad = np.einsum('ipk,ip->ik', J, resid[act])
+      diag = jtj.diagonal(axis1=1, axis2=2)
+      # Give up on ill-conditioned fits and leave them for the fallback
+      ill = ~np.all(diag > MIN_CURVATURE, axis=1) | \
+            (np.linalg.det(jtj) <= MIN_CURVATURE * np.prod(diag, axis=1))
+      if ill.any():
+         active[act[ill]] = False
+         act, jtj, grad, diag = act[~ill], jtj[~ill], grad[~ill], diag[~ill]
+         if len(act) == 0: break
+      lhs = jtj + lam[act,np.newaxis,np.newaxis] * diag[:,:,np.newaxis] * ident
+      step = -np.linalg.solve(lhs, grad[:,:,np.newaxis])[:,:,0]
+      trial = params[act] + step
+      tcurve, tjac = _batch_curve(trial, xdata)
+      tresid = tcurve - ydata[act]
+      tssr = np.sum(tresid * tresid, axis=1)
+      better = tssr <= ssr[act]
+      # Accept the improved steps and relax their damping
+      good = act[better]
+      small = (ssr[good] - tssr[better] <= FTOL * ssr[good] + 1e-30) & \
+              np.all(np.abs(step[better]) <= XTOL * (np.abs(params[good]) +
+                     XTOL), axis=1)
+      params[good] = trial[better]
+      curve[good], jac[good], resid[good] = tcurve[better], tjac[better], \
+                                            tresid[better]
+      ssr[good] = tssr[better]
+      lam[good] *= 0.1
+      lam[act[~better]] *= 10
+      # A step that neither changes the parameters nor the residual is done
+      converged[good[small]] = True
+      active[good[small]] = False
+      stuck = act[~better][lam[act[~better]] > MAX_LAMBDA]
+      active[stuck] = False
+
+   converged &= np.all(np.isfinite(params), axis=1)
+   # Reject physically meaningless minima of noisy, nearly flat data
+   xdata = np.asarray(xdata, float)
+   converged &= (params[:,0] >= xdata.min() - PKA_MARGIN) & \
+                (params[:,0] <= xdata.max() + PKA_MARGIN)
+   if hill: converged &= params[:,1] > 0
+   return params, converged
+
+#-------------------------------------------------------------------------------
+
+def _curve_fit(args):
+   """ One scipy curve_fit, returning None if it fails (run in the pool) """
+   fit_func, xdata, ydata, starting_guess = args
+   try:
+      params, cov = optimize.curve_fit(fit_func, xdata, ydata, starting_guess)
+   except (RuntimeError, ValueError):
+      return None
+   return params
+
+def fallback_fit(fit_func, xdata, ydata, starting_guesses, nproc=1):
+   """
+   Fits each row of ydata with scipy's curve_fit from its starting guess,
+   spreading the fits over nproc processes. Returns a list of parameter
+   arrays, with None wherever the fit failed
+   """
+   jobs = [(fit_func, xdata, y, guess) for y, guess in
+           zip(ydata, starting_guesses)]
+   if nproc <= 1 or len(jobs) < 2 * nproc:
+      return [_curve_fit(job) for job in jobs]
+   from multiprocessing import Pool
+   pool = Pool(nproc)
+   try:
+      return pool.map(_curve_fit, jobs, max(1, len(jobs) // (4 * nproc)))
+   finally:
+      pool.terminate()
+
+#-------------------------------------------------------------------------------
+
+def frame_numbers(nrecords, nres):
+   """
+   The frame number printed with each residue record, numbering the records
+   in the order they are read from the files
+   """
+   numbers = np.zeros(nrecords, int)
+   numres = numframes = 0
+   for i in range(nrecords):
+      numres += 1
+      if numres % nres == 0:
+         numframes += 1
+         numres = 1
+      numbers[i] = numframes
+   return numbers
+
+#-------------------------------------------------------------------------------
+
+def main(file_list, outname, fit_func, starting_guess, chunk, hill, nproc=1):
    """
    This function is the main driver. It fits the data to the given fit_func (it
    should be one of the Callable functions defined above).
@@ -134,18 +311,19 @@ def main(file_list, outname, fit_func, starting_guess, chunk, hill):
       outname:        File prefix to dump all of the statistics to
       fit_func:       The function we're fitting to
       starting_guess: The starting guess for the parameters
+      nproc:          Number of processes for fits batch_fit cannot do
+
+   All of the records are read first, and every residue at every frame is fit
+   at once with batch_fit (only curve_with_hillcoef and curve_no_hillcoef can
+   be batched; anything else goes straight to fallback_fit).
 
    All error checking should be done on this input before calling main, or
    suffer the exceptions! Output files are named "outname_RES_NUM.dat"
    """
    
-   class StopWhile(Exception): pass
-
    # See if we want to analyze chunks
    if chunk: pHStatFile.my_re = pHStatFile.chunkre
 
-   xdata = np.zeros(len(file_list))
-   ydata = np.zeros(len(file_list))
    # Convert the file_list into a list of pHStatFile objects if it's not yet
    if type(file_list[0]).__name__ == 'str':
       tmp = [pHStatFile(open(fname, 'r')) for fname in file_list]
@@ -154,84 +332,63 @@ def main(file_list, outname, fit_func, starting_guess, chunk, hill):
    # Build the list of output files
    output_files = {}
    for resid in file_list[0].list_of_residues:
-      output_files[resid] = open('%s_%s.dat' % (outname, resid), 'w', 0)
+      output_files[resid] = open('%s_%s.dat' % (outname, resid), 'w')
   
    # Generate the x-data (the pHs). This never changes
-   for i, frec in enumerate(file_list): xdata[i] = frec.pH
+   xdata = np.array([frec.pH for frec in file_list], float)
 
-   # Now loop through all of our data
-   numres = 0      # Number of residues we've looped through so far
-   numframes = 0   # Number of frames we've looped through so far
+   # Load every record of every file. The files are synchronized, so record i
+   # is the same residue in each; stop when the first file runs out
+   records = [frec.get_all_residues() for frec in file_list]
+   nrec = min([len(rec[0]) for rec in records])
+   resids = ['%s_%d' % (name, num) for name, num in
+             zip(records[0][0][:nrec], records[0][1][:nrec])]
+   offset = np.array([rec[2][:nrec] for rec in records]).T
+   pred = np.array([rec[3][:nrec] for rec in records]).T
+   ydata = 1 - np.array([rec[4][:nrec] for rec in records]).T
+   numframes = frame_numbers(nrec, len(output_files))
+   lines = [None] * nrec
 
-   # This is the easiest way to bust out of an infinite loop -- Engulf the whole
-   # thing in a big try-except, and catch a specialized exception.
-   try:
-      while True:
-         numres += 1
-         # If we've looped through all of our residues, then we know we've hit
-         # the next frame, so update our counters accordingly
-         if numres % len(output_files) == 0:
-            numframes += 1
-            numres = 1
-         # Zero out the y-data, because we're about to fill it up
-         ydata = np.zeros(len(file_list))           # fraction protonated
-         offset = np.zeros(len(file_list))          # Offset for pKa
-         pred = np.zeros(len(file_list))            # Predicted pKas
-         trans = [0 for i in range(len(file_list))] # num of transitions
-         # Loop through all of the files and get our next residue -- they should
-         # be synchronized, so this should pull the same residue from each file
-         for i, frec in enumerate(file_list):
-            stuff = frec.get_next_residue()
-            # If we got nothing bust out of the loop
-            if not stuff:
-               raise StopWhile
-            resname,resnum,offset[i],pred[i],ydata[i],trans[i] = stuff
-            ydata[i] = 1-ydata[i] # Get fraction DEprotonated
-            # Make the y-data into a hill-plottable form
-         if fit_func:
-            # If we're doing a hill plot, adjust our starting guess to be
-            # relatively close -- hill will start as 1, and pKa will start
-            # as the average of pKa values (not including infinity)
-            if hill:
-               starting_guess = (get_avg_pka(pred), 1)
-            try:
-               params, cov = optimize.curve_fit(fit_func, xdata,
-                                                ydata, starting_guess)
-            except (RuntimeError, ValueError):
-               # If we can't fit the data (expected at the beginning) just go on
-               continue
-            line = '%d ' % numframes
-            try:
-               for i, param in enumerate(params):
-                  try:
-#                    line += '%.4f %.4f ' % (param, math.sqrt(cov[i][i]))
-                     line += '%.4f ' % param
-                  except TypeError:
-#                    line += '%.4f %.4f ' % (param, cov)
-                     line += '%.4f ' % param
-            except ValueError:
-               continue
-         else:
-            # Average all of the predicted pKas, ignoring values whose offset is
-            # >= 3 pH units
-            runsum = runsum2 = numpts = 0
-            for i in range(len(file_list)):
-               if abs(offset[i]) < 3:
-                  runsum += pred[i]
-                  runsum2 += pred[i] * pred[i]
-                  numpts += 1
-
-            if numpts == 0: continue
-            avg = runsum / numpts
-            stdev = math.sqrt(abs(runsum2/numpts - avg*avg))
-            line = '%d %.4f %.4f' % (numframes, avg, stdev)
-            
-         # Now write out the data as: Frame # pKa1 std.dev. [hill.coef. std.dev.]
-         # but only write out if we actually got a pKa this time around
-         ofile = output_files['%s_%d' % (resname, resnum)]
-         ofile.write(line + os.linesep)
-
-   except StopWhile: pass
+   if fit_func:
+      if fit_func in (curve_with_hillcoef, curve_no_hillcoef):
+         params, converged = batch_fit(xdata, ydata,
+                                       fit_func is curve_with_hillcoef)
+         params = list(params)
+      else:
+         params, converged = [None] * nrec, np.zeros(nrec, bool)
+      # Refit what the batched fit could not with curve_fit. If we're doing a
+      # hill plot, start hill as 1, and pKa as the average of pKa values (not
+      # including infinity)
+      refit = np.flatnonzero(~converged)
+      if hill:
+         guesses = [(get_avg_pka(pred[i]), 1) for i in refit]
+      else:
+         guesses = [starting_guess] * len(refit)
+      for i, fit in zip(refit, fallback_fit(fit_func, xdata, ydata[refit],
+                                            guesses, nproc)):
+         params[i] = fit
+      for i in range(nrec):
+         # If we can't fit the data (expected at the beginning) just go on
+         if params[i] is None: continue
+         lines[i] = '%d ' % numframes[i] + \
+                    ''.join(['%.4f ' % param for param in params[i]])
+   else:
+      # Average all of the predicted pKas, ignoring values whose offset is
+      # >= 3 pH units
+      use = np.abs(offset) < 3
+      numpts = use.sum(axis=1)
+      runsum = np.where(use, pred, 0).sum(axis=1)
+      runsum2 = np.where(use, pred * pred, 0).sum(axis=1)
+      for i in np.flatnonzero(numpts):
+         avg = runsum[i] / numpts[i]
+         stdev = math.sqrt(abs(runsum2[i]/numpts[i] - avg*avg))
+         lines[i] = '%d %.4f %.4f' % (numframes[i], avg, stdev)
+
+   # Now write out the data as: Frame # pKa1 std.dev. [hill.coef. std.dev.]
+   # but only write out if we actually got a pKa this time around
+   for resid, line in zip(resids, lines):
+      if line is not None: output_files[resid].write(line + os.linesep)
+   for ofile in output_files.values(): ofile.close()
    
 if __name__ == '__main__':
    """ Main program """
@@ -256,6 +413,9 @@ if __name__ == '__main__':
    group.add_option('-a', '--average', dest='avg', default=False,
                     action='store_true',
                     help='Do simple averaging to get pKa and error bars.')
+   group.add_option('-p', '--nproc', dest='nproc', default=1, type='int',
+                    metavar='INT', help='Number of processes to use for the ' +
+                    'fits that cannot be done in one batch. Default %default')
    parser.add_option_group(group)
    group = OptionGroup(parser, 'Data Options', 'These options control the ' +
                        'data that gets processed')
@@ -296,5 +456,6 @@ if __name__ == '__main__':
    if opt.avg:
       fit_func = None
    # Now call our main function
-   main(args, opt.outprefix, fit_func, starting_guess, opt.chunk, opt.hill)
+   main(args, opt.outprefix, fit_func, starting_guess, opt.chunk, opt.hill,
+        opt.nproc)
    print 'Finished: I took %.3f minutes' % ((time()-start)/60)
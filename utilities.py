@@ -31,12 +31,18 @@
 #              alphabeitcal ordered array
 # minmax: returns the maximum and minimum of a data set
 # add_log: adds logs of two numbers and stores it as the log of the sum
+# loadparm: returns a (cached) AmberParm for a given amber topology file
 #
 ################################################################################
 
 from chemistry.amber.readparm import AmberParm
+from collections import OrderedDict
 import os, math
 
+# Topologies recently loaded by loadparm, keyed by path, size, and mtime
+_parm_cache = OrderedDict()
+PARM_CACHE_SIZE = 4
+
 def which(program):
    def is_exe(fpath):
       return os.path.exists(fpath) and os.access(fpath, os.X_OK)
@@ -115,23 +121,40 @@ def round(number, decimals):
       return toreturn
 
 
+def loadparm(topfile):
+   """
+   Returns an AmberParm for topfile, reusing the one loaded by a previous call
+   as long as the file has not changed since. The returned object is shared,
+   so do not modify it.
+   """
+   st = os.stat(topfile)
+   key = (os.path.abspath(topfile), st.st_size, st.st_mtime)
+   if key in _parm_cache:
+      parm = _parm_cache.pop(key)
+   else:
+      parm = AmberParm(topfile)
+   _parm_cache[key] = parm
+   while len(_parm_cache) > PARM_CACHE_SIZE:
+      _parm_cache.popitem(last=False)
+   return parm
+
 def resnum(topfile):
 
-   parm = AmberParm(topfile)
+   parm = loadparm(topfile)
    return parm.ptr("NRES")
 
 def natom(topfile):
    
-   parm = AmberParm(topfile)
+   parm = loadparm(topfile)
    return parm.ptr("NATOM")
 
 def getresinfo(res, topname, flag):
 
-   parm = AmberParm(topname)
+   parm = loadparm(topname)
    return parm.parm_data[flag][res-1] # and simply return the residue of interest
 
 def getallresinfo(topname, flag):
-   parm = AmberParm(topname)
+   parm = loadparm(topname)
    return parm.parm_data[flag]
 
 def fileexists(file):